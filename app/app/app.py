@@ -17,6 +17,9 @@ class S2S(NoSSRComponent):
     wsEndpoint: rx.Var[str]
     startText: rx.Var[str]
     stopText: rx.Var[str]
+    binaryAudio: rx.Var[bool]
+    # Codecs to offer the middle tier for the audio leg, in order of preference: "mulaw", "adpcm"
+    audioCodec: rx.Var[str]
 
     def add_imports(self):
         return {"react-use-websocket": ["useWebSocket"]}
@@ -36,6 +39,7 @@ def index() -> rx.Component:
                     wsEndpoint="ws://localhost:8765/realtime",
                     startText="Start",
                     stopText="Stop",
+                    binaryAudio=True,
                 ),
                 width="100%",
             ),
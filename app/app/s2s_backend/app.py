@@ -7,8 +7,11 @@ from azure.core.credentials import AzureKeyCredential
 from azure.identity import AzureDeveloperCliCredential, DefaultAzureCredential
 from dotenv import load_dotenv
 
+from flow import FlowPolicy
+from metrics import metrics, metrics_handler
 from ragtools import attach_rag_tools
 from rtmt import RTMiddleTier
+from tokens import TokenManager
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("voicerag")
@@ -43,6 +46,20 @@ async def create_app():
         credentials=llm_credential,
         endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
         deployment=os.environ["AZURE_OPENAI_REALTIME_DEPLOYMENT"],
+        # 0 is unlimited, every session and warm pooled socket holds a connection for its lifetime
+        connector_limit=int(os.environ.get("RTMT_UPSTREAM_CONNECTOR_LIMIT") or 0),
+        dns_cache_ttl=int(os.environ.get("RTMT_UPSTREAM_DNS_CACHE_TTL") or 300),
+        warm_pool_size=int(os.environ.get("RTMT_WARM_POOL_SIZE") or 0),
+        warm_pool_idle_timeout=float(os.environ.get("RTMT_WARM_POOL_IDLE_TIMEOUT") or 60),
+        upstream_connect_timeout=float(os.environ.get("RTMT_UPSTREAM_CONNECT_TIMEOUT") or 10),
+    )
+    rtmt.drain_timeout = float(os.environ.get("RTMT_DRAIN_TIMEOUT") or 30)
+    if silence_gate_dbfs := os.environ.get("RTMT_SILENCE_GATE_DBFS"):
+        rtmt.silence_gate_dbfs = float(silence_gate_dbfs)
+    rtmt.record_directory = os.environ.get("RTMT_RECORD_DIR") or None
+    rtmt.flow_policy = FlowPolicy(
+        max_bytes=int(os.environ.get("RTMT_QUEUE_MAX_BYTES") or 2 * 1024 * 1024),
+        over_budget_timeout=float(os.environ.get("RTMT_QUEUE_OVER_BUDGET_TIMEOUT") or 5),
     )
     rtmt.system_message = (
         "You are an English Speaking assistant. Only answer questions based on information you searched in the knowledge base, accessible with the 'search' tool. "
@@ -53,7 +70,46 @@ async def create_app():
         + "2. Always use the 'report_grounding' tool to report the source of information from the knowledge base. \n"
         + "3. Produce an answer that's as short as possible. If the answer isn't in the knowledge base, say you don't know."
     )
-    attach_rag_tools(
+
+    retriever = None
+    embedder = None
+    embedding_token_manager = None
+    local_retriever_path = os.environ.get("LOCAL_RETRIEVER_PATH")
+    # Query embeddings are computed here for the local backend, and for Azure AI Search when
+    # AZURE_SEARCH_CLIENT_EMBEDDINGS is set, instead of the service embedding every query itself
+    if (embedding_deployment := os.environ.get("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")) and (
+        local_retriever_path or os.environ.get("AZURE_SEARCH_CLIENT_EMBEDDINGS") == "true"
+    ):
+        # Imported here so NumPy is only needed when queries are embedded in the middle tier
+        from embeddings import AzureOpenAIEmbedder, BatchingEmbedder, CachedEmbedder
+
+        if not isinstance(llm_credential, AzureKeyCredential):
+            embedding_token_manager = TokenManager(
+                llm_credential, "https://cognitiveservices.azure.com/.default"
+            )
+        embedder = CachedEmbedder(
+            BatchingEmbedder(
+                AzureOpenAIEmbedder(
+                    endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
+                    deployment=embedding_deployment,
+                    credentials=embedding_token_manager or llm_credential,
+                    dimensions=int(os.environ.get("AZURE_OPENAI_EMBEDDING_DIMENSIONS") or 0)
+                    or None,
+                )
+            ),
+            max_size=int(os.environ.get("AZURE_OPENAI_EMBEDDING_CACHE_SIZE") or 4096),
+            dtype=os.environ.get("AZURE_OPENAI_EMBEDDING_CACHE_DTYPE") or "float16",
+        )
+        metrics.add_collector("query_embeddings", embedder.stats)
+        if embedding_token_manager is not None:
+            metrics.add_collector("embedding_token", embedding_token_manager.metrics.as_dict)
+    if local_retriever_path:
+        # Imported here so NumPy is only needed when the local backend is used
+        from local_retriever import LocalRetriever
+
+        retriever = LocalRetriever(local_retriever_path, embedder=embedder)
+
+    rag_tools = attach_rag_tools(
         rtmt,
         credentials=search_credential,
         search_endpoint=os.environ.get("AZURE_SEARCH_ENDPOINT"),
@@ -66,9 +122,48 @@ async def create_app():
         title_field=os.environ.get("AZURE_SEARCH_TITLE_FIELD") or "title",
         use_vector_query=(os.environ.get("AZURE_SEARCH_USE_VECTOR_QUERY") == "true")
         or True,
+        # Set to an empty string for indexes without one, overlapping chunks are then never merged
+        parent_field=os.environ.get("AZURE_SEARCH_PARENT_FIELD", "parent_id") or None,
+        cache_size=int(os.environ.get("AZURE_SEARCH_CACHE_SIZE") or 256),
+        cache_ttl=float(os.environ.get("AZURE_SEARCH_CACHE_TTL") or 300),
+        speculative_search=os.environ.get("AZURE_SEARCH_SPECULATIVE") == "true",
+        token_budget=int(os.environ.get("AZURE_SEARCH_TOKEN_BUDGET") or 0) or None,
+        search_deadline=float(os.environ.get("AZURE_SEARCH_DEADLINE") or 4),
+        hedge_search=os.environ.get("AZURE_SEARCH_HEDGE") != "false",
+        fallback_to_cached=os.environ.get("AZURE_SEARCH_STALE_FALLBACK") == "true",
+        embedder=embedder,
+        retriever=retriever,
     )
 
+    async def close_rag_tools(app):
+        logger.info("Search cache stats: %s", rag_tools.search_cache.stats.as_dict())
+        logger.info("Search resilience stats: %s", rag_tools.retriever.stats.as_dict())
+        if rag_tools.speculation is not None:
+            logger.info("Speculative search stats: %s", rag_tools.speculation.as_dict())
+        await rag_tools.retriever.close()
+        if embedder is not None:
+            await embedder.close()
+        if rag_tools.token_manager is not None:
+            logger.info("Search token refresh metrics: %s", rag_tools.token_manager.metrics.as_dict())
+            await rag_tools.token_manager.close()
+        if embedding_token_manager is not None:
+            logger.info("Embedding token refresh metrics: %s", embedding_token_manager.metrics.as_dict())
+            await embedding_token_manager.close()
+
+    app.on_cleanup.append(close_rag_tools)
+    metrics.add_collector("search_cache", rag_tools.search_cache.stats.as_dict)
+    metrics.add_collector("chunk_cache", rag_tools.chunk_cache.stats.as_dict)
+    metrics.add_collector("search_resilience", rag_tools.retriever.stats.as_dict)
+    if rag_tools.token_manager is not None:
+        metrics.add_collector("search_token", rag_tools.token_manager.metrics.as_dict)
+    if rag_tools.speculation is not None:
+        metrics.add_collector("speculative_search", rag_tools.speculation.as_dict)
+
     rtmt.attach_to_app(app, "/realtime")
+    # Content of the chunks report_grounding cites, which only sends their ids and titles
+    rag_tools.allow_origin = os.environ.get("RTMT_CHUNKS_ALLOW_ORIGIN") or None
+    app.router.add_get("/chunks", rag_tools.chunks_handler)
+    app.router.add_get("/metrics", metrics_handler)
 
     current_directory = Path(__file__).parent
 
@@ -0,0 +1,176 @@
+import struct
+from typing import Optional
+
+import numpy as np
+
+
+class InvalidAudioFrame(ValueError):
+    """A client frame that can't be decoded, e.g. truncated or with a header that doesn't match its length."""
+
+
+class AudioCodec:
+    """Transcodes between the PCM16 the realtime API speaks and a smaller format for the client leg.
+
+    decode() raises InvalidAudioFrame for frames it can't make sense of."""
+
+    name: str
+
+    def encode(self, pcm: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+
+def _mulaw_decode_table() -> np.ndarray:
+    codes = ~np.arange(256, dtype=np.int32) & 0xFF
+    exponent = (codes >> 4) & 0x07
+    mantissa = codes & 0x0F
+    magnitude = (((mantissa << 3) + 0x84) << exponent) - 0x84
+    return np.where(codes & 0x80, -magnitude, magnitude).astype(np.int16)
+
+
+class MuLawCodec(AudioCodec):
+    """G.711 μ-law, one byte per sample at the same 24 kHz, half the bytes of PCM16."""
+
+    name = "mulaw"
+    # Encoded from 14 bits like the reference implementation, so negative samples round the same way
+    _BIAS = 0x21
+    _CLIP = 8159
+    # Segment of a biased magnitude, indexed by magnitude >> 7
+    _EXPONENTS = np.array([max(int(v).bit_length() - 1, 0) for v in range(256)], dtype=np.int32)
+    _DECODE = _mulaw_decode_table()
+
+    def encode(self, pcm: bytes) -> bytes:
+        samples = np.frombuffer(pcm, dtype="<i2").astype(np.int32)
+        sign = (samples < 0).astype(np.int32) << 7
+        # The largest magnitudes land one past the top segment, they encode as its top value
+        magnitude = np.minimum((np.minimum(np.abs(samples >> 2), self._CLIP) + self._BIAS) << 2, 32767)
+        exponent = self._EXPONENTS[magnitude >> 7]
+        mantissa = (magnitude >> (exponent + 3)) & 0x0F
+        return (~(sign | (exponent << 4) | mantissa) & 0xFF).astype(np.uint8).tobytes()
+
+    def decode(self, data: bytes) -> bytes:
+        return self._DECODE[np.frombuffer(data, dtype=np.uint8)].astype("<i2").tobytes()
+
+
+# fmt: off
+_ADPCM_STEPS = np.array([
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45, 50, 55, 60, 66, 73, 80, 88, 97,
+    107, 118, 130, 143, 157, 173, 190, 209, 230, 253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796,
+    876, 963, 1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327, 3660, 4026, 4428, 4871,
+    5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442, 11487, 12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623,
+    27086, 29794, 32767,
+], dtype=np.int32)
+_ADPCM_INDEX_ADJUST = np.array([-1, -1, -1, -1, 2, 4, 6, 8, -1, -1, -1, -1, 2, 4, 6, 8], dtype=np.int32)
+# fmt: on
+
+
+def _adpcm_tables() -> tuple[np.ndarray, np.ndarray]:
+    # Signed predictor change and next step index for every (step index << 4 | code), so the per
+    # sample work in the codec loops is two lookups
+    index = np.repeat(np.arange(89, dtype=np.int32), 16)
+    code = np.tile(np.arange(16, dtype=np.int32), 89)
+    step = _ADPCM_STEPS[index]
+    delta = (step >> 3) + (code & 4 > 0) * step + (code & 2 > 0) * (step >> 1) + (code & 1 > 0) * (step >> 2)
+    signed_delta = np.where(code & 8, -delta, delta)
+    next_index = np.clip(index + _ADPCM_INDEX_ADJUST[code], 0, 88)
+    return signed_delta, next_index
+
+
+_ADPCM_DELTA, _ADPCM_NEXT_INDEX = _adpcm_tables()
+
+
+class ImaAdpcmCodec(AudioCodec):
+    """IMA-ADPCM, four bits per sample plus block headers, about 3.5x fewer bytes than PCM16.
+
+    A frame is the sample count (uint32) followed by independent blocks of `block_samples` samples,
+    each with a 4 byte header (first sample as int16, step index, reserved) and the remaining samples
+    as packed nibbles, low nibble first. Blocks don't depend on each other, so the inherently serial
+    ADPCM loop runs once per sample position across all blocks of a frame with NumPy. That still
+    costs about 2 ms per 100 ms of audio to encode, against a few microseconds for μ-law; larger
+    blocks compress slightly better and cost proportionally more.
+    """
+
+    name = "adpcm"
+    _COUNT = struct.Struct("<I")
+
+    def __init__(self, block_samples: int = 64):
+        self.block_samples = block_samples
+        self.block_bytes = 4 + block_samples // 2
+
+    def encode(self, pcm: bytes) -> bytes:
+        samples = np.frombuffer(pcm, dtype="<i2")
+        count = len(samples)
+        if count == 0:
+            return self._COUNT.pack(0)
+        n_blocks = -(-count // self.block_samples)
+        blocks = np.pad(samples, (0, n_blocks * self.block_samples - count), mode="edge")
+        blocks = blocks.reshape(n_blocks, self.block_samples).astype(np.int32)
+
+        predictor = blocks[:, 0].copy()
+        # Start each block with a step close to its average sample to sample change
+        mean_change = np.abs(np.diff(blocks, axis=1)).mean(axis=1)
+        index = np.minimum(np.searchsorted(_ADPCM_STEPS, mean_change), 88)
+        start_index = index.copy()
+        # Sample position major, so every step of the loop reads and writes contiguous rows
+        columns = np.ascontiguousarray(blocks.T)
+        codes = np.zeros((self.block_samples, n_blocks), dtype=np.int32)
+        for i in range(1, self.block_samples):
+            diff = columns[i] - predictor
+            code = np.minimum((np.abs(diff) << 2) // _ADPCM_STEPS[index], 7)
+            code |= (diff < 0) << 3
+            state = (index << 4) | code
+            predictor += _ADPCM_DELTA[state]
+            # np.clip is several times slower than this on arrays this small
+            np.maximum(np.minimum(predictor, 32767, out=predictor), -32768, out=predictor)
+            index = _ADPCM_NEXT_INDEX[state]
+            codes[i - 1] = code
+        codes = codes.T
+
+        header = np.zeros((n_blocks, 4), dtype=np.uint8)
+        header[:, :2] = blocks[:, 0].astype("<i2").view(np.uint8).reshape(n_blocks, 2)
+        header[:, 2] = start_index
+        packed = (codes[:, 0::2] | (codes[:, 1::2] << 4)).astype(np.uint8)
+        return self._COUNT.pack(count) + np.concatenate([header, packed], axis=1).tobytes()
+
+    def decode(self, data: bytes) -> bytes:
+        # Frames come from the client, a count that doesn't match the blocks that follow is rejected
+        # instead of decoding garbage or reading past the end
+        if len(data) < self._COUNT.size:
+            raise InvalidAudioFrame(f"ADPCM frame of {len(data)} bytes is shorter than its header")
+        (count,) = self._COUNT.unpack_from(data)
+        n_blocks = -(-count // self.block_samples)
+        if len(data) != self._COUNT.size + n_blocks * self.block_bytes:
+            raise InvalidAudioFrame(f"ADPCM frame of {len(data)} bytes doesn't hold the {count} samples it announces")
+        if n_blocks == 0:
+            return b""
+        frame = np.frombuffer(data, dtype=np.uint8, offset=self._COUNT.size).reshape(n_blocks, self.block_bytes)
+        predictor = frame[:, :2].copy().view("<i2").reshape(n_blocks).astype(np.int32)
+        index = np.minimum(frame[:, 2].astype(np.int32), 88)
+        packed = frame[:, 4:].astype(np.int32)
+        codes = np.empty((self.block_samples, n_blocks), dtype=np.int32)
+        codes[0::2] = (packed & 0x0F).T
+        codes[1::2] = (packed >> 4).T
+
+        out = np.empty((self.block_samples, n_blocks), dtype=np.int32)
+        out[0] = predictor
+        for i in range(1, self.block_samples):
+            state = (index << 4) | codes[i - 1]
+            predictor += _ADPCM_DELTA[state]
+            np.maximum(np.minimum(predictor, 32767, out=predictor), -32768, out=predictor)
+            index = _ADPCM_NEXT_INDEX[state]
+            out[i] = predictor
+        return out.T.reshape(-1)[:count].astype("<i2").tobytes()
+
+
+CODECS: dict[str, AudioCodec] = {codec.name: codec for codec in (MuLawCodec(), ImaAdpcmCodec())}
+
+
+def negotiate(requested: Optional[str]) -> Optional[AudioCodec]:
+    # The client lists the codecs it can handle in order of preference, None keeps plain PCM16
+    for name in (requested or "").split(","):
+        codec = CODECS.get(name.strip())
+        if codec is not None:
+            return codec
+    return None
@@ -0,0 +1,160 @@
+import asyncio
+import base64
+import json
+import os
+import time
+from types import SimpleNamespace
+
+from azure.core.credentials import AzureKeyCredential
+
+import codec
+from rtmt import RTMiddleTier, RTSession
+
+# 4800 bytes of PCM16 matches the chunk size s2s.js sends, output deltas are of similar size
+_AUDIO = base64.b64encode(os.urandom(4800)).decode("ascii")
+
+_SESSION = {
+    "id": "sess_123",
+    "object": "realtime.session",
+    "model": "gpt-4o-realtime-preview",
+    "modalities": ["audio", "text"],
+    "instructions": "Your knowledge cutoff is 2023-10. You are a helpful, witty, and friendly AI. " * 8,
+    "voice": "alloy",
+    "input_audio_format": "pcm16",
+    "output_audio_format": "pcm16",
+    "input_audio_transcription": None,
+    "turn_detection": {"type": "server_vad", "threshold": 0.5, "prefix_padding_ms": 300, "silence_duration_ms": 200},
+    "tools": [],
+    "tool_choice": "auto",
+    "temperature": 0.8,
+    "max_response_output_tokens": "inf",
+}
+_MESSAGE_ITEM = {
+    "id": "item_123",
+    "object": "realtime.item",
+    "type": "message",
+    "status": "completed",
+    "role": "assistant",
+    "content": [{"type": "audio", "transcript": "The answer is in the second section of the handbook."}],
+}
+_FUNCTION_CALL_ITEM = {
+    "id": "item_456",
+    "object": "realtime.item",
+    "type": "function_call",
+    "status": "completed",
+    "name": "search",
+    "call_id": "call_123",
+    "arguments": '{"query": "vacation policy"}',
+}
+_USAGE = {"total_tokens": 1234, "input_tokens": 1000, "output_tokens": 234}
+
+# name: (direction, frame, whether the code before the codec re-encoded it)
+FRAMES = {
+    "response.audio.delta (to client)": (
+        "client",
+        json.dumps(
+            {
+                "type": "response.audio.delta",
+                "event_id": "event_123",
+                "response_id": "resp_123",
+                "item_id": "item_123",
+                "output_index": 0,
+                "content_index": 0,
+                "delta": _AUDIO,
+            }
+        ),
+        False,
+    ),
+    "session.created (to client)": (
+        "client",
+        json.dumps({"type": "session.created", "event_id": "event_123", "session": _SESSION}),
+        True,
+    ),
+    "response.output_item.added (to client)": (
+        "client",
+        json.dumps({"type": "response.output_item.added", "event_id": "event_123", "response_id": "resp_123", "output_index": 0, "item": _MESSAGE_ITEM}),
+        False,
+    ),
+    "conversation.item.created (to client)": (
+        "client",
+        json.dumps({"type": "conversation.item.created", "event_id": "event_123", "previous_item_id": "item_122", "item": _FUNCTION_CALL_ITEM}),
+        False,
+    ),
+    "response.output_item.done (to client)": (
+        "client",
+        json.dumps({"type": "response.output_item.done", "event_id": "event_123", "response_id": "resp_123", "output_index": 0, "item": _MESSAGE_ITEM}),
+        False,
+    ),
+    "response.done, message (to client)": (
+        "client",
+        json.dumps(
+            {
+                "type": "response.done",
+                "event_id": "event_123",
+                "response": {"id": "resp_123", "status": "completed", "output": [_MESSAGE_ITEM], "usage": _USAGE},
+            }
+        ),
+        False,
+    ),
+    "response.done, function call (to client)": (
+        "client",
+        json.dumps(
+            {
+                "type": "response.done",
+                "event_id": "event_123",
+                "response": {"id": "resp_123", "status": "completed", "output": [_FUNCTION_CALL_ITEM], "usage": _USAGE},
+            }
+        ),
+        True,
+    ),
+    "input_audio_buffer.append (to server)": (
+        "server",
+        json.dumps({"type": "input_audio_buffer.append", "audio": _AUDIO}),
+        False,
+    ),
+    "session.update (to server)": (
+        "server",
+        json.dumps({"type": "session.update", "session": {"instructions": "", "voice": "alloy", "tools": []}}),
+        True,
+    ),
+}
+
+def _legacy_route(data: str, rewrite: bool) -> str:
+    # What the handlers did before the fast path and the codec: a full stdlib decode of every frame
+    # to find its type, and a full encode of every rewritten one
+    message = json.loads(data)
+    message["type"]
+    return json.dumps(message) if rewrite else data
+
+async def _run(rtmt: RTMiddleTier, direction: str, data: str, iterations: int) -> float:
+    msg = SimpleNamespace(data=data)
+    rt_session = RTSession()
+    start = time.perf_counter()
+    if direction == "client":
+        for _ in range(iterations):
+            await rtmt._process_message_to_client(msg, None, None, rt_session)
+    else:
+        for _ in range(iterations):
+            await rtmt._process_message_to_server(msg, None)
+    return (time.perf_counter() - start) / iterations
+
+
+def main(iterations: int = 20000):
+    rtmt = RTMiddleTier(
+        endpoint="https://localhost", deployment="bench", credentials=AzureKeyCredential("bench")
+    )
+    print(f"JSON backend: {codec.JSON_BACKEND}")
+    for name, (direction, data, rewrite) in FRAMES.items():
+        start = time.perf_counter()
+        for _ in range(iterations):
+            _legacy_route(data, rewrite)
+        before = (time.perf_counter() - start) / iterations
+        after = asyncio.run(_run(rtmt, direction, data, iterations))
+        print(
+            f"{name}: {len(data)} bytes, before {before * 1e6:.2f} us/frame, "
+            f"now {after * 1e6:.2f} us/frame ({before / after:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
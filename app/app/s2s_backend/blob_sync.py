@@ -0,0 +1,277 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+logger = logging.getLogger("voicerag")
+
+# Blob metadata key holding the SHA-256 of the uploaded content
+HASH_METADATA_KEY = "content_sha256"
+# Files up to this size are sent in a single put, larger ones as blocks of this size
+BLOCK_SIZE = 4 * 1024 * 1024
+MANIFEST_FILE = ".blob_manifest.json"
+
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(1024 * 1024):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_block(path: str, offset: int, size: int) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+class SyncStats:
+    def __init__(self):
+        self.uploaded = 0
+        self.skipped = 0
+        self.failed = 0
+        self.uploaded_bytes = 0
+        self.hashed_bytes = 0
+        self.seconds = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "uploaded": self.uploaded,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "uploaded_bytes": self.uploaded_bytes,
+            "hashed_bytes": self.hashed_bytes,
+            "seconds": round(self.seconds, 3),
+            "mb_per_second": round(self.uploaded_bytes / 1_000_000 / self.seconds, 2) if self.seconds else 0.0,
+        }
+
+
+class Manifest:
+    """Size, modification time and content hash of every file uploaded from a directory, so a re-run
+    only hashes files that changed since. Entries are keyed by container so one manifest can serve
+    several targets."""
+
+    def __init__(self, path: str, container: str):
+        self.path = path
+        self.container = container
+        self._entries: dict[str, dict] = {}
+        try:
+            with open(path) as f:
+                self._entries = json.load(f).get(container, {})
+        except (OSError, ValueError):
+            pass
+
+    def cached_hash(self, name: str, stat: os.stat_result) -> Optional[str]:
+        entry = self._entries.get(name)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return entry["sha256"]
+        return None
+
+    def update(self, name: str, stat: os.stat_result, sha256: str) -> None:
+        self._entries[name] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256}
+
+    def retain(self, names: set[str]) -> None:
+        self._entries = {name: entry for name, entry in self._entries.items() if name in names}
+
+    def save(self) -> None:
+        try:
+            with open(self.path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        manifest[self.container] = self._entries
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+class BlobSync:
+    """Uploads the files of a directory to a blob container, skipping those whose content hash
+    matches the hash stored in the blob's metadata.
+
+    `container_client` is an `azure.storage.blob.aio.ContainerClient` or anything with the same
+    `exists`, `create_container`, `list_blobs` and `get_blob_client` methods, such as
+    `LocalContainerClient`. At most `concurrency` requests (single puts or staged blocks) are in
+    flight at once, which also bounds the memory held in file contents to `concurrency * block_size`.
+    """
+
+    def __init__(self, container_client, manifest: Manifest, concurrency: int = 8, block_size: int = BLOCK_SIZE):
+        self.container_client = container_client
+        self.manifest = manifest
+        self.block_size = block_size
+        self.stats = SyncStats()
+        self._requests = asyncio.Semaphore(concurrency)
+        # Hashing is disk and CPU bound, a couple of threads keep up with the uploads
+        self._hashing = asyncio.Semaphore(max(concurrency // 4, 1))
+
+    async def _remote_hashes(self) -> dict[str, Optional[str]]:
+        hashes = {}
+        async for blob in self.container_client.list_blobs(include=["metadata"]):
+            hashes[blob.name] = (blob.metadata or {}).get(HASH_METADATA_KEY)
+        return hashes
+
+    async def _local_hash(self, name: str, path: str, stat: os.stat_result) -> str:
+        if (sha256 := self.manifest.cached_hash(name, stat)) is not None:
+            return sha256
+        async with self._hashing:
+            sha256 = await asyncio.to_thread(_hash_file, path)
+        self.stats.hashed_bytes += stat.st_size
+        return sha256
+
+    async def _upload_single(self, blob_client, path: str, metadata: dict) -> None:
+        async with self._requests:
+            data = await asyncio.to_thread(_read_block, path, 0, -1)
+            await blob_client.upload_blob(data, overwrite=True, metadata=metadata)
+
+    async def _upload_blocks(self, blob_client, path: str, size: int, metadata: dict) -> None:
+        # Block ids within a blob have to be the same length
+        block_ids = [f"{i:08d}" for i in range(-(-size // self.block_size))]
+
+        async def stage(i: int, block_id: str):
+            async with self._requests:
+                data = await asyncio.to_thread(_read_block, path, i * self.block_size, self.block_size)
+                await blob_client.stage_block(block_id, data)
+
+        await asyncio.gather(*(stage(i, block_id) for i, block_id in enumerate(block_ids)))
+        async with self._requests:
+            await blob_client.commit_block_list(block_ids, metadata=metadata)
+
+    async def _sync_file(self, name: str, path: str, remote_hash: Optional[str]) -> None:
+        stat = os.stat(path)
+        sha256 = await self._local_hash(name, path, stat)
+        if sha256 == remote_hash:
+            logger.debug("Blob is up to date, skipping file: %s", name)
+            self.stats.skipped += 1
+            self.manifest.update(name, stat, sha256)
+            return
+
+        logger.info("Uploading blob for file: %s", name)
+        blob_client = self.container_client.get_blob_client(name)
+        metadata = {HASH_METADATA_KEY: sha256}
+        try:
+            if stat.st_size <= self.block_size:
+                await self._upload_single(blob_client, path, metadata)
+            else:
+                await self._upload_blocks(blob_client, path, stat.st_size, metadata)
+        except Exception:
+            logger.exception("Failed to upload file: %s", name)
+            self.stats.failed += 1
+            return
+        self.stats.uploaded += 1
+        self.stats.uploaded_bytes += stat.st_size
+        self.manifest.update(name, stat, sha256)
+
+    async def sync(self, directory: str) -> SyncStats:
+        start = time.perf_counter()
+        if not await self.container_client.exists():
+            await self.container_client.create_container()
+        remote_hashes = await self._remote_hashes()
+        files = {entry.name: entry.path for entry in os.scandir(directory) if entry.is_file()}
+        try:
+            await asyncio.gather(*(self._sync_file(name, path, remote_hashes.get(name)) for name, path in files.items()))
+        finally:
+            # Saved even when interrupted, so what did upload isn't hashed again next time
+            self.manifest.retain(set(files))
+            self.manifest.save()
+            self.stats.seconds = time.perf_counter() - start
+        return self.stats
+
+
+class _LocalBlobProperties:
+    def __init__(self, name: str, size: int, metadata: dict):
+        self.name = name
+        self.size = size
+        self.metadata = metadata
+
+
+class LocalBlobClient:
+    def __init__(self, container: "LocalContainerClient", name: str):
+        self.container = container
+        self.name = name
+        self._staged: dict[str, bytes] = container._staged.setdefault(name, {})
+
+    def _write(self, data: bytes, metadata: Optional[dict]) -> None:
+        path = os.path.join(self.container.directory, self.name)
+        with open(path, "wb") as f:
+            f.write(data)
+        with open(path + LocalContainerClient.METADATA_SUFFIX, "w") as f:
+            json.dump(metadata or {}, f)
+
+    async def upload_blob(self, data: bytes, overwrite: bool = False, metadata: Optional[dict] = None) -> None:
+        if not overwrite and os.path.exists(os.path.join(self.container.directory, self.name)):
+            raise FileExistsError(self.name)
+        await self.container._request()
+        self._write(data, metadata)
+
+    async def stage_block(self, block_id: str, data: bytes) -> None:
+        await self.container._request()
+        self._staged[block_id] = data
+
+    async def commit_block_list(self, block_list: list[str], metadata: Optional[dict] = None) -> None:
+        await self.container._request()
+        self._write(b"".join(self._staged.pop(block_id) for block_id in block_list), metadata)
+        self._staged.clear()
+
+
+class LocalContainerClient:
+    """A blob container backed by a local directory, with metadata in a sidecar file per blob and an
+    optional per-request latency, for running BlobSync without a storage account."""
+
+    METADATA_SUFFIX = ".metadata.json"
+
+    def __init__(self, directory: str, latency: float = 0.0):
+        self.directory = directory
+        self.latency = latency
+        self.requests = 0
+        self._staged: dict[str, dict[str, bytes]] = {}
+
+    async def _request(self) -> None:
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def exists(self) -> bool:
+        return os.path.isdir(self.directory)
+
+    async def create_container(self) -> None:
+        os.makedirs(self.directory)
+
+    async def list_blobs(self, include: Optional[list[str]] = None):
+        await self._request()
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.METADATA_SUFFIX):
+                continue
+            metadata = {}
+            if include and "metadata" in include:
+                try:
+                    with open(entry.path + self.METADATA_SUFFIX) as f:
+                        metadata = json.load(f)
+                except OSError:
+                    pass
+            yield _LocalBlobProperties(entry.name, entry.stat().st_size, metadata)
+
+    def get_blob_client(self, name: str) -> LocalBlobClient:
+        return LocalBlobClient(self, name)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Sync a directory into a local stand-in blob container")
+    parser.add_argument("source")
+    parser.add_argument("container")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--block-size", type=int, default=BLOCK_SIZE)
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated seconds per storage request")
+    parser.add_argument("--manifest", default=MANIFEST_FILE)
+    args = parser.parse_args()
+
+    container_client = LocalContainerClient(args.container, latency=args.latency)
+    sync = BlobSync(container_client, Manifest(args.manifest, os.path.abspath(args.container)), args.concurrency, args.block_size)
+    stats = asyncio.run(sync.sync(args.source))
+    logger.info("Synced %s: %s, %d storage requests", args.source, stats.as_dict(), container_client.requests)
@@ -0,0 +1,104 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+        }
+
+
+class AsyncLRUCache:
+    """Bounded LRU cache with per-entry TTL and single-flight loading.
+
+    Concurrent get_or_load calls for a key that isn't cached yet share one in-flight load instead of
+    each issuing their own request.
+    """
+
+    def __init__(self, max_size: int = 256, ttl: Optional[float] = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._in_flight: dict[Hashable, asyncio.Future] = {}
+        # Bumped by clear(), loads started under an older generation don't store their result
+        self._generation = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else float("inf")
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+
+    async def get_or_load(self, key: Hashable, load: Callable[[], Awaitable[Any]]) -> Any:
+        missing = object()
+        value = self.get(key, missing)
+        if value is not missing:
+            self.stats.hits += 1
+            return value
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self.stats.coalesced += 1
+        else:
+            self.stats.misses += 1
+            # The load belongs to the cache, not to the caller that started it: callers only wait
+            # for it, so one of them being cancelled doesn't cancel it for the others
+            in_flight = asyncio.ensure_future(self._load(key, load, self._generation))
+            self._in_flight[key] = in_flight
+            # Every caller may have gone by the time it fails, don't warn about an unretrieved error
+            in_flight.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return await asyncio.shield(in_flight)
+
+    async def _load(self, key: Hashable, load: Callable[[], Awaitable[Any]], generation: int) -> Any:
+        try:
+            value = await load()
+            # Loaded from before a clear(), its callers get it but it isn't cached
+            if generation == self._generation:
+                self.put(key, value)
+            return value
+        finally:
+            if self._in_flight.get(key) is asyncio.current_task():
+                del self._in_flight[key]
+
+    def invalidate(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def invalidate_where(self, predicate: Callable[[Hashable], bool]) -> None:
+        for key in [k for k in self._entries if predicate(k)]:
+            del self._entries[key]
+
+    def clear(self) -> None:
+        # Call after re-indexing so stale results aren't served until their TTL runs out, loads in
+        # flight aren't cached and later calls start new ones
+        self._entries.clear()
+        self._in_flight.clear()
+        self._generation += 1
@@ -0,0 +1,128 @@
+import json
+from typing import Any, Optional
+
+# orjson or msgspec when installed, both decode and encode several times faster than the standard
+# library and allocate less doing it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+if orjson is not None:
+    JSON_BACKEND = "orjson"
+
+    def loads(data: str | bytes) -> Any:
+        return orjson.loads(data)
+
+    def dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+
+elif msgspec is not None:
+    JSON_BACKEND = "msgspec"
+    _decoder = msgspec.json.Decoder()
+    _encoder = msgspec.json.Encoder()
+
+    def loads(data: str | bytes) -> Any:
+        return _decoder.decode(data)
+
+    def dumps(obj: Any) -> str:
+        return _encoder.encode(obj).decode("utf-8")
+
+else:
+    JSON_BACKEND = "json"
+    loads = json.loads
+
+    def dumps(obj: Any) -> str:
+        return json.dumps(obj, separators=(",", ":"))
+
+
+# Any event carrying a function call item has to contain this literal, events without it are never
+# decoded
+_FUNCTION_CALL = '"function_call'
+
+
+class Item:
+    """The fields of a conversation item the middle tier looks at."""
+
+    __slots__ = ("type", "call_id", "name", "arguments")
+
+    def __init__(self, raw: dict):
+        self.type: Optional[str] = raw.get("type")
+        self.call_id: Optional[str] = raw.get("call_id")
+        self.name: Optional[str] = raw.get("name")
+        self.arguments: Optional[str] = raw.get("arguments")
+
+
+class ItemEvent:
+    """response.output_item.added, conversation.item.created and response.output_item.done."""
+
+    __slots__ = ("type", "previous_item_id", "item")
+
+    def __init__(self, type: str, previous_item_id: Optional[str], item: Item):
+        self.type = type
+        self.previous_item_id = previous_item_id
+        self.item = item
+
+
+class TranscriptEvent:
+    """response.audio_transcript.done and conversation.item.input_audio_transcription.completed."""
+
+    __slots__ = ("type", "item_id", "transcript")
+
+    def __init__(self, type: str, item_id: Optional[str], transcript: str):
+        self.type = type
+        self.item_id = item_id
+        self.transcript = transcript
+
+
+def decode_item_event(data: str) -> Optional[ItemEvent]:
+    # None for events that can't hold a function call or function call output, the only items acted on
+    if _FUNCTION_CALL not in data:
+        return None
+    message = loads(data)
+    item = message.get("item")
+    if item is None:
+        return None
+    return ItemEvent(message["type"], message.get("previous_item_id"), Item(item))
+
+
+def decode_transcript(data: str) -> TranscriptEvent:
+    message = loads(data)
+    return TranscriptEvent(message["type"], message.get("item_id"), message["transcript"])
+
+
+def rewrite_session_created(data: str, overrides: dict) -> str:
+    message = loads(data)
+    message["session"].update(overrides)
+    return dumps(message)
+
+
+def rewrite_session_update(data: str, session: dict) -> str:
+    # The client's session is replaced as a whole, only its event_id is worth keeping
+    message = loads(data)
+    rewritten = {"type": "session.update", "session": session}
+    if "event_id" in message:
+        rewritten["event_id"] = message["event_id"]
+    return dumps(rewritten)
+
+
+def strip_function_calls(data: str) -> Optional[str]:
+    # Removes function calls from a response.done, None when there are none and the frame can be
+    # forwarded as is
+    if _FUNCTION_CALL not in data:
+        return None
+    message = loads(data)
+    response = message.get("response")
+    if response is None:
+        return None
+    output = response.get("output", [])
+    kept = [o for o in output if o.get("type") != "function_call"]
+    if len(kept) == len(output):
+        return None
+    response["output"] = kept
+    return dumps(message)
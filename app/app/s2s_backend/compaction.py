@@ -0,0 +1,180 @@
+import math
+import re
+from typing import Optional
+
+from retrievers import Chunk
+
+# Exact counts for the realtime models when tiktoken is installed, otherwise about four characters
+# per token, which is close enough for English text to keep a budget
+try:
+    import tiktoken
+
+    _encoding = tiktoken.get_encoding("o200k_base")
+
+    def count_tokens(text: str) -> int:
+        return len(_encoding.encode(text, disallowed_special=()))
+
+except ImportError:
+
+    def count_tokens(text: str) -> int:
+        return (len(text) + 3) // 4
+
+
+# Shorter shared runs are more likely to be a common phrase than an actual page overlap
+MIN_OVERLAP = 40
+_PROBE_LENGTH = 32
+_SENTENCE_PATTERN = re.compile(r"[^.!?\n]+(?:[.!?]+[\"')\]]*|\n+|$)")
+_TERM_PATTERN = re.compile(r"\w+")
+_GAP = " … "
+
+
+class Passage:
+    """One or more chunks of the same document merged where their text overlaps, cited by the
+    identifier of the best ranked of them."""
+
+    __slots__ = ("identifiers", "title", "content", "parent", "rank")
+
+    def __init__(self, identifier: str, title: str, content: str, parent: Optional[str], rank: int):
+        self.identifiers = [identifier]
+        self.title = title
+        self.content = content
+        self.parent = parent
+        self.rank = rank
+
+    @property
+    def identifier(self) -> str:
+        return self.identifiers[0]
+
+
+def _overlap(first: str, second: str) -> int:
+    # Length of the longest end of `first` that `second` starts with, 0 when under MIN_OVERLAP
+    probe = second[:_PROBE_LENGTH]
+    position = first.find(probe, max(len(first) - len(second), 0))
+    while position != -1:
+        length = len(first) - position
+        if length >= MIN_OVERLAP and second.startswith(first[position:]):
+            return length
+        position = first.find(probe, position + 1)
+    return 0
+
+
+def _merged(first: Passage, second: Passage) -> Optional[str]:
+    if second.content in first.content:
+        return first.content
+    if first.content in second.content:
+        return second.content
+    if overlap := _overlap(first.content, second.content):
+        return first.content + second.content[overlap:]
+    if overlap := _overlap(second.content, first.content):
+        return second.content + first.content[overlap:]
+    return None
+
+
+def merge_overlapping(chunks: list[Chunk]) -> list[Passage]:
+    """Merges chunks of the same parent document whose text overlaps, as adjacent pages split with an
+    overlap do, keeping the order of the best ranked chunk of each passage."""
+    passages: list[Passage] = []
+    for rank, (identifier, title, content, parent) in enumerate(chunks):
+        passage = Passage(identifier, title, content, parent, rank)
+        merged = True
+        # A chunk can bridge two passages of the same document, so keep merging until nothing changes
+        while merged and passage.parent is not None:
+            merged = False
+            for other in passages:
+                if other.parent != passage.parent or (content := _merged(other, passage)) is None:
+                    continue
+                passages.remove(other)
+                other.identifiers.extend(passage.identifiers)
+                other.content = content
+                other.rank = min(other.rank, passage.rank)
+                passage = other
+                merged = True
+                break
+        passages.append(passage)
+    passages.sort(key=lambda p: p.rank)
+    return passages
+
+
+def render(passages: list[Passage]) -> str:
+    # The format described in the search tool's schema
+    return "".join(f"[{p.identifier}]: {p.content}\n-----\n" for p in passages)
+
+
+def _sentences(text: str) -> list[str]:
+    return [s for s in (m.group().strip() for m in _SENTENCE_PATTERN.finditer(text)) if s]
+
+
+def extract_relevant(passages: list[Passage], query: str, token_budget: int) -> list[Passage]:
+    """Keeps the sentences that share the most (and the rarest) terms with the query, as many as fit in
+    `token_budget` once rendered. Kept sentences stay in document order with gaps marked, passages
+    left without any are dropped. Without matching terms the leading sentences of the best ranked
+    passages are kept."""
+    sentences = [(p, i, s) for p in passages for i, s in enumerate(_sentences(p.content))]
+    terms = [set(_TERM_PATTERN.findall(s.lower())) for _, _, s in sentences]
+    query_terms = set(_TERM_PATTERN.findall(query.lower()))
+    # Terms found in fewer sentences say more about which sentence the query is after
+    weights = {
+        term: math.log(1 + len(sentences) / df)
+        for term in query_terms
+        if (df := sum(term in sentence_terms for sentence_terms in terms))
+    }
+    scores = [sum(weights.get(term, 0.0) for term in sentence_terms & query_terms) for sentence_terms in terms]
+    order = sorted(range(len(sentences)), key=lambda k: (-scores[k], sentences[k][0].rank, sentences[k][1]))
+
+    kept: dict[int, dict[int, str]] = {}
+    used = 0
+    for k in order:
+        passage, index, sentence = sentences[k]
+        # The passage header and separator are paid for by its first kept sentence
+        cost = count_tokens(sentence) + 1
+        if passage.rank not in kept:
+            cost += count_tokens(f"[{passage.identifier}]: \n-----\n")
+        if used + cost > token_budget:
+            continue
+        kept.setdefault(passage.rank, {})[index] = sentence
+        used += cost
+
+    compacted = []
+    for passage in passages:
+        if passage.rank not in kept:
+            continue
+        content = ""
+        previous = None
+        for index, sentence in sorted(kept[passage.rank].items()):
+            if previous is not None:
+                content += " " if index == previous + 1 else _GAP
+            elif index > 0:
+                content += _GAP.lstrip()
+            content += sentence
+            previous = index
+        extract = Passage(passage.identifier, passage.title, content, passage.parent, passage.rank)
+        extract.identifiers = passage.identifiers
+        compacted.append(extract)
+    return compacted
+
+
+class CompactionResult:
+    __slots__ = ("passages", "text", "original_tokens", "tokens")
+
+    def __init__(self, passages: list[Passage], text: str, original_tokens: int, tokens: int):
+        self.passages = passages
+        self.text = text
+        self.original_tokens = original_tokens
+        self.tokens = tokens
+
+    @property
+    def saved_tokens(self) -> int:
+        return self.original_tokens - self.tokens
+
+
+def compact(chunks: list[Chunk], query: str, token_budget: Optional[int] = None) -> CompactionResult:
+    """Shapes search results for the model: overlapping chunks are merged, which loses nothing, and
+    with a `token_budget` only the sentences most relevant to `query` that fit in it are kept."""
+    original_tokens = count_tokens("".join(f"[{c[0]}]: {c[2]}\n-----\n" for c in chunks))
+    passages = merge_overlapping(chunks)
+    text = render(passages)
+    tokens = count_tokens(text)
+    if token_budget is not None and tokens > token_budget:
+        text = render(extract_relevant(passages, query, token_budget))
+        tokens = count_tokens(text)
+    return CompactionResult(passages, text, original_tokens, tokens)
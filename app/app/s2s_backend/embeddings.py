@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import re
+from typing import Optional
+
+import aiohttp
+import numpy as np
+from azure.core.credentials import AzureKeyCredential
+
+from cache import AsyncLRUCache
+from tokens import TokenManager
+
+logger = logging.getLogger("voicerag")
+
+
+class AzureOpenAIEmbedder:
+    """Async query embedder backed by an Azure OpenAI embeddings deployment.
+
+    Calling the instance embeds a single text, embed() takes a batch.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        deployment: str,
+        credentials: AzureKeyCredential | TokenManager,
+        dimensions: Optional[int] = None,
+        api_version: str = "2024-06-01",
+    ):
+        self.endpoint = endpoint
+        self.deployment = deployment
+        self.credentials = credentials
+        self.dimensions = dimensions
+        self.api_version = api_version
+        # Everything that changes the vectors, embeddings under another key aren't interchangeable
+        self.cache_key = ("azure-openai", endpoint, deployment, dimensions)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def _headers(self) -> dict[str, str]:
+        if isinstance(self.credentials, AzureKeyCredential):
+            return {"api-key": self.credentials.key}
+        return {"Authorization": f"Bearer {await self.credentials.bearer_token()}"}
+
+    async def embed(self, texts: list[str]) -> list[list[float]]:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(base_url=self.endpoint)
+        body = {"input": texts}
+        if self.dimensions is not None:
+            body["dimensions"] = self.dimensions
+        async with self._session.post(
+            f"/openai/deployments/{self.deployment}/embeddings",
+            params={"api-version": self.api_version},
+            headers=await self._headers(),
+            json=body,
+        ) as response:
+            response.raise_for_status()
+            result = await response.json()
+        return [d["embedding"] for d in sorted(result["data"], key=lambda d: d["index"])]
+
+    async def __call__(self, text: str) -> list[float]:
+        return (await self.embed([text]))[0]
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class BatchingEmbedder:
+    """Coalesces single-text embedding calls made at about the same time, from any session, into one
+    batched request to the wrapped embedder.
+
+    The first call of a batch waits up to `max_wait` seconds for others to join, a full batch goes
+    out immediately.
+    """
+
+    def __init__(self, embedder, max_batch: int = 16, max_wait: float = 0.005):
+        self.embedder = embedder
+        self.cache_key = getattr(embedder, "cache_key", ())
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.batches = 0
+        self.texts = 0
+        self._pending: list[tuple[str, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        # The event loop only keeps weak references to tasks
+        self._tasks: set[asyncio.Task] = set()
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._embed_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    def _fail(batch: list[tuple[str, asyncio.Future]], error: Exception) -> None:
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    async def _embed_batch(self, batch: list[tuple[str, asyncio.Future]]) -> None:
+        self.batches += 1
+        self.texts += len(batch)
+        try:
+            vectors = await self.embedder.embed([text for text, _ in batch])
+        except Exception as e:
+            self._fail(batch, e)
+            return
+        except BaseException:
+            # Cancelled, e.g. on close, the callers get an error they handle instead of waiting forever
+            self._fail(batch, RuntimeError("Embedding batch cancelled"))
+            raise
+        if len(vectors) != len(batch):
+            self._fail(batch, ValueError(f"Embedder returned {len(vectors)} vectors for {len(batch)} texts"))
+            return
+        for (_, future), vector in zip(batch, vectors):
+            if not future.done():
+                future.set_result(vector)
+
+    async def embed(self, texts: list[str]) -> list[list[float]]:
+        return await self.embedder.embed(texts)
+
+    async def __call__(self, text: str) -> list[float]:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.max_wait, self._flush)
+        return await future
+
+    async def close(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        self._fail(batch, RuntimeError("Embedder closed"))
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.embedder.close()
+
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+
+
+def normalize_query(text: str) -> str:
+    # Case, spacing and punctuation don't change what is asked, so they share a cache entry
+    return " ".join(_PUNCTUATION.sub(" ", text.lower()).split())
+
+
+class CachedEmbedder:
+    """Query embeddings in a bounded LRU keyed by normalized query text, so repeated questions skip the
+    embedding call entirely. Concurrent misses for the same query share one call.
+
+    Vectors are kept as float16 (half the memory, differences around 1e-3) or int8 with a per vector
+    scale (a quarter of it, around 1e-2), either is far below what changes a nearest neighbor ranking.
+    """
+
+    def __init__(self, embedder, max_size: int = 4096, dtype: str = "float16"):
+        if dtype not in ("float32", "float16", "int8"):
+            raise ValueError(f"Unsupported embedding cache dtype: {dtype}")
+        self.embedder = embedder
+        self.cache_key = getattr(embedder, "cache_key", ())
+        self.dtype = dtype
+        self.cache = AsyncLRUCache(max_size=max_size, ttl=None)
+
+    def _pack(self, vector: list[float]) -> tuple[np.ndarray, float]:
+        vector = np.asarray(vector, dtype=np.float32)
+        if self.dtype != "int8":
+            return vector.astype(self.dtype), 1.0
+        scale = max(float(np.abs(vector).max()), 1e-12) / 127
+        return np.round(vector / scale).astype(np.int8), scale
+
+    async def __call__(self, text: str) -> list[float]:
+        async def load():
+            return self._pack(await self.embedder(text))
+
+        packed, scale = await self.cache.get_or_load(normalize_query(text), load)
+        return (packed.astype(np.float32) * scale).tolist()
+
+    async def embed(self, texts: list[str]) -> list[list[float]]:
+        return await asyncio.gather(*(self(text) for text in texts))
+
+    def stats(self) -> dict:
+        stats = self.cache.stats.as_dict()
+        stats["size"] = len(self.cache)
+        if isinstance(self.embedder, BatchingEmbedder):
+            stats["batches"] = self.embedder.batches
+            stats["batched_texts"] = self.embedder.texts
+        return stats
+
+    async def close(self) -> None:
+        await self.embedder.close()
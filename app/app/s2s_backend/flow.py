@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Callable, Optional, Union
+
+import aiohttp
+from aiohttp import web
+
+from metrics import BYTE_BUCKETS, metrics
+
+logger = logging.getLogger("voicerag")
+
+AUDIO_EVENTS = frozenset(["response.audio.delta", "input_audio_buffer.append"])
+# Audio still queued when one of these goes out is stale: the user interrupted the answer, or the
+# client discarded its input buffer
+STALE_AUDIO_EVENTS = frozenset(["input_audio_buffer.speech_started", "input_audio_buffer.clear"])
+# Events that end an audio stream, sent after the audio queued before them instead of overtaking it
+STREAM_END_EVENTS = frozenset(
+    [
+        "input_audio_buffer.commit",
+        "response.audio.done",
+        "response.content_part.done",
+        "response.output_item.done",
+        "response.done",
+    ]
+)
+
+
+class FlowPolicy:
+    def __init__(
+        self,
+        max_bytes: int = 2 * 1024 * 1024,
+        over_budget_timeout: float = 5.0,
+        drop_stale_audio: bool = True,
+    ):
+        # Audio beyond max_bytes is dropped oldest first, a queue that stays over budget with only
+        # control events for over_budget_timeout seconds gets its session closed
+        self.max_bytes = max_bytes
+        self.over_budget_timeout = over_budget_timeout
+        self.drop_stale_audio = drop_stale_audio
+
+
+class OutboundQueue:
+    """Bounded send queue for one direction of a session.
+
+    Producers never wait on the socket: put() enqueues and a sender task drains the queue, control
+    events first, so a slow peer costs bounded memory instead of stalling the forwarding loop. Events
+    ending an audio stream still wait for the audio queued before them. A failed send closes the
+    queue and calls `on_send_error`.
+    """
+
+    def __init__(
+        self,
+        ws: web.WebSocketResponse,
+        direction: str,
+        policy: FlowPolicy,
+        on_over_budget: Optional[Callable[[], None]] = None,
+        on_send_error: Optional[Callable[[], None]] = None,
+    ):
+        self.ws = ws
+        self.direction = direction
+        self.policy = policy
+        self.on_over_budget = on_over_budget
+        self.on_send_error = on_send_error
+        self.queued_bytes = 0
+        self.peak_bytes = 0
+        self.peak_depth = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+        self.closed = False
+        # Audio frames with their sequence number, control events with the sequence number of the
+        # last audio frame they have to follow (-1 for none)
+        self._control: deque[tuple[Union[str, bytes], int]] = deque()
+        self._audio: deque[tuple[Union[str, bytes], int]] = deque()
+        self._audio_sequence = -1
+        self._ready = asyncio.Event()
+        self._over_budget_since: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+        # Sees every frame the queue accepts, e.g. to record a session
+        self.tap: Optional[Callable[[Union[str, bytes], Optional[str]], None]] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    def put(self, data: Union[str, bytes], event_type: Optional[str]) -> None:
+        if self.closed:
+            return
+        if self.tap is not None:
+            self.tap(data, event_type)
+        if self.policy.drop_stale_audio and event_type in STALE_AUDIO_EVENTS:
+            self.drop_audio()
+        if event_type in AUDIO_EVENTS:
+            self._audio_sequence += 1
+            self._audio.append((data, self._audio_sequence))
+        else:
+            self._control.append((data, self._audio_sequence if event_type in STREAM_END_EVENTS else -1))
+        self.queued_bytes += len(data)
+        self.peak_bytes = max(self.peak_bytes, self.queued_bytes)
+        self.peak_depth = max(self.peak_depth, len(self._audio) + len(self._control))
+        if self.queued_bytes > self.policy.max_bytes:
+            self._enforce_budget()
+        else:
+            self._over_budget_since = None
+        self._ready.set()
+
+    def _drop_oldest_audio(self) -> None:
+        data, _ = self._audio.popleft()
+        self.queued_bytes -= len(data)
+        self.dropped += 1
+        self.dropped_bytes += len(data)
+
+    def drop_audio(self) -> None:
+        while self._audio:
+            self._drop_oldest_audio()
+
+    def _enforce_budget(self) -> None:
+        while self.queued_bytes > self.policy.max_bytes and self._audio:
+            self._drop_oldest_audio()
+        if self.queued_bytes <= self.policy.max_bytes:
+            self._over_budget_since = None
+            return
+        now = time.monotonic()
+        if self._over_budget_since is None:
+            self._over_budget_since = now
+        elif now - self._over_budget_since > self.policy.over_budget_timeout:
+            logger.warning(
+                "Closing session, %s queue over its byte budget for %ss (%d bytes)",
+                self.direction,
+                self.policy.over_budget_timeout,
+                self.queued_bytes,
+            )
+            metrics.increment("rtmt_sessions_closed_over_budget_total", direction=self.direction)
+            self.closed = True
+            if self.on_over_budget is not None:
+                self.on_over_budget()
+
+    def _next(self) -> Union[str, bytes]:
+        if self._control:
+            data, after = self._control[0]
+            if not self._audio or self._audio[0][1] > after:
+                self._control.popleft()
+                return data
+        data, _ = self._audio.popleft()
+        return data
+
+    async def _run(self) -> None:
+        while True:
+            await self._ready.wait()
+            while self._control or self._audio:
+                data = self._next()
+                self.queued_bytes -= len(data)
+                try:
+                    if isinstance(data, bytes):
+                        await self.ws.send_bytes(data)
+                    else:
+                        await self.ws.send_str(data)
+                except (ConnectionResetError, aiohttp.ClientConnectionError, RuntimeError) as e:
+                    # The socket is closing or gone, nothing queued behind this frame can be sent
+                    logger.info("Closing session, %s send failed: %r", self.direction, e)
+                    self.closed = True
+                    self._control.clear()
+                    self._audio.clear()
+                    self.queued_bytes = 0
+                    if self.on_send_error is not None:
+                        self.on_send_error()
+                    return
+            self._ready.clear()
+
+    async def close(self) -> None:
+        self.closed = True
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        metrics.observe("rtmt_queue_peak_bytes", self.peak_bytes, buckets=BYTE_BUCKETS, direction=self.direction)
+        metrics.increment("rtmt_queue_dropped_frames_total", self.dropped, direction=self.direction)
+        metrics.increment("rtmt_queue_dropped_bytes_total", self.dropped_bytes, direction=self.direction)
+
+    def stats(self) -> dict:
+        return {
+            "queued_bytes": self.queued_bytes,
+            "peak_bytes": self.peak_bytes,
+            "peak_depth": self.peak_depth,
+            "dropped": self.dropped,
+            "dropped_bytes": self.dropped_bytes,
+        }
@@ -0,0 +1,462 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Awaitable, Callable, Optional
+
+import numpy as np
+
+logger = logging.getLogger("voicerag")
+
+# The parameters of the SplitSkill in setup_intvect.setup_index
+MAX_PAGE_LENGTH = 2000
+PAGE_OVERLAP_LENGTH = 500
+MANIFEST_FILE = ".ingest_manifest.json"
+EMBEDDING_CACHE_FILE = "embedding_cache.db"
+
+# Text extraction for PDFs is optional, other documents are read as UTF-8 text
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+# Preferred page break positions, strongest first
+_BOUNDARIES = ("\n\n", ". ", "! ", "? ", "\n", " ")
+
+
+def _page_end(text: str, start: int, end: int) -> int:
+    # Breaks a page at the strongest boundary in its second half, so pages don't end mid-sentence
+    lowest = start + (end - start) // 2
+    for boundary in _BOUNDARIES:
+        i = text.rfind(boundary, lowest, end)
+        if i != -1:
+            return i + len(boundary)
+    return end
+
+
+def split_pages(text: str, max_length: int = MAX_PAGE_LENGTH, overlap: int = PAGE_OVERLAP_LENGTH) -> list[str]:
+    """Splits text into pages of at most `max_length` characters, each starting with about the last
+    `overlap` characters of the previous one, like the service side SplitSkill in pages mode."""
+    pages = []
+    start = 0
+    while start < len(text):
+        end = min(start + max_length, len(text))
+        if end < len(text):
+            end = _page_end(text, start, end)
+        if page := text[start:end].strip():
+            pages.append(page)
+        if end >= len(text):
+            break
+        # Start the overlap at a word so the next page doesn't open with half of one
+        next_start = max(end - overlap, start + 1)
+        space = text.find(" ", next_start, end)
+        start = space + 1 if space != -1 else next_start
+    return pages
+
+
+def _extract_text(path: str) -> Optional[str]:
+    if path.lower().endswith(".pdf"):
+        if PdfReader is None:
+            return None
+        return "\n".join(page.extract_text() or "" for page in PdfReader(path).pages)
+    with open(path, encoding="utf-8", errors="replace") as f:
+        return f.read()
+
+
+def _chunk_document(path: str, max_length: int, overlap: int) -> Optional[list[tuple[str, str]]]:
+    # Runs in a worker process: the document's pages with the SHA-256 of each, None when the
+    # document can't be read
+    text = _extract_text(path)
+    if text is None:
+        return None
+    return [(page, hashlib.sha256(page.encode("utf-8")).hexdigest()) for page in split_pages(text, max_length, overlap)]
+
+
+def parent_id(name: str) -> str:
+    return hashlib.sha256(name.encode("utf-8")).hexdigest()[:32]
+
+
+class EmbeddingCache:
+    """Embeddings by chunk content hash in SQLite, so unchanged text is never embedded twice, not
+    even when it moves to another document or another position."""
+
+    def __init__(self, path: str, namespace: tuple = ()):
+        self._db = sqlite3.connect(path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+        # Embeddings of different deployments or dimensions don't mix
+        self._namespace = hashlib.sha256(json.dumps(namespace).encode("utf-8")).hexdigest()[:16]
+
+    def _key(self, content_hash: str) -> str:
+        return f"{self._namespace}:{content_hash}"
+
+    def get_many(self, content_hashes: list[str]) -> dict[str, list[float]]:
+        found = {}
+        for start in range(0, len(content_hashes), 500):
+            keys = [self._key(h) for h in content_hashes[start : start + 500]]
+            rows = self._db.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(keys))})", keys
+            )
+            for key, vector in rows:
+                found[key.split(":", 1)[1]] = np.frombuffer(vector, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, embeddings: dict[str, list[float]]) -> None:
+        self._db.executemany(
+            "INSERT OR REPLACE INTO embeddings VALUES (?, ?)",
+            [(self._key(h), np.asarray(v, dtype=np.float32).tobytes()) for h, v in embeddings.items()],
+        )
+        self._db.commit()
+
+    def close(self) -> None:
+        self._db.close()
+
+
+class IngestManifest:
+    """What the index holds for each document: its size and modification time, and the content hash
+    of each of its chunks by chunk id. Documents whose size and mtime match are not read again."""
+
+    def __init__(self, path: str, index: str):
+        self.path = path
+        self.index = index
+        self.documents: dict[str, dict] = {}
+        try:
+            with open(path) as f:
+                self.documents = json.load(f).get(index, {})
+        except (OSError, ValueError):
+            pass
+
+    def save(self) -> None:
+        try:
+            with open(self.path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        manifest[self.index] = self.documents
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.path)
+
+
+class IngestStats:
+    def __init__(self):
+        self.documents = 0
+        self.unchanged_documents = 0
+        self.unreadable_documents = 0
+        self.chunks = 0
+        self.unchanged_chunks = 0
+        self.embedded_chunks = 0
+        self.cached_embeddings = 0
+        self.embedding_batches = 0
+        self.uploaded_chunks = 0
+        self.upload_batches = 0
+        self.deleted_chunks = 0
+        self.seconds = 0.0
+
+    def as_dict(self) -> dict:
+        return {name: round(value, 3) if isinstance(value, float) else value for name, value in vars(self).items()}
+
+
+class _PendingChunk:
+    __slots__ = ("document", "chunk_id", "title", "content", "content_hash", "vector")
+
+    def __init__(self, document: str, chunk_id: str, title: str, content: str, content_hash: str):
+        self.document = document
+        self.chunk_id = chunk_id
+        self.title = title
+        self.content = content
+        self.content_hash = content_hash
+        self.vector: Optional[list[float]] = None
+
+    def as_document(self) -> dict:
+        return {
+            "chunk_id": self.chunk_id,
+            "parent_id": parent_id(self.document),
+            "title": self.title,
+            "chunk": self.content,
+            "text_vector": self.vector,
+        }
+
+
+class IngestPipeline:
+    """Chunks the documents of a directory locally and pushes new or changed chunks, with their
+    embeddings, into an index following the schema of setup_intvect.setup_index.
+
+    Documents are chunked in a process pool while earlier ones are embedded and uploaded. `embed`
+    is any async callable taking a batch of texts and returning their vectors, such as
+    AzureOpenAIEmbedder.embed. `search_client` needs the async `upload_documents` and
+    `delete_documents` of an `azure.search.documents.aio.SearchClient`. Only chunks whose content
+    hash isn't already in the index for that chunk id are embedded and uploaded, embeddings come
+    from `cache` when the same text was embedded before, and chunks of deleted or shortened
+    documents are deleted.
+    """
+
+    def __init__(
+        self,
+        embed: Callable[[list[str]], Awaitable[list[list[float]]]],
+        search_client,
+        cache: EmbeddingCache,
+        manifest: IngestManifest,
+        workers: Optional[int] = None,
+        embedding_batch_size: int = 16,
+        embedding_concurrency: int = 4,
+        # Well under the 16 MB request limit with 3072 dimension vectors
+        upload_batch_size: int = 100,
+        max_length: int = MAX_PAGE_LENGTH,
+        overlap: int = PAGE_OVERLAP_LENGTH,
+    ):
+        self.embed = embed
+        self.search_client = search_client
+        self.cache = cache
+        self.manifest = manifest
+        self.workers = workers or os.cpu_count() or 1
+        self.embedding_batch_size = embedding_batch_size
+        self.embedding_concurrency = embedding_concurrency
+        self.upload_batch_size = upload_batch_size
+        self.max_length = max_length
+        self.overlap = overlap
+        self.stats = IngestStats()
+        # Bounded so chunking can't run arbitrarily far ahead of embedding
+        self._to_embed: asyncio.Queue[Optional[_PendingChunk]] = asyncio.Queue(maxsize=embedding_batch_size * embedding_concurrency * 4)
+        self._to_upload: asyncio.Queue[Optional[_PendingChunk]] = asyncio.Queue(maxsize=upload_batch_size * 2)
+        # Chunk hashes of each document being ingested, committed to the manifest once all are uploaded
+        self._new_chunks: dict[str, dict[str, str]] = {}
+        self._outstanding: dict[str, int] = {}
+        self._failed: set[str] = set()
+        self._stat: dict[str, os.stat_result] = {}
+
+    async def _chunk_documents(self, pool: ProcessPoolExecutor, paths: dict[str, str]) -> None:
+        loop = asyncio.get_running_loop()
+        in_flight = asyncio.Semaphore(self.workers * 2)
+
+        async def chunk(name: str, path: str):
+            async with in_flight:
+                pages = await loop.run_in_executor(pool, _chunk_document, path, self.max_length, self.overlap)
+            await self._queue_changed_chunks(name, pages)
+
+        await asyncio.gather(*(chunk(name, path) for name, path in paths.items()))
+
+    async def _queue_changed_chunks(self, name: str, pages: Optional[list[tuple[str, str]]]) -> None:
+        if pages is None:
+            logger.warning("Can't extract text from %s, skipping it", name)
+            self.stats.unreadable_documents += 1
+            return
+        previous = self.manifest.documents.get(name, {}).get("chunks", {})
+        chunks = {f"{parent_id(name)}_pages_{i}": content_hash for i, (_, content_hash) in enumerate(pages)}
+        changed = [
+            _PendingChunk(name, chunk_id, name, content, content_hash)
+            for (chunk_id, content_hash), (content, _) in zip(chunks.items(), pages)
+            if previous.get(chunk_id) != content_hash
+        ]
+        self.stats.chunks += len(chunks)
+        self.stats.unchanged_chunks += len(chunks) - len(changed)
+        self._new_chunks[name] = chunks
+        self._outstanding[name] = len(changed)
+        stale = [chunk_id for chunk_id in previous if chunk_id not in chunks]
+        if stale:
+            await self._delete(stale)
+        if not changed:
+            self._commit(name)
+            return
+
+        cached = self.cache.get_many([chunk.content_hash for chunk in changed])
+        self.stats.cached_embeddings += sum(chunk.content_hash in cached for chunk in changed)
+        for chunk in changed:
+            if (vector := cached.get(chunk.content_hash)) is not None:
+                chunk.vector = vector
+                await self._to_upload.put(chunk)
+            else:
+                await self._to_embed.put(chunk)
+
+    def _commit(self, name: str) -> None:
+        stat = self._stat[name]
+        self.manifest.documents[name] = {
+            # A document with failed chunks is read again next time, only those chunks are uploaded
+            "size": None if name in self._failed else stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "chunks": self._new_chunks.pop(name),
+        }
+        del self._outstanding[name]
+
+    @staticmethod
+    async def _next_batch(queue: asyncio.Queue, size: int) -> tuple[list, bool]:
+        # Waits for one item and takes whatever else is already queued, up to `size`. The flag is
+        # False once the end marker was seen
+        batch = []
+        item = await queue.get()
+        while item is not None:
+            batch.append(item)
+            if len(batch) == size or queue.empty():
+                return batch, True
+            item = queue.get_nowait()
+        return batch, False
+
+    async def _embed_chunks(self) -> None:
+        while True:
+            batch, more = await self._next_batch(self._to_embed, self.embedding_batch_size)
+            if batch:
+                vectors = await self.embed([chunk.content for chunk in batch])
+                self.stats.embedding_batches += 1
+                self.stats.embedded_chunks += len(batch)
+                self.cache.put_many({chunk.content_hash: vector for chunk, vector in zip(batch, vectors)})
+                for chunk, vector in zip(batch, vectors):
+                    chunk.vector = vector
+                    await self._to_upload.put(chunk)
+            if not more:
+                # Lets the other embedding workers see the end marker as well
+                await self._to_embed.put(None)
+                return
+
+    async def _upload_chunks(self) -> None:
+        while True:
+            batch, more = await self._next_batch(self._to_upload, self.upload_batch_size)
+            if batch:
+                results = await self.search_client.upload_documents(documents=[chunk.as_document() for chunk in batch])
+                failed = {result.key for result in results if not result.succeeded}
+                self.stats.upload_batches += 1
+                for chunk in batch:
+                    if chunk.chunk_id in failed:
+                        # Left out of the manifest so the next run tries it again
+                        logger.warning("Failed to upload chunk %s of %s", chunk.chunk_id, chunk.document)
+                        self._new_chunks[chunk.document].pop(chunk.chunk_id, None)
+                        self._failed.add(chunk.document)
+                    else:
+                        self.stats.uploaded_chunks += 1
+                    self._outstanding[chunk.document] -= 1
+                    if self._outstanding[chunk.document] == 0:
+                        self._commit(chunk.document)
+            if not more:
+                return
+
+    async def _delete(self, chunk_ids: list[str]) -> None:
+        for start in range(0, len(chunk_ids), self.upload_batch_size):
+            batch = chunk_ids[start : start + self.upload_batch_size]
+            await self.search_client.delete_documents(documents=[{"chunk_id": chunk_id} for chunk_id in batch])
+            self.stats.deleted_chunks += len(batch)
+
+    async def run(self, directory: str) -> IngestStats:
+        start = time.perf_counter()
+        paths = {}
+        for entry in os.scandir(directory):
+            if not entry.is_file():
+                continue
+            self.stats.documents += 1
+            stat = entry.stat()
+            previous = self.manifest.documents.get(entry.name)
+            if previous is not None and previous["size"] == stat.st_size and previous["mtime_ns"] == stat.st_mtime_ns:
+                self.stats.unchanged_documents += 1
+                continue
+            self._stat[entry.name] = stat
+            paths[entry.name] = entry.path
+
+        removed = [name for name in self.manifest.documents if not os.path.isfile(os.path.join(directory, name))]
+        try:
+            for name in removed:
+                await self._delete(list(self.manifest.documents[name]["chunks"]))
+                del self.manifest.documents[name]
+
+            async def chunk():
+                with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                    await self._chunk_documents(pool, paths)
+                await self._to_embed.put(None)
+
+            async def embed():
+                await asyncio.gather(*(self._embed_chunks() for _ in range(self.embedding_concurrency)))
+                await self._to_upload.put(None)
+
+            # A failing stage fails the run instead of leaving the others waiting on full queues
+            tasks = [asyncio.create_task(stage) for stage in (chunk(), embed(), self._upload_chunks())]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+        finally:
+            # Documents are only recorded once all their chunks are in the index, so an interrupted
+            # run picks up where it stopped
+            self.manifest.save()
+            self.stats.seconds = time.perf_counter() - start
+        return self.stats
+
+
+async def ingest_directory(
+    directory: str,
+    embedder,
+    search_client,
+    index_name: str,
+    manifest_path: str = MANIFEST_FILE,
+    cache_path: str = EMBEDDING_CACHE_FILE,
+    **kwargs,
+) -> IngestStats:
+    cache = EmbeddingCache(cache_path, getattr(embedder, "cache_key", ()))
+    try:
+        pipeline = IngestPipeline(embedder.embed, search_client, cache, IngestManifest(manifest_path, index_name), **kwargs)
+        stats = await pipeline.run(directory)
+    finally:
+        cache.close()
+    logger.info(
+        "Ingested %(documents)d documents (%(unchanged_documents)d unchanged): %(chunks)d chunks, %(embedded_chunks)d embedded, "
+        + "%(cached_embeddings)d from cache, %(uploaded_chunks)d uploaded, %(deleted_chunks)d deleted in %(seconds).1fs",
+        stats.as_dict(),
+    )
+    return stats
+
+
+if __name__ == "__main__":
+    from azure.core.credentials import AzureKeyCredential
+    from azure.identity import AzureDeveloperCliCredential
+    from azure.search.documents.aio import SearchClient
+    from dotenv import load_dotenv
+
+    from embeddings import AzureOpenAIEmbedder
+    from tokens import TokenManager
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Chunk, embed and upload the documents of a directory into the Azure AI Search index")
+    parser.add_argument("directory", nargs="?", default="data")
+    parser.add_argument("--workers", type=int, default=None, help="chunking processes, defaults to the CPU count")
+    parser.add_argument("--embedding-batch-size", type=int, default=16)
+    parser.add_argument("--embedding-concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    load_dotenv()
+
+    async def main():
+        credential = AzureDeveloperCliCredential(tenant_id=os.environ.get("AZURE_TENANT_ID"), process_timeout=60)
+        openai_credential = (
+            AzureKeyCredential(key)
+            if (key := os.environ.get("AZURE_OPENAI_API_KEY"))
+            else TokenManager(credential, "https://cognitiveservices.azure.com/.default")
+        )
+        search_credential = (
+            AzureKeyCredential(key)
+            if (key := os.environ.get("AZURE_SEARCH_API_KEY"))
+            else TokenManager(credential, "https://search.azure.com/.default")
+        )
+        embedder = AzureOpenAIEmbedder(
+            endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
+            deployment=os.environ["AZURE_OPENAI_EMBEDDING_DEPLOYMENT"],
+            credentials=openai_credential,
+            dimensions=int(os.environ.get("AZURE_OPENAI_EMBEDDING_DIMENSIONS") or 0) or None,
+        )
+        index_name = os.environ["AZURE_SEARCH_INDEX"]
+        async with SearchClient(os.environ["AZURE_SEARCH_ENDPOINT"], index_name, search_credential) as search_client:
+            try:
+                await ingest_directory(
+                    args.directory,
+                    embedder,
+                    search_client,
+                    index_name,
+                    workers=args.workers,
+                    embedding_batch_size=args.embedding_batch_size,
+                    embedding_concurrency=args.embedding_concurrency,
+                )
+            finally:
+                await embedder.close()
+
+    asyncio.run(main())
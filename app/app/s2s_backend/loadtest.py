@@ -0,0 +1,199 @@
+import argparse
+import asyncio
+import base64
+import json
+import os
+import time
+from typing import Optional
+
+import aiohttp
+
+from mock_realtime import AUDIO_CHUNK_BYTES, audio_timestamp_ns
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+class LevelResult:
+    def __init__(self, sessions: int):
+        self.sessions = sessions
+        self.forwarding_ms: list[float] = []
+        self.tool_round_trip_ms: list[float] = []
+        self.cpu_seconds: Optional[float] = None
+        self.wall_seconds = 0.0
+        self.errors = 0
+        self.connected = 0
+        self.peak_concurrent = 0
+        self._concurrent = 0
+
+    def percentile(self, values: list[float], p: float) -> Optional[float]:
+        if not values:
+            return None
+        values = sorted(values)
+        return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+    def report(self) -> dict:
+        cores = self.cpu_seconds / self.wall_seconds if self.cpu_seconds is not None else None
+        return {
+            "sessions": self.sessions,
+            "connected": self.connected,
+            "peak_concurrent_sessions": self.peak_concurrent,
+            "errors": self.errors,
+            "audio_frames": len(self.forwarding_ms),
+            "forwarding_ms_p50": self.percentile(self.forwarding_ms, 50),
+            "forwarding_ms_p95": self.percentile(self.forwarding_ms, 95),
+            "forwarding_ms_p99": self.percentile(self.forwarding_ms, 99),
+            "tool_round_trip_ms_p50": self.percentile(self.tool_round_trip_ms, 50),
+            "tool_round_trip_ms_p95": self.percentile(self.tool_round_trip_ms, 95),
+            "server_cpu_ms_per_session_second": (
+                self.cpu_seconds * 1000 / (self.sessions * self.wall_seconds) if self.cpu_seconds is not None else None
+            ),
+            "server_cores_used": cores,
+        }
+
+
+async def _simulated_client(session: aiohttp.ClientSession, url: str, duration: float, binary: bool, result: LevelResult):
+    """Streams audio chunks in real time like s2s.js and timestamps every audio delta
+    that comes back."""
+    if binary:
+        url += ("&" if "?" in url else "?") + "audio=binary"
+    try:
+        async with session.ws_connect(url) as ws:
+            result.connected += 1
+            result._concurrent += 1
+            result.peak_concurrent = max(result.peak_concurrent, result._concurrent)
+            await ws.send_str(json.dumps({"type": "session.update"}))
+
+            async def send_audio():
+                start = time.perf_counter()
+                i = 0
+                while time.perf_counter() - start < duration:
+                    chunk = os.urandom(AUDIO_CHUNK_BYTES)
+                    if binary:
+                        await ws.send_bytes(chunk)
+                    else:
+                        await ws.send_str(json.dumps({"type": "input_audio_buffer.append", "audio": base64.b64encode(chunk).decode("ascii")}))
+                    i += 1
+                    await asyncio.sleep(max(start + i * 0.1 - time.perf_counter(), 0))
+                await ws.close()
+
+            async def receive():
+                async for msg in ws:
+                    if msg.type == aiohttp.WSMsgType.BINARY:
+                        pcm = msg.data
+                    elif msg.type == aiohttp.WSMsgType.TEXT:
+                        event = json.loads(msg.data)
+                        if event.get("type") != "response.audio.delta":
+                            continue
+                        pcm = base64.b64decode(event["delta"])
+                    else:
+                        continue
+                    result.forwarding_ms.append((time.time_ns() - audio_timestamp_ns(pcm)) / 1e6)
+
+            try:
+                await asyncio.gather(send_audio(), receive())
+            finally:
+                result._concurrent -= 1
+    except (aiohttp.ClientError, ConnectionResetError):
+        result.errors += 1
+
+
+def _cpu_seconds(servers: list["psutil.Process"]) -> dict[int, float]:
+    # User and system time of the server processes and all their children (the serve.py workers),
+    # by pid so processes starting or exiting mid-level are counted for the time they were there
+    seconds = {}
+    for server in servers:
+        try:
+            processes = [server] + server.children(recursive=True)
+        except psutil.NoSuchProcess:
+            continue
+        for process in processes:
+            try:
+                seconds[process.pid] = sum(process.cpu_times()[:2])
+            except psutil.NoSuchProcess:
+                pass
+    return seconds
+
+
+async def run_level(url: str, sessions: int, duration: float, binary: bool, mock_url: Optional[str], servers: list["psutil.Process"]) -> LevelResult:
+    result = LevelResult(sessions)
+    # Unlimited, the default connector would queue every client past 100 and measure this generator's
+    # cap instead of the middle tier
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        if mock_url:
+            async with session.get(f"{mock_url}/stats", params={"reset": "1"}):
+                pass
+        cpu_before = _cpu_seconds(servers)
+        start = time.perf_counter()
+        await asyncio.gather(*[_simulated_client(session, url, duration, binary, result) for _ in range(sessions)])
+        result.wall_seconds = time.perf_counter() - start
+        if servers:
+            cpu_after = _cpu_seconds(servers)
+            result.cpu_seconds = sum(seconds - cpu_before.get(pid, 0.0) for pid, seconds in cpu_after.items())
+        if mock_url:
+            async with session.get(f"{mock_url}/stats", params={"reset": "1"}) as response:
+                result.tool_round_trip_ms = (await response.json())["tool_round_trip_ms"]
+    return result
+
+
+async def main(args):
+    servers = []
+    if args.server_pid:
+        if psutil is None:
+            print("psutil is not installed, server CPU will not be reported")
+        else:
+            servers = [psutil.Process(pid) for pid in args.server_pid]
+
+    levels = [args.sessions] if not args.ramp else [n for n in (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024) if n <= args.sessions]
+    baseline_p95 = None
+    last_good = None
+    for sessions in levels:
+        result = await run_level(args.url, sessions, args.duration, args.binary, args.mock_url, servers)
+        report = result.report()
+        print(json.dumps(report))
+        if result.peak_concurrent != sessions:
+            # Clients that never ran side by side measured something other than this level
+            print(f"Only {result.peak_concurrent} of {sessions} sessions were connected at once, stopping")
+            break
+        p95 = report["forwarding_ms_p95"]
+        if p95 is None:
+            break
+        baseline_p95 = baseline_p95 if baseline_p95 is not None else p95
+        # Degraded once the tail is well above what a single session sees, or over the absolute budget
+        if result.errors or p95 > max(baseline_p95 * args.degradation_factor, args.latency_budget_ms):
+            break
+        last_good = report
+
+    if args.ramp and last_good is not None:
+        cores = last_good["server_cores_used"]
+        print(
+            json.dumps(
+                {
+                    "max_sessions_before_degradation": last_good["sessions"],
+                    "server_cores_used": cores,
+                    # Extrapolated from the last healthy level, only meaningful once the ramp actually degraded
+                    "sessions_per_core": last_good["sessions"] / cores if cores else None,
+                }
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Drives simulated browser clients against the middle tier's /realtime endpoint. Point the middle "
+        + "tier's AZURE_OPENAI_ENDPOINT at mock_realtime.py to run without Azure."
+    )
+    parser.add_argument("--url", default="ws://localhost:8765/realtime")
+    parser.add_argument("--mock-url", default="http://localhost:8766", help="mock_realtime.py base url, for tool round-trip times")
+    parser.add_argument("--sessions", type=int, default=10, help="concurrent sessions, the upper bound with --ramp")
+    parser.add_argument("--duration", type=float, default=20, help="seconds each session streams audio")
+    parser.add_argument("--binary", action="store_true", help="use binary audio framing")
+    parser.add_argument("--ramp", action="store_true", help="double the sessions until forwarding latency degrades")
+    parser.add_argument(
+        "--server-pid", type=int, nargs="+", help="middle tier process ids, for CPU usage, children (serve.py workers) included"
+    )
+    parser.add_argument("--latency-budget-ms", type=float, default=20)
+    parser.add_argument("--degradation-factor", type=float, default=2)
+    asyncio.run(main(parser.parse_args()))
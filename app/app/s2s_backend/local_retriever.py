@@ -0,0 +1,270 @@
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import re
+from collections import Counter
+from typing import Awaitable, Callable, Iterable, Optional, Sequence
+
+import numpy as np
+
+from retrievers import Chunk, Retriever
+
+logger = logging.getLogger("voicerag")
+
+CHUNKS_FILE = "chunks.jsonl"
+EMBEDDINGS_FILE = "embeddings.npy"
+# Per-row dequantization scales, only present for int8 embeddings
+SCALES_FILE = "scales.npy"
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def _tokenize(text: str) -> list[str]:
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    k = min(k, len(scores))
+    if k == 0:
+        return np.empty(0, dtype=np.int64)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+class BM25Index:
+    def __init__(self, documents: Sequence[str], k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.size = len(documents)
+        lengths = np.zeros(self.size, dtype=np.float32)
+        postings: dict[str, tuple[list[int], list[int]]] = {}
+        for i, document in enumerate(documents):
+            counts = Counter(_tokenize(document))
+            lengths[i] = sum(counts.values())
+            for term, tf in counts.items():
+                docs, tfs = postings.setdefault(term, ([], []))
+                docs.append(i)
+                tfs.append(tf)
+
+        average_length = float(lengths.mean()) if self.size else 0.0
+        # Document length normalization doesn't depend on the query, so it is computed once
+        self._length_norm = k1 * (1 - b + b * lengths / max(average_length, 1e-9))
+        self._postings = {
+            term: (
+                np.asarray(docs, dtype=np.int32),
+                np.asarray(tfs, dtype=np.float32),
+                math.log(1 + (self.size - len(docs) + 0.5) / (len(docs) + 0.5)),
+            )
+            for term, (docs, tfs) in postings.items()
+        }
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(self.size, dtype=np.float32)
+        for term in set(_tokenize(query)):
+            posting = self._postings.get(term)
+            if posting is None:
+                continue
+            docs, tfs, idf = posting
+            scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + self._length_norm[docs])
+        return scores
+
+
+class LocalRetriever(Retriever):
+    """In-process hybrid retriever over files written by build_local_index.
+
+    Keyword results come from BM25 and vector results from a brute-force scan of a memory-mapped
+    embedding matrix, fused with reciprocal rank fusion. Without an embedder, or without embeddings
+    on disk, it is keyword only.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        embedder: Optional[Callable[[str], Awaitable[Sequence[float]]]] = None,
+        k_nearest_neighbors: int = 50,
+        rrf_k: int = 60,
+        block_size: int = 65536,
+    ):
+        self.embedder = embedder
+        self.k_nearest_neighbors = k_nearest_neighbors
+        self.rrf_k = rrf_k
+        self.block_size = block_size
+
+        self._ids: list[str] = []
+        self._titles: list[str] = []
+        self._contents: list[str] = []
+        self._parents: list[Optional[str]] = []
+        with open(os.path.join(directory, CHUNKS_FILE), encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                self._ids.append(record["chunk_id"])
+                self._titles.append(record["title"])
+                self._contents.append(record["chunk"])
+                self._parents.append(record.get("parent_id"))
+        self._positions = {chunk_id: i for i, chunk_id in enumerate(self._ids)}
+
+        self._embeddings: Optional[np.ndarray] = None
+        self._scales: Optional[np.ndarray] = None
+        if os.path.exists(os.path.join(directory, EMBEDDINGS_FILE)):
+            self._embeddings = np.load(os.path.join(directory, EMBEDDINGS_FILE), mmap_mode="r")
+            if os.path.exists(os.path.join(directory, SCALES_FILE)):
+                self._scales = np.load(os.path.join(directory, SCALES_FILE))
+
+        # Title is indexed with the content, like the semantic configuration prioritizes it
+        self._bm25 = BM25Index([f"{t} {c}" for t, c in zip(self._titles, self._contents)])
+        self.cache_key = ("local", os.path.abspath(directory), embedder is not None)
+        logger.info(
+            "Loaded local retriever with %d chunks from %s (%s)",
+            len(self._ids),
+            directory,
+            "keyword only" if self._embeddings is None else f"{self._embeddings.dtype} vectors",
+        )
+
+    def _vector_scores(self, query_vector: Sequence[float]) -> np.ndarray:
+        query = np.asarray(query_vector, dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        count = self._embeddings.shape[0]
+        scores = np.empty(count, dtype=np.float32)
+        # Blocks bound the float32 temporaries when the matrix is int8
+        for start in range(0, count, self.block_size):
+            block = self._embeddings[start : start + self.block_size]
+            scores[start : start + len(block)] = block.astype(np.float32, copy=False) @ query
+        if self._scales is not None:
+            scores *= self._scales
+        return scores
+
+    def _search(self, query: str, query_vector: Optional[Sequence[float]], top: int) -> list[Chunk]:
+        keyword_scores = self._bm25.scores(query)
+        keyword_ranking = _top_k(keyword_scores, self.k_nearest_neighbors)
+        rankings = [keyword_ranking[keyword_scores[keyword_ranking] > 0]]
+        if query_vector is not None:
+            rankings.append(_top_k(self._vector_scores(query_vector), self.k_nearest_neighbors))
+
+        fused: dict[int, float] = {}
+        for ranking in rankings:
+            for rank, i in enumerate(ranking.tolist()):
+                fused[i] = fused.get(i, 0.0) + 1.0 / (self.rrf_k + rank + 1)
+        best = sorted(fused, key=fused.get, reverse=True)[:top]
+        return [(self._ids[i], self._titles[i], self._contents[i], self._parents[i]) for i in best]
+
+    async def search(self, query: str, top: int) -> list[Chunk]:
+        query_vector = None
+        if self.embedder is not None and self._embeddings is not None:
+            query_vector = await self.embedder(query)
+        # NumPy releases the GIL for the heavy parts, keep them off the event loop
+        return await asyncio.to_thread(self._search, query, query_vector, top)
+
+    async def lookup(self, ids: list[str]) -> dict[str, tuple[str, str]]:
+        return {
+            chunk_id: (self._titles[i], self._contents[i])
+            for chunk_id in ids
+            if (i := self._positions.get(chunk_id)) is not None
+        }
+
+
+def build_local_index(records: Iterable[dict], directory: str, dtype: str = "float32") -> int:
+    """Writes the files LocalRetriever loads from records following the index schema created by
+    setup_intvect.setup_index (chunk_id, parent_id, title, chunk and optionally text_vector).
+
+    Records are streamed, vectors go through a temporary file so the corpus never has to fit in
+    memory. Returns the number of chunks written.
+    """
+    if dtype not in ("float32", "int8"):
+        raise ValueError(f"Unsupported embedding dtype: {dtype}")
+    os.makedirs(directory, exist_ok=True)
+    raw_path = os.path.join(directory, EMBEDDINGS_FILE + ".tmp")
+    count = 0
+    vector_count = 0
+    dimensions = None
+    with open(os.path.join(directory, CHUNKS_FILE), "w", encoding="utf-8") as chunks_file, open(
+        raw_path, "wb"
+    ) as raw_file:
+        for record in records:
+            chunks_file.write(
+                json.dumps(
+                    {
+                        "chunk_id": record["chunk_id"],
+                        "parent_id": record.get("parent_id"),
+                        "title": record["title"],
+                        "chunk": record["chunk"],
+                    }
+                )
+                + "\n"
+            )
+            count += 1
+            vector = record.get("text_vector")
+            if vector is not None:
+                vector = np.asarray(vector, dtype=np.float32)
+                if dimensions is None:
+                    dimensions = len(vector)
+                elif len(vector) != dimensions:
+                    raise ValueError(f"Chunk {record['chunk_id']} has {len(vector)} dimensions, expected {dimensions}")
+                raw_file.write(vector.tobytes())
+                vector_count += 1
+
+    for path in (EMBEDDINGS_FILE, SCALES_FILE):
+        if os.path.exists(os.path.join(directory, path)):
+            os.remove(os.path.join(directory, path))
+    try:
+        if vector_count == 0:
+            return count
+        if vector_count != count:
+            raise ValueError(f"Only {vector_count} of {count} chunks have vectors, they must all have one or none")
+
+        raw = np.memmap(raw_path, dtype=np.float32, mode="r", shape=(count, dimensions))
+        embeddings = np.lib.format.open_memmap(
+            os.path.join(directory, EMBEDDINGS_FILE), mode="w+", dtype=dtype, shape=(count, dimensions)
+        )
+        scales = np.empty(count, dtype=np.float32) if dtype == "int8" else None
+        for start in range(0, count, 65536):
+            block = np.array(raw[start : start + 65536])
+            # Normalized up front so the dot product at query time is the cosine similarity
+            block /= np.maximum(np.linalg.norm(block, axis=1, keepdims=True), 1e-12)
+            if scales is None:
+                embeddings[start : start + len(block)] = block
+            else:
+                block_scales = np.maximum(np.abs(block).max(axis=1), 1e-12) / 127
+                embeddings[start : start + len(block)] = np.round(block / block_scales[:, None]).astype(np.int8)
+                scales[start : start + len(block)] = block_scales
+        embeddings.flush()
+        del embeddings, raw
+        if scales is not None:
+            np.save(os.path.join(directory, SCALES_FILE), scales)
+        return count
+    finally:
+        os.remove(raw_path)
+
+
+def _export_search_index(search_endpoint: str, search_index: str, credential) -> Iterable[dict]:
+    from azure.search.documents import SearchClient
+
+    search_client = SearchClient(search_endpoint, search_index, credential)
+    yield from search_client.search(
+        search_text="*", select=["chunk_id", "parent_id", "title", "chunk", "text_vector"]
+    )
+
+
+if __name__ == "__main__":
+    from azure.core.credentials import AzureKeyCredential
+    from azure.identity import AzureDeveloperCliCredential
+    from dotenv import load_dotenv
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Export the Azure AI Search index into files for LocalRetriever")
+    parser.add_argument("directory")
+    parser.add_argument("--dtype", choices=["float32", "int8"], default="float32")
+    args = parser.parse_args()
+
+    load_dotenv()
+    if search_key := os.environ.get("AZURE_SEARCH_API_KEY"):
+        credential = AzureKeyCredential(search_key)
+    else:
+        credential = AzureDeveloperCliCredential(tenant_id=os.environ.get("AZURE_TENANT_ID"), process_timeout=60)
+    count = build_local_index(
+        _export_search_index(os.environ["AZURE_SEARCH_ENDPOINT"], os.environ["AZURE_SEARCH_INDEX"], credential),
+        args.directory,
+        dtype=args.dtype,
+    )
+    logger.info("Wrote %d chunks to %s", count, args.directory)
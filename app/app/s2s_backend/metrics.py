@@ -0,0 +1,123 @@
+import bisect
+import logging
+import time
+from collections import deque
+from typing import Callable, Optional
+
+from aiohttp import web
+
+logger = logging.getLogger("voicerag")
+
+# Milliseconds, spanning a local forward up to a slow tool call
+DEFAULT_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+BYTE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """Process-wide histograms plus collectors for the stats other components already keep,
+    rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._histograms: dict[tuple[str, tuple[tuple[str, str], ...]], Histogram] = {}
+        self._counters: dict[tuple[str, tuple[tuple[str, str], ...]], float] = {}
+        self._collectors: dict[str, Callable[[], dict]] = {}
+        # Added to every series, e.g. the worker of a multi-process server this process is
+        self.labels: dict[str, str] = {}
+
+    def observe(
+        self, name: str, value: float, buckets: tuple[float, ...] = DEFAULT_BUCKETS, **labels: str
+    ) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def increment(self, name: str, value: float = 1, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def add_collector(self, prefix: str, collect: Callable[[], dict]) -> None:
+        # Numeric values of the returned dict are exported as gauges named <prefix>_<key>
+        self._collectors[prefix] = collect
+
+    def _label_text(self, labels: tuple[tuple[str, str], ...] = ()) -> str:
+        return ",".join(f'{k}="{v}"' for k, v in sorted(self.labels.items()) + list(labels))
+
+    def render(self) -> str:
+        lines = []
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            label_text = self._label_text(labels)
+            separator = "," if label_text else ""
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{label_text}{separator}le="{bound}"}} {cumulative}')
+            suffix = f"{{{label_text}}}" if label_text else ""
+            lines.append(f"{name}_sum{suffix} {histogram.sum}")
+            lines.append(f"{name}_count{suffix} {histogram.count}")
+        for (name, labels), value in sorted(self._counters.items()):
+            label_text = self._label_text(labels)
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+        label_text = self._label_text()
+        suffix = f"{{{label_text}}}" if label_text else ""
+        for prefix, collect in sorted(self._collectors.items()):
+            for key, value in collect().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f"{prefix}_{key}{suffix} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain")
+
+
+class SessionTimeline:
+    """Timestamped milestones of one realtime session, feeding the latency histograms."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        # Bounded, long sessions only keep their most recent milestones
+        self.events: deque[tuple[float, str]] = deque(maxlen=500)
+        self._speech_stopped: Optional[float] = None
+        self._first_audio: Optional[float] = None
+
+    def mark(self, event: str) -> float:
+        now = time.perf_counter()
+        self.events.append(((now - self.start) * 1000, event))
+        return now
+
+    def observe(self, event_type: Optional[str]) -> None:
+        # Called for every upstream event, so only a few types do any work
+        if event_type == "input_audio_buffer.speech_stopped":
+            self._speech_stopped = self.mark(event_type)
+            self._first_audio = None
+        elif event_type == "response.audio.delta":
+            if self._speech_stopped is not None and self._first_audio is None:
+                self._first_audio = self.mark("first response.audio.delta")
+                metrics.observe("rtmt_speech_stopped_to_first_audio_ms", (self._first_audio - self._speech_stopped) * 1000)
+        elif event_type == "response.done":
+            now = self.mark(event_type)
+            # Tool calls produce several responses per turn, the turn ends with the one that spoke
+            if self._speech_stopped is not None and self._first_audio is not None:
+                metrics.observe("rtmt_speech_stopped_to_response_done_ms", (now - self._speech_stopped) * 1000)
+                self._speech_stopped = None
+
+    def summary(self) -> str:
+        return ", ".join(f"{offset:.0f}ms {event}" for offset, event in self.events)
@@ -0,0 +1,177 @@
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import struct
+import time
+import uuid
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger("voicerag")
+
+SAMPLE_RATE = 24000
+# 100 ms of PCM16 mono per audio delta
+AUDIO_CHUNK_BYTES = SAMPLE_RATE * 2 // 10
+
+# Every audio delta starts with the wall clock time it was sent at so clients can measure how long
+# the middle tier took to forward it, the rest is noise standing in for speech
+_TIMESTAMP = struct.Struct("<q")
+
+
+def stamped_audio(size: int = AUDIO_CHUNK_BYTES) -> bytes:
+    return _TIMESTAMP.pack(time.time_ns()) + os.urandom(size - _TIMESTAMP.size)
+
+
+def audio_timestamp_ns(pcm: bytes) -> int:
+    return _TIMESTAMP.unpack_from(pcm)[0]
+
+
+def _id(prefix: str) -> str:
+    return f"{prefix}_{uuid.uuid4().hex[:20]}"
+
+
+class MockStats:
+    def __init__(self):
+        self.sessions = 0
+        self.tool_round_trip_ms: list[float] = []
+
+    def as_dict(self) -> dict:
+        return {"sessions": self.sessions, "tool_round_trip_ms": self.tool_round_trip_ms}
+
+
+class MockRealtimeSession:
+    """Plays a scripted realtime conversation: every `turn_ms` of input audio is treated as an
+    utterance that is answered with a search call, a report_grounding call and a spoken answer."""
+
+    def __init__(self, ws: web.WebSocketResponse, stats: MockStats, turn_ms: int, answer_ms: int, tool_delay_ms: int):
+        self.ws = ws
+        self.stats = stats
+        self.turn_bytes = SAMPLE_RATE * 2 * turn_ms // 1000
+        self.answer_ms = answer_ms
+        self.tool_delay_ms = tool_delay_ms
+        self.audio_bytes = 0
+        self.responding = False
+        self.pending_calls: dict[str, float] = {}
+        self.step = 0
+        self.last_item_id = None
+
+    async def send(self, event: dict):
+        event.setdefault("event_id", _id("event"))
+        await self.ws.send_str(json.dumps(event))
+
+    async def _function_call_response(self, name: str, arguments: dict):
+        response_id = _id("resp")
+        item_id = _id("item")
+        call_id = _id("call")
+        item = {"id": item_id, "type": "function_call", "status": "in_progress", "name": name, "call_id": call_id, "arguments": ""}
+        await self.send({"type": "response.created", "response": {"id": response_id, "status": "in_progress", "output": []}})
+        await self.send({"type": "response.output_item.added", "response_id": response_id, "output_index": 0, "item": item})
+        await self.send({"type": "conversation.item.created", "previous_item_id": self.last_item_id, "item": item})
+        args = json.dumps(arguments)
+        await asyncio.sleep(self.tool_delay_ms / 1000)
+        await self.send({"type": "response.function_call_arguments.delta", "response_id": response_id, "item_id": item_id, "call_id": call_id, "delta": args})
+        await self.send({"type": "response.function_call_arguments.done", "response_id": response_id, "item_id": item_id, "call_id": call_id, "arguments": args})
+        done_item = dict(item, status="completed", arguments=args)
+        self.pending_calls[call_id] = time.perf_counter()
+        await self.send({"type": "response.output_item.done", "response_id": response_id, "output_index": 0, "item": done_item})
+        await self.send({"type": "response.done", "response": {"id": response_id, "status": "completed", "output": [done_item]}})
+        self.last_item_id = item_id
+
+    async def _audio_response(self):
+        response_id = _id("resp")
+        item_id = _id("item")
+        item = {"id": item_id, "type": "message", "role": "assistant", "status": "in_progress", "content": []}
+        await self.send({"type": "response.created", "response": {"id": response_id, "status": "in_progress", "output": []}})
+        await self.send({"type": "response.output_item.added", "response_id": response_id, "output_index": 0, "item": item})
+        await self.send({"type": "conversation.item.created", "previous_item_id": self.last_item_id, "item": item})
+        # Paced like the real service, audio is produced roughly in real time
+        start = time.perf_counter()
+        for i in range(self.answer_ms // 100):
+            await self.send({"type": "response.audio_transcript.delta", "response_id": response_id, "item_id": item_id, "output_index": 0, "content_index": 0, "delta": "word "})
+            await self.send({"type": "response.audio.delta", "response_id": response_id, "item_id": item_id, "output_index": 0, "content_index": 0, "delta": base64.b64encode(stamped_audio()).decode("ascii")})
+            await asyncio.sleep(max(start + (i + 1) * 0.1 - time.perf_counter(), 0))
+        await self.send({"type": "response.audio.done", "response_id": response_id, "item_id": item_id, "output_index": 0, "content_index": 0})
+        await self.send({"type": "response.audio_transcript.done", "response_id": response_id, "item_id": item_id, "output_index": 0, "content_index": 0, "transcript": "This is a mock answer."})
+        done_item = dict(item, status="completed")
+        await self.send({"type": "response.output_item.done", "response_id": response_id, "output_index": 0, "item": done_item})
+        await self.send({"type": "response.done", "response": {"id": response_id, "status": "completed", "output": [done_item]}})
+        self.last_item_id = item_id
+        self.responding = False
+
+    async def _start_turn(self):
+        self.responding = True
+        self.step = 0
+        item_id = _id("item")
+        await self.send({"type": "input_audio_buffer.speech_started", "audio_start_ms": 0, "item_id": item_id})
+        await self.send({"type": "input_audio_buffer.speech_stopped", "audio_end_ms": 1000, "item_id": item_id})
+        await self.send({"type": "input_audio_buffer.committed", "previous_item_id": self.last_item_id, "item_id": item_id})
+        await self.send({"type": "conversation.item.input_audio_transcription.completed", "item_id": item_id, "content_index": 0, "transcript": "What is in the knowledge base?"})
+        self.last_item_id = item_id
+        await self._function_call_response("search", {"query": "knowledge base contents"})
+
+    async def _next_step(self):
+        # Driven by the middle tier's response.create after it delivered the tool outputs
+        self.step += 1
+        if self.step == 1:
+            await self._function_call_response("report_grounding", {"sources": []})
+        else:
+            await self._audio_response()
+
+    async def handle(self, event: dict):
+        match event["type"]:
+            case "session.update":
+                await self.send({"type": "session.updated", "session": event.get("session", {})})
+            case "input_audio_buffer.append":
+                self.audio_bytes += len(event["audio"]) * 3 // 4
+                if not self.responding and self.audio_bytes >= self.turn_bytes:
+                    self.audio_bytes = 0
+                    asyncio.create_task(self._start_turn())
+            case "conversation.item.create":
+                item = event.get("item", {})
+                if item.get("type") == "function_call_output" and item.get("call_id") in self.pending_calls:
+                    sent = self.pending_calls.pop(item["call_id"])
+                    self.stats.tool_round_trip_ms.append((time.perf_counter() - sent) * 1000)
+            case "response.create":
+                asyncio.create_task(self._next_step())
+
+
+def create_mock_app(turn_ms: int = 3000, answer_ms: int = 2000, tool_delay_ms: int = 50) -> web.Application:
+    stats = MockStats()
+
+    async def realtime_handler(request: web.Request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        stats.sessions += 1
+        session = MockRealtimeSession(ws, stats, turn_ms, answer_ms, tool_delay_ms)
+        await session.send({"type": "session.created", "session": {"id": _id("sess"), "model": "mock", "voice": "alloy", "instructions": "", "tools": [], "tool_choice": "auto", "max_response_output_tokens": "inf"}})
+        async for msg in ws:
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                await session.handle(json.loads(msg.data))
+        return ws
+
+    async def stats_handler(request: web.Request):
+        result = stats.as_dict()
+        if request.query.get("reset") == "1":
+            stats.tool_round_trip_ms = []
+        return web.json_response(result)
+
+    app = web.Application()
+    app.router.add_get("/openai/realtime", realtime_handler)
+    app.router.add_get("/stats", stats_handler)
+    return app
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Local stand-in for the Azure OpenAI /openai/realtime endpoint")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--turn-ms", type=int, default=3000, help="input audio per simulated utterance")
+    parser.add_argument("--answer-ms", type=int, default=2000, help="length of each spoken answer")
+    parser.add_argument("--tool-delay-ms", type=int, default=50, help="simulated model time before emitting function call arguments")
+    args = parser.parse_args()
+    web.run_app(create_mock_app(args.turn_ms, args.answer_ms, args.tool_delay_ms), host=args.host, port=args.port)
@@ -1,12 +1,25 @@
+import asyncio
+import hashlib
+import json
+import logging
 import re
-from typing import Any
+import time
+from typing import Any, Awaitable, Callable, Optional
 
+from aiohttp import web
 from azure.core.credentials import AzureKeyCredential
 from azure.identity import DefaultAzureCredential
 from azure.search.documents.aio import SearchClient
-from azure.search.documents.models import VectorizableTextQuery
 
-from rtmt import RTMiddleTier, Tool, ToolResult, ToolResultDirection
+from cache import AsyncLRUCache
+from compaction import compact
+from metrics import metrics
+from resilience import KnowledgeBaseUnavailable, ResilientRetriever
+from retrievers import AzureSearchRetriever, Chunk, Retriever
+from rtmt import RTMiddleTier, Tool, ToolResult, ToolResultDirection, current_session
+from tokens import TokenManager
+
+logger = logging.getLogger("voicerag")
 
 _search_tool_schema = {
     "type": "function",
@@ -49,55 +62,220 @@ _grounding_tool_schema = {
     }
 }
 
+SEARCH_TOP = 5
+# Most chunks a single /chunks request can ask for
+MAX_CHUNK_IDS = 50
+KNOWLEDGE_BASE_UNAVAILABLE = "The knowledge base is unavailable right now. Tell the user you can't look this up at the moment " + \
+                             "and suggest trying again shortly, don't answer from memory."
+
+def _normalize_query(query: str) -> str:
+    return " ".join(query.lower().split()).rstrip("?.!")
+
+def _session_chunks() -> dict[str, tuple[str, str]]:
+    # Chunks retrieved by search in the current session, keyed by identifier, as (title, content)
+    rt_session = current_session.get()
+    if rt_session is None:
+        return {}
+    return rt_session.tool_state.setdefault("chunks", {})
+
+class SpeculationStats:
+    def __init__(self):
+        self.launched = 0
+        self.hits = 0
+        self.misses = 0
+        self.saved_ms = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "launched": self.launched,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / max(self.hits + self.misses, 1),
+            "saved_ms": self.saved_ms,
+        }
+
+class RagTools:
+    def __init__(self, retriever: ResilientRetriever, search_cache: AsyncLRUCache, chunk_cache: AsyncLRUCache, speculation: Optional[SpeculationStats], token_manager: Optional[TokenManager] = None):
+        # Clear search_cache and chunk_cache after re-indexing, speculation is None unless speculative search is enabled
+        self.retriever = retriever
+        self.search_cache = search_cache
+        self.chunk_cache = chunk_cache
+        self.speculation = speculation
+        # The search credential when it's refreshed in the background, None with an API key or a custom retriever
+        self.token_manager = token_manager
+        # Set for browsers loading the page from another origin than the middle tier, "*" allows any
+        self.allow_origin: Optional[str] = None
+
+    async def chunks(self, ids: list[str]) -> dict[str, tuple[str, str]]:
+        # (title, content) by id, from the chunk cache first and a single backend lookup for the rest
+        found = {}
+        missing = []
+        for chunk_id in ids:
+            if (chunk := self.chunk_cache.get(chunk_id)) is not None:
+                self.chunk_cache.stats.hits += 1
+                found[chunk_id] = chunk
+            else:
+                missing.append(chunk_id)
+        if missing:
+            self.chunk_cache.stats.misses += len(missing)
+            for chunk_id, chunk in (await self.retriever.lookup(missing)).items():
+                self.chunk_cache.put(chunk_id, chunk)
+                found[chunk_id] = chunk
+        return found
+
+    async def chunks_handler(self, request: web.Request) -> web.Response:
+        """GET /chunks?ids=a,b,c: the content of cited chunks, fetched when the user opens a citation
+        instead of being pushed down the realtime socket with every report_grounding call."""
+        ids = list(dict.fromkeys(i for i in request.query.get("ids", "").split(",") if i))
+        if not ids or len(ids) > MAX_CHUNK_IDS or not all(KEY_PATTERN.match(i) for i in ids):
+            raise web.HTTPBadRequest(text=f"ids must be 1 to {MAX_CHUNK_IDS} comma separated chunk ids")
+        try:
+            found = await self.chunks(ids)
+        except KnowledgeBaseUnavailable:
+            raise web.HTTPServiceUnavailable(headers={"Retry-After": str(int(self.retriever.breaker.reset_timeout))})
+        body = json.dumps({
+            "chunks": [{"chunk_id": i, "title": found[i][0], "chunk": found[i][1]} for i in ids if i in found],
+            "missing": [i for i in ids if i not in found],
+        })
+        headers = {
+            "ETag": f'"{hashlib.sha256(body.encode("utf-8")).hexdigest()[:32]}"',
+            # Chunks only change on re-indexing, revalidation after that is a 304 while they stay the same
+            "Cache-Control": f"private, max-age={int(self.chunk_cache.ttl or 0)}",
+        }
+        if self.allow_origin is not None:
+            headers["Access-Control-Allow-Origin"] = self.allow_origin
+        if headers["ETag"] in request.headers.get("If-None-Match", ""):
+            raise web.HTTPNotModified(headers=headers)
+        return web.Response(text=body, content_type="application/json", headers=headers)
+
+# Function words say nothing about what a query is after, "what is the refund" and "what is the
+# weather" share three of their four terms
+_STOP_WORDS = frozenset("""
+    a about an and any are as at be but by can could did do does for from get got had has have how i
+    if in is it its know me my of on or our please should so tell than that the their them then there
+    these they this to us was we were what when where which who why will with would you your
+""".split())
+
+def _query_terms(query: str) -> set[str]:
+    return set(re.findall(r"\w+", query.lower())) - _STOP_WORDS
+
+def _query_similarity(a: set[str], b: set[str]) -> float:
+    # Overlap rather than Jaccard, tool queries tend to be a shortened rewrite of what the user said
+    if not a or not b:
+        return 0.0
+    return len(a & b) / min(len(a), len(b))
+
+async def _retrieve(retriever: Retriever, search_cache: AsyncLRUCache, query: str) -> list[Chunk]:
+    # Everything that changes the results is part of the key, so differently configured tools can share a cache
+    cache_key = (_normalize_query(query), SEARCH_TOP) + retriever.cache_key
+
+    async def timed_search():
+        start = time.perf_counter()
+        chunks = await retriever.search(query, SEARCH_TOP)
+        metrics.observe("search_service_ms", (time.perf_counter() - start) * 1000)
+        return chunks
+
+    return await search_cache.get_or_load(cache_key, timed_search)
+
+async def _speculative_search(retrieve: Callable[[str], Awaitable[list]], speculation: SpeculationStats, transcript: str, item_id: Optional[str]) -> None:
+    rt_session = current_session.get()
+    terms = _query_terms(transcript)
+    # A transcription arriving after its turn is over is too late to help
+    if rt_session is None or not terms or item_id is None or item_id != rt_session.input_item_id:
+        return
+    print(f"Speculatively searching for '{transcript}' in the knowledge base.")
+    entry = {"item_id": item_id, "terms": terms, "started": time.perf_counter(), "finished": None}
+    task = asyncio.ensure_future(retrieve(transcript))
+    task.add_done_callback(lambda _: entry.__setitem__("finished", time.perf_counter()))
+    entry["task"] = task
+    rt_session.tool_state["speculative_search"] = entry
+    speculation.launched += 1
+    try:
+        await task
+    except Exception:
+        pass # Reported when (and if) a search call tries to use it, the tool falls back to a regular search
+
+async def _speculated_chunks(query: str, speculation: SpeculationStats, similarity_threshold: float) -> Optional[list[Chunk]]:
+    # Used by at most one search, and only in the turn whose transcript it was started on
+    rt_session = current_session.get()
+    entry = rt_session.tool_state.pop("speculative_search", None) if rt_session is not None else None
+    if entry is None or entry["item_id"] != rt_session.input_item_id:
+        return None
+    if _query_similarity(_query_terms(query), entry["terms"]) < similarity_threshold:
+        speculation.misses += 1
+        return None
+    requested = time.perf_counter()
+    try:
+        chunks = await asyncio.shield(entry["task"])
+    except asyncio.CancelledError:
+        if not entry["task"].cancelled():
+            raise # The search call itself was cancelled
+        speculation.misses += 1
+        return None
+    except Exception:
+        speculation.misses += 1
+        return None
+    # Time the search had already been running (or was done) when the model asked for it
+    speculation.hits += 1
+    speculation.saved_ms += (min(requested, entry["finished"] or requested) - entry["started"]) * 1000
+    return chunks
+
 async def _search_tool(
-    search_client: SearchClient, 
-    semantic_configuration: str,
-    identifier_field: str,
-    content_field: str,
-    embedding_field: str,
-    use_vector_query: bool,
+    retrieve: Callable[[str], Awaitable[list]],
+    speculation: Optional[SpeculationStats],
+    similarity_threshold: float,
+    token_budget: Optional[int],
     args: Any) -> ToolResult:
     print(f"Searching for '{args['query']}' in the knowledge base.")
-    # Hybrid + Reranking query using Azure AI Search
-    vector_queries = []
-    if use_vector_query:
-        vector_queries.append(VectorizableTextQuery(text=args['query'], k_nearest_neighbors=50, fields=embedding_field))
-    search_results = await search_client.search(
-        search_text=args['query'], 
-        query_type="semantic",
-        semantic_configuration_name=semantic_configuration,
-        top=5,
-        vector_queries=vector_queries,
-        select=", ".join([identifier_field, content_field])
-    )
-    result = ""
-    async for r in search_results:
-        result += f"[{r[identifier_field]}]: {r[content_field]}\n-----\n"
-    return ToolResult(result, ToolResultDirection.TO_SERVER)
+    chunks = None
+    if speculation is not None:
+        chunks = await _speculated_chunks(args['query'], speculation, similarity_threshold)
+    if chunks is None:
+        try:
+            chunks = await retrieve(args['query'])
+        except KnowledgeBaseUnavailable as e:
+            logger.warning("Search for '%s' failed: %s", args['query'], e)
+            return ToolResult(KNOWLEDGE_BASE_UNAVAILABLE, ToolResultDirection.TO_SERVER)
+
+    # Overlapping pages are merged and, over the token budget, cut down to the most relevant sentences,
+    # every input token adds to the time before the model starts answering
+    start = time.perf_counter()
+    compacted = compact(chunks, args['query'], token_budget)
+    metrics.observe("search_compaction_ms", (time.perf_counter() - start) * 1000)
+    metrics.increment("search_tokens_saved", compacted.saved_tokens)
+    logger.info("Search result compacted from %d to %d tokens (%d saved)", compacted.original_tokens, compacted.tokens, compacted.saved_tokens)
+
+    # Kept so report_grounding can answer from what the model just read without another round-trip,
+    # a merged passage is cited by its first identifier and grounds with its full text
+    session_chunks = _session_chunks()
+    for identifier, title, content, _ in chunks:
+        session_chunks[identifier] = (title, content)
+    for passage in compacted.passages:
+        session_chunks[passage.identifier] = (passage.title, passage.content)
+    return ToolResult(compacted.text, ToolResultDirection.TO_SERVER)
 
 KEY_PATTERN = re.compile(r'^[a-zA-Z0-9_=\-]+$')
 
-# TODO: move from sending all chunks used for grounding eagerly to only sending links to 
-# the original content in storage, it'll be more efficient overall
-async def _report_grounding_tool(search_client: SearchClient, identifier_field: str, title_field: str, content_field: str, args: Any) -> None:
+# Only ids and titles go to the client, which fetches the content from /chunks when it shows it, so
+# citations don't hold up audio frames on the realtime socket
+async def _report_grounding_tool(rag_tools: RagTools, args: Any) -> None:
     sources = [s for s in args["sources"] if KEY_PATTERN.match(s)]
-    list = " OR ".join(sources)
-    print(f"Grounding source: {list}")
-    # Use search instead of filter to align with how detailt integrated vectorization indexes
-    # are generated, where chunk_id is searchable with a keyword tokenizer, not filterable 
-    search_results = await search_client.search(search_text=list, 
-                                                search_fields=[identifier_field], 
-                                                select=[identifier_field, title_field, content_field], 
-                                                top=len(sources), 
-                                                query_type="full")
-    
-    # If your index has a key field that's filterable but not searchable and with the keyword analyzer, you can 
-    # use a filter instead (and you can remove the regex check above, just ensure you escape single quotes)
-    # search_results = await search_client.search(filter=f"search.in(chunk_id, '{list}')", select=["chunk_id", "title", "chunk"])
-
-    docs = []
-    async for r in search_results:
-        docs.append({"chunk_id": r[identifier_field], "title": r[title_field], "chunk": r[content_field]})
+    print(f"Grounding source: {' OR '.join(sources)}")
+
+    session_chunks = _session_chunks()
+    found = {s: session_chunks[s] for s in sources if s in session_chunks}
+    for s, chunk in found.items():
+        # Served from the chunk cache when the client asks for them, as the model read them
+        rag_tools.chunk_cache.put(s, chunk)
+    missing = [s for s in sources if s not in found]
+    if missing:
+        try:
+            found.update(await rag_tools.chunks(missing))
+        except KnowledgeBaseUnavailable as e:
+            # Citations of chunks the session read still go out, the rest can't be titled
+            logger.warning("Looking up grounding sources failed: %s", e)
+
+    docs = [{"chunk_id": s, "title": found[s][0]} for s in sources if s in found]
     return ToolResult({"sources": docs}, ToolResultDirection.TO_CLIENT)
 
 def attach_rag_tools(rtmt: RTMiddleTier,
@@ -108,11 +286,40 @@ def attach_rag_tools(rtmt: RTMiddleTier,
     content_field: str,
     embedding_field: str,
     title_field: str,
-    use_vector_query: bool
-    ) -> None:
-    if not isinstance(credentials, AzureKeyCredential):
-        credentials.get_token("https://search.azure.com/.default") # warm this up before we start getting requests
-    search_client = SearchClient(search_endpoint, search_index, credentials, user_agent="RTMiddleTier")
-
-    rtmt.tools["search"] = Tool(schema=_search_tool_schema, target=lambda args: _search_tool(search_client, semantic_configuration, identifier_field, content_field, embedding_field, use_vector_query, args))
-    rtmt.tools["report_grounding"] = Tool(schema=_grounding_tool_schema, target=lambda args: _report_grounding_tool(search_client, identifier_field, title_field, content_field, args))
+    use_vector_query: bool,
+    parent_field: Optional[str] = None,
+    retriever: Optional[Retriever] = None,
+    cache_size: int = 256,
+    cache_ttl: float = 300,
+    speculative_search: bool = False,
+    speculation_similarity: float = 0.6,
+    token_budget: Optional[int] = None,
+    chunk_cache_size: int = 1024,
+    search_deadline: float = 4.0,
+    hedge_search: bool = True,
+    fallback_to_cached: bool = False,
+    embedder: Optional[Callable[[str], Awaitable[list[float]]]] = None
+    ) -> RagTools:
+    # An explicit retriever (e.g. local_retriever.LocalRetriever) replaces Azure AI Search entirely
+    token_manager = None
+    if retriever is None:
+        if not isinstance(credentials, AzureKeyCredential):
+            # Served from a background-refreshed cache so search calls never block the event loop on Entra ID
+            credentials = token_manager = TokenManager(credentials, "https://search.azure.com/.default")
+            credentials.warm_up() # warm this up before we start getting requests
+        search_client = SearchClient(search_endpoint, search_index, credentials, user_agent="RTMiddleTier")
+        retriever = AzureSearchRetriever(search_client, semantic_configuration, identifier_field, content_field, embedding_field, title_field, use_vector_query, parent_field, embedder)
+    # Deadlines, hedging and a circuit breaker, a slow search backend would otherwise stall the spoken answer
+    retriever = ResilientRetriever(retriever, deadline=search_deadline, hedge=hedge_search, fallback_to_cached=fallback_to_cached)
+    search_cache = AsyncLRUCache(max_size=cache_size, ttl=cache_ttl)
+    retrieve = lambda query: _retrieve(retriever, search_cache, query)
+
+    # Starts retrieval on the user's transcript while the model is still deciding what to search for
+    speculation = SpeculationStats() if speculative_search else None
+    if speculation is not None:
+        rtmt.input_transcript_handlers.append(lambda transcript, item_id: _speculative_search(retrieve, speculation, transcript, item_id))
+
+    rtmt.tools["search"] = Tool(schema=_search_tool_schema, target=lambda args: _search_tool(retrieve, speculation, speculation_similarity, token_budget, args))
+    rag_tools = RagTools(retriever, search_cache, AsyncLRUCache(max_size=chunk_cache_size, ttl=cache_ttl), speculation, token_manager)
+    rtmt.tools["report_grounding"] = Tool(schema=_grounding_tool_schema, target=lambda args: _report_grounding_tool(rag_tools, args))
+    return rag_tools
@@ -0,0 +1,81 @@
+import os
+import struct
+import time
+import uuid
+from typing import Iterator, Union
+
+# Who sent a recorded frame
+CLIENT_IN = 0  # browser to middle tier
+UPSTREAM_OUT = 1  # middle tier to the realtime API, control events only
+UPSTREAM_IN = 2  # realtime API to middle tier
+TOOL_CALL = 3
+TOOL_RESULT = 4
+
+# What the payload is
+TEXT = 0  # a JSON frame as received or sent
+AUDIO = 1  # raw PCM16 of an audio event, without the base64 JSON around it
+
+MAGIC = b"S2SREC1\n"
+# source, kind, microseconds since the session started, payload length
+_HEADER = struct.Struct("<BBQI")
+
+
+class Record:
+    __slots__ = ("source", "kind", "offset", "payload")
+
+    def __init__(self, source: int, kind: int, offset: float, payload: bytes):
+        self.source = source
+        self.kind = kind
+        # Seconds since the session started
+        self.offset = offset
+        self.payload = payload
+
+    def text(self) -> str:
+        return self.payload.decode("utf-8")
+
+
+class SessionRecorder:
+    """Append-only recording of one realtime session: what the browser sent, what the realtime API
+    sent, the control events the middle tier sent upstream, and every tool call with its result.
+
+    Each record is a 14 byte header followed by its payload, written as it happens so a crashed
+    session still leaves everything up to the crash on disk.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "wb")
+        self._file.write(MAGIC)
+        self._start = time.perf_counter()
+
+    @classmethod
+    def in_directory(cls, directory: str) -> "SessionRecorder":
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.s2srec"
+        return cls(os.path.join(directory, name))
+
+    def record(self, source: int, kind: int, payload: Union[str, bytes]) -> None:
+        if self._file.closed:
+            return
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        offset_us = int((time.perf_counter() - self._start) * 1_000_000)
+        self._file.write(_HEADER.pack(source, kind, offset_us, len(payload)))
+        self._file.write(payload)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def read_recording(path: str) -> Iterator[Record]:
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a session recording")
+        while header := f.read(_HEADER.size):
+            if len(header) < _HEADER.size:
+                # Cut short by a crash mid-write, everything before it is still usable
+                return
+            source, kind, offset_us, length = _HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            yield Record(source, kind, offset_us / 1_000_000, payload)
@@ -0,0 +1,282 @@
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import time
+from collections import defaultdict, deque
+from typing import Optional
+
+import aiohttp
+from aiohttp import web
+from azure.core.credentials import AzureKeyCredential
+
+import codec
+from recorder import AUDIO, CLIENT_IN, TOOL_RESULT, UPSTREAM_IN, UPSTREAM_OUT, Record, read_recording
+from rtmt import RTMiddleTier, Tool, ToolResult, ToolResultDirection, peek_event_type
+
+logger = logging.getLogger("voicerag")
+
+# How long the stub waits for the middle tier to send what a recorded upstream event depended on
+DEPENDENCY_TIMEOUT = 10
+
+
+def _percentile(values: list[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+class UpstreamEvent:
+    """A recorded realtime API event, sent `delay` seconds after the middle tier sent the nth
+    (`dependency_index`) event of `dependency_type`, or after the session started when there is none."""
+
+    def __init__(self, record: Record, dependency_type: Optional[str], dependency_index: int, delay: float):
+        self.record = record
+        self.dependency_type = dependency_type
+        self.dependency_index = dependency_index
+        self.delay = delay
+
+
+class RecordedSession:
+    def __init__(self, path: str):
+        self.client: list[Record] = []
+        self.upstream: list[UpstreamEvent] = []
+        self.tool_results: dict[str, deque[dict]] = defaultdict(deque)
+        sent_counts: dict[str, int] = defaultdict(int)
+        dependency: Optional[tuple[str, int, float]] = None
+        for record in read_recording(path):
+            if record.source == CLIENT_IN:
+                self.client.append(record)
+            elif record.source == UPSTREAM_OUT:
+                # The realtime API only reacts to what the middle tier sends, so upstream events are
+                # replayed relative to the last control event that preceded them
+                event_type = peek_event_type(record.text()) or codec.loads(record.payload).get("type")
+                dependency = (event_type, sent_counts[event_type], record.offset)
+                sent_counts[event_type] += 1
+            elif record.source == UPSTREAM_IN:
+                if dependency is None:
+                    self.upstream.append(UpstreamEvent(record, None, 0, record.offset))
+                else:
+                    event_type, index, offset = dependency
+                    self.upstream.append(UpstreamEvent(record, event_type, index, record.offset - offset))
+            elif record.source == TOOL_RESULT:
+                result = codec.loads(record.payload)
+                self.tool_results[result["name"]].append(result)
+
+
+class ReplayStats:
+    def __init__(self):
+        self.forwarding_ms: list[float] = []
+        self.tool_round_trip_ms: list[float] = []
+        self.response_create_ms: list[float] = []
+        self.audio_sent_at: list[float] = []
+        self.upstream_events = 0
+        self.diverged = 0
+        self.wall_seconds = 0.0
+
+    def report(self) -> dict:
+        report = {"upstream_events": self.upstream_events, "diverged": self.diverged, "wall_seconds": self.wall_seconds}
+        for name in ("forwarding_ms", "tool_round_trip_ms", "response_create_ms"):
+            values = getattr(self, name)
+            report[f"{name}_p50"] = _percentile(values, 50)
+            report[f"{name}_p95"] = _percentile(values, 95)
+            report[f"{name}_max"] = max(values) if values else None
+        return report
+
+
+def _stub_upstream_app(session: RecordedSession, stats: ReplayStats, speed: float, done: asyncio.Event) -> web.Application:
+    async def realtime_handler(request: web.Request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        start = time.perf_counter()
+        received: dict[str, list[float]] = defaultdict(list)
+        changed = asyncio.Event()
+        function_calls_sent: dict[str, float] = {}
+        last_output: Optional[float] = None
+
+        async def read():
+            nonlocal last_output
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                now = time.perf_counter()
+                event_type = peek_event_type(msg.data)
+                if event_type == "input_audio_buffer.append":
+                    continue
+                if event_type == "conversation.item.create":
+                    item = codec.loads(msg.data).get("item", {})
+                    if item.get("call_id") in function_calls_sent:
+                        stats.tool_round_trip_ms.append((now - function_calls_sent.pop(item["call_id"])) * 1000)
+                        last_output = now
+                elif event_type == "response.create" and last_output is not None:
+                    stats.response_create_ms.append((now - last_output) * 1000)
+                    last_output = None
+                received[event_type].append(now)
+                changed.set()
+
+        async def write():
+            for event in session.upstream:
+                base = start
+                if event.dependency_type is not None:
+                    times = received[event.dependency_type]
+                    deadline = time.perf_counter() + DEPENDENCY_TIMEOUT
+                    while len(times) <= event.dependency_index and time.perf_counter() < deadline:
+                        changed.clear()
+                        try:
+                            await asyncio.wait_for(changed.wait(), deadline - time.perf_counter())
+                        except asyncio.TimeoutError:
+                            pass
+                    if len(times) > event.dependency_index:
+                        base = times[event.dependency_index]
+                    else:
+                        # This build didn't send what the recorded session did, carry on from here
+                        stats.diverged += 1
+                        base = time.perf_counter() - event.delay / speed
+                await asyncio.sleep(max(base + event.delay / speed - time.perf_counter(), 0))
+
+                record = event.record
+                if record.kind == AUDIO:
+                    data = '{"type":"response.audio.delta","delta":"' + base64.b64encode(record.payload).decode("ascii") + '"}'
+                    stats.audio_sent_at.append(time.perf_counter())
+                else:
+                    data = record.text()
+                    item_event = codec.decode_item_event(data)
+                    if item_event is not None and item_event.type == "response.output_item.done" and item_event.item.type == "function_call":
+                        function_calls_sent[item_event.item.call_id] = time.perf_counter()
+                await ws.send_str(data)
+                stats.upstream_events += 1
+            done.set()
+
+        reader = asyncio.create_task(read())
+        await write()
+        await reader
+        return ws
+
+    app = web.Application()
+    app.router.add_get("/openai/realtime", realtime_handler)
+    return app
+
+
+def _recorded_tools(session: RecordedSession, speed: float) -> dict[str, Tool]:
+    # Tools answer with the recorded results after the recorded time, so only the middle tier differs
+    def replay_tool(name: str):
+        async def target(args) -> ToolResult:
+            results = session.tool_results[name]
+            if not results:
+                return ToolResult("", ToolResultDirection.TO_SERVER)
+            result = results.popleft()
+            await asyncio.sleep(result["ms"] / 1000 / speed)
+            return ToolResult(
+                result["text"], ToolResultDirection.TO_CLIENT if result["to_client"] else ToolResultDirection.TO_SERVER
+            )
+
+        return target
+
+    return {name: Tool(replay_tool(name), {}) for name in session.tool_results}
+
+
+async def _drive_client(url: str, session: RecordedSession, stats: ReplayStats, speed: float, binary: bool, done: asyncio.Event):
+    if binary:
+        url += "?audio=binary"
+    async with aiohttp.ClientSession() as client:
+        async with client.ws_connect(url) as ws:
+
+            async def send():
+                start = time.perf_counter()
+                for record in session.client:
+                    await asyncio.sleep(max(start + record.offset / speed - time.perf_counter(), 0))
+                    if record.kind == AUDIO:
+                        if binary:
+                            await ws.send_bytes(record.payload)
+                        else:
+                            await ws.send_str(
+                                json.dumps({"type": "input_audio_buffer.append", "audio": base64.b64encode(record.payload).decode("ascii")})
+                            )
+                    else:
+                        await ws.send_str(record.text())
+                await done.wait()
+                # Gives the last forwarded events time to arrive
+                await asyncio.sleep(0.5)
+                await ws.close()
+
+            async def receive():
+                received_audio = 0
+                async for msg in ws:
+                    if msg.type == aiohttp.WSMsgType.BINARY:
+                        is_audio = True
+                    elif msg.type == aiohttp.WSMsgType.TEXT:
+                        is_audio = peek_event_type(msg.data) == "response.audio.delta"
+                    else:
+                        continue
+                    if is_audio and received_audio < len(stats.audio_sent_at):
+                        stats.forwarding_ms.append((time.perf_counter() - stats.audio_sent_at[received_audio]) * 1000)
+                        received_audio += 1
+
+            await asyncio.gather(send(), receive())
+
+
+async def _start_site(app: web.Application) -> tuple[web.AppRunner, int]:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, runner.addresses[0][1]
+
+
+async def replay(path: str, speed: float = 1.0, binary: bool = False) -> dict:
+    """Replays a recorded session through this checkout's RTMiddleTier against a stub upstream that
+    plays back the recorded realtime API events, and reports the middle tier's latencies."""
+    session = RecordedSession(path)
+    stats = ReplayStats()
+    done = asyncio.Event()
+
+    stub_runner, stub_port = await _start_site(_stub_upstream_app(session, stats, speed, done))
+    rtmt = RTMiddleTier(endpoint=f"http://127.0.0.1:{stub_port}", deployment="replay", credentials=AzureKeyCredential("replay"))
+    rtmt.tools = _recorded_tools(session, speed)
+    app = web.Application()
+    rtmt.attach_to_app(app, "/realtime")
+    middle_tier_runner, middle_tier_port = await _start_site(app)
+    try:
+        start = time.perf_counter()
+        await _drive_client(f"ws://127.0.0.1:{middle_tier_port}/realtime", session, stats, speed, binary, done)
+        stats.wall_seconds = time.perf_counter() - start
+    finally:
+        await middle_tier_runner.cleanup()
+        await stub_runner.cleanup()
+    return stats.report()
+
+
+def compare(baseline: dict, current: dict) -> None:
+    for key, value in current.items():
+        before = baseline.get(key)
+        if not isinstance(value, (int, float)) or not isinstance(before, (int, float)):
+            continue
+        change = f"{(value - before) / before * 100:+.1f}%" if before else ""
+        print(f"{key:28} {before:12.2f} {value:12.2f} {value - before:+12.2f} {change}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(
+        description="Replays a session recorded with RTMT_RECORD_DIR through the middle tier in this checkout against "
+        + "a stub realtime endpoint. Run it in two builds and pass the first report as --baseline to compare them."
+    )
+    parser.add_argument("recording")
+    parser.add_argument("--speed", type=float, default=1.0, help="playback speed, 2 replays twice as fast, inf as fast as possible")
+    parser.add_argument("--binary", action="store_true", help="use binary audio framing")
+    parser.add_argument("--out", help="write the report to this file")
+    parser.add_argument("--baseline", help="report of another build to compare against")
+    args = parser.parse_args()
+
+    report = asyncio.run(replay(args.recording, args.speed, args.binary))
+    print(json.dumps(report))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"{'':28} {'baseline':>12} {'current':>12} {'change':>12}")
+        compare(baseline, report)
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Optional
+
+from retrievers import Chunk, Retriever
+
+logger = logging.getLogger("voicerag")
+
+
+class KnowledgeBaseUnavailable(Exception):
+    """The retriever failed, timed out or is short-circuited by its breaker, and there was no
+    fallback result."""
+
+
+class ResilienceStats:
+    def __init__(self):
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.breaker_opens = 0
+        self.short_circuits = 0
+        self.fallbacks = 0
+        self.breaker_state = "closed"
+        self.hedge_delay_ms: Optional[float] = None
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "timeouts": self.timeouts,
+            "failures": self.failures,
+            "breaker_opens": self.breaker_opens,
+            "short_circuits": self.short_circuits,
+            "fallbacks": self.fallbacks,
+            "breaker_open": int(self.breaker_state != "closed"),
+            "hedge_delay_ms": self.hedge_delay_ms,
+        }
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures and fails calls fast for `reset_timeout`
+    seconds, then lets a single trial call through: its success closes the breaker, its failure
+    opens it again."""
+
+    def __init__(self, stats: ResilienceStats, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.stats = stats
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+    def allow(self) -> bool:
+        if self.stats.breaker_state == "open" and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self.stats.breaker_state = "half_open"
+        if self.stats.breaker_state == "closed":
+            return True
+        if self.stats.breaker_state == "half_open" and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self._trial_in_flight = False
+        self.stats.breaker_state = "closed"
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        self._trial_in_flight = False
+        if self.stats.breaker_state == "half_open" or self._failures >= self.failure_threshold:
+            if self.stats.breaker_state != "open":
+                logger.warning("Knowledge base circuit breaker opened after %d failures", self._failures)
+                self.stats.breaker_opens += 1
+            self.stats.breaker_state = "open"
+            self._opened_at = time.monotonic()
+
+    def release(self) -> None:
+        # A trial call that was cancelled decides nothing, the next call gets to try
+        self._trial_in_flight = False
+
+
+class ResilientRetriever(Retriever):
+    """Wraps a retriever so a slow or failing search backend can't stall a spoken answer.
+
+    Every call has a `deadline`. Once `min_samples` latencies are known, a call still running past
+    their p95 is hedged with a duplicate request and whichever answers first wins. Consecutive
+    failures open a circuit breaker that fails calls immediately. With `fallback_to_cached`, a failed
+    search returns the last result retrieved for the same query instead, however old. Whatever isn't
+    answered raises KnowledgeBaseUnavailable.
+    """
+
+    def __init__(
+        self,
+        retriever: Retriever,
+        deadline: float = 4.0,
+        hedge: bool = True,
+        min_hedge_delay: float = 0.05,
+        min_samples: int = 20,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30,
+        fallback_to_cached: bool = False,
+        fallback_size: int = 1024,
+    ):
+        self.retriever = retriever
+        self.cache_key = retriever.cache_key
+        self.deadline = deadline
+        self.hedge = hedge
+        self.min_hedge_delay = min_hedge_delay
+        self.min_samples = min_samples
+        self.fallback_to_cached = fallback_to_cached
+        self.fallback_size = fallback_size
+        self.stats = ResilienceStats()
+        self.breaker = CircuitBreaker(self.stats, failure_threshold, reset_timeout)
+        self._latencies: deque[float] = deque(maxlen=200)
+        self._last_results: OrderedDict[tuple, list[Chunk]] = OrderedDict()
+
+    def _hedge_delay(self) -> Optional[float]:
+        if not self.hedge or len(self._latencies) < self.min_samples:
+            return None
+        latencies = sorted(self._latencies)
+        delay = max(latencies[int(len(latencies) * 0.95) - 1], self.min_hedge_delay)
+        self.stats.hedge_delay_ms = delay * 1000
+        return delay
+
+    async def _timed(self, call: Callable[[], Awaitable[Any]]) -> Any:
+        start = time.perf_counter()
+        try:
+            return await call()
+        finally:
+            # Calls cut short by a hedge or the deadline are recorded too, as a lower bound, or the
+            # p95 would only ever see the fast calls and keep lowering the hedge delay
+            self._latencies.append(time.perf_counter() - start)
+
+    async def _hedged(self, call: Callable[[], Awaitable[Any]]) -> Any:
+        first = asyncio.ensure_future(self._timed(call))
+        tasks = [first]
+        try:
+            if (delay := self._hedge_delay()) is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    self.stats.hedges += 1
+                    tasks.append(asyncio.ensure_future(self._timed(call)))
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            # The first request to succeed wins, one failing leaves the other to finish
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.stats.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _call(self, call: Callable[[], Awaitable[Any]]) -> Any:
+        self.stats.calls += 1
+        if not self.breaker.allow():
+            self.stats.short_circuits += 1
+            raise KnowledgeBaseUnavailable("circuit breaker open")
+        try:
+            result = await asyncio.wait_for(self._hedged(call), self.deadline)
+        except asyncio.TimeoutError as e:
+            self.stats.timeouts += 1
+            self.breaker.record_failure()
+            raise KnowledgeBaseUnavailable(f"no answer within {self.deadline}s") from e
+        except asyncio.CancelledError:
+            self.breaker.release()
+            raise
+        except Exception as e:
+            self.stats.failures += 1
+            self.breaker.record_failure()
+            raise KnowledgeBaseUnavailable(str(e)) from e
+        self.breaker.record_success()
+        return result
+
+    async def search(self, query: str, top: int) -> list[Chunk]:
+        key = (" ".join(query.lower().split()), top)
+        try:
+            chunks = await self._call(lambda: self.retriever.search(query, top))
+        except KnowledgeBaseUnavailable as e:
+            if self.fallback_to_cached and (chunks := self._last_results.get(key)) is not None:
+                logger.warning("Search failed (%s), answering from the last result for the same query", e)
+                self.stats.fallbacks += 1
+                return chunks
+            raise
+        if self.fallback_to_cached:
+            self._last_results[key] = chunks
+            self._last_results.move_to_end(key)
+            while len(self._last_results) > self.fallback_size:
+                self._last_results.popitem(last=False)
+        return chunks
+
+    async def lookup(self, ids: list[str]) -> dict[str, tuple[str, str]]:
+        return await self._call(lambda: self.retriever.lookup(ids))
+
+    async def close(self) -> None:
+        await self.retriever.close()
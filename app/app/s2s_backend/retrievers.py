@@ -0,0 +1,119 @@
+from typing import Awaitable, Callable, Optional
+
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import VectorizableTextQuery, VectorizedQuery
+
+# Chunks are passed around as (identifier, title, content, parent identifier), the parent being the
+# document the chunk was split from when the index records it
+Chunk = tuple[str, str, str, Optional[str]]
+
+
+class Retriever:
+    """Backend for the search and report_grounding tools."""
+
+    # Everything about the backend that changes search results, part of the result cache key
+    cache_key: tuple = ()
+
+    async def search(self, query: str, top: int) -> list[Chunk]:
+        raise NotImplementedError
+
+    async def lookup(self, ids: list[str]) -> dict[str, tuple[str, str]]:
+        # Returns (title, content) for the ids that exist, unknown ids are left out
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+class AzureSearchRetriever(Retriever):
+    def __init__(
+        self,
+        search_client: SearchClient,
+        semantic_configuration: str,
+        identifier_field: str,
+        content_field: str,
+        embedding_field: str,
+        title_field: str,
+        use_vector_query: bool,
+        parent_field: Optional[str] = None,
+        embedder: Optional[Callable[[str], Awaitable[list[float]]]] = None,
+    ):
+        self.search_client = search_client
+        self.semantic_configuration = semantic_configuration
+        self.identifier_field = identifier_field
+        self.content_field = content_field
+        self.embedding_field = embedding_field
+        self.title_field = title_field
+        self.use_vector_query = use_vector_query
+        self.parent_field = parent_field
+        # Embeds queries in the middle tier, instead of the search service calling the embedding
+        # deployment for every query
+        self.embedder = embedder
+        self.cache_key = (
+            "azure",
+            semantic_configuration,
+            identifier_field,
+            title_field,
+            content_field,
+            embedding_field,
+            use_vector_query,
+            parent_field,
+            getattr(embedder, "cache_key", None) if embedder is not None else None,
+        )
+
+    async def search(self, query: str, top: int) -> list[Chunk]:
+        # Hybrid + Reranking query using Azure AI Search
+        vector_queries = []
+        if self.use_vector_query and self.embedder is not None:
+            vector_queries.append(
+                VectorizedQuery(vector=await self.embedder(query), k_nearest_neighbors=50, fields=self.embedding_field)
+            )
+        elif self.use_vector_query:
+            vector_queries.append(
+                VectorizableTextQuery(text=query, k_nearest_neighbors=50, fields=self.embedding_field)
+            )
+        search_results = await self.search_client.search(
+            search_text=query,
+            query_type="semantic",
+            semantic_configuration_name=self.semantic_configuration,
+            top=top,
+            vector_queries=vector_queries,
+            select=", ".join(
+                [self.identifier_field, self.title_field, self.content_field]
+                + ([self.parent_field] if self.parent_field else [])
+            ),
+        )
+        return [
+            (
+                r[self.identifier_field],
+                r[self.title_field],
+                r[self.content_field],
+                r.get(self.parent_field) if self.parent_field else None,
+            )
+            async for r in search_results
+        ]
+
+    async def lookup(self, ids: list[str]) -> dict[str, tuple[str, str]]:
+        # Callers must only pass ids matching ragtools.KEY_PATTERN, they are used in a full lucene query
+        list = " OR ".join(ids)
+        # Use search instead of filter to align with how detailt integrated vectorization indexes
+        # are generated, where chunk_id is searchable with a keyword tokenizer, not filterable
+        search_results = await self.search_client.search(
+            search_text=list,
+            search_fields=[self.identifier_field],
+            select=[self.identifier_field, self.title_field, self.content_field],
+            top=len(ids),
+            query_type="full",
+        )
+
+        # If your index has a key field that's filterable but not searchable and with the keyword analyzer, you can
+        # use a filter instead (and you can remove the regex check in ragtools, just ensure you escape single quotes)
+        # search_results = await search_client.search(filter=f"search.in(chunk_id, '{list}')", select=["chunk_id", "title", "chunk"])
+
+        return {
+            r[self.identifier_field]: (r[self.title_field], r[self.content_field])
+            async for r in search_results
+        }
+
+    async def close(self) -> None:
+        await self.search_client.close()
@@ -1,16 +1,111 @@
 import asyncio
-import json
+import base64
 import logging
+import re
+import time
+from contextvars import ContextVar
 from enum import Enum
-from typing import Any, Callable, Optional
+from typing import Any, Awaitable, Callable, Optional
 
 import aiohttp
 from aiohttp import web
 from azure.core.credentials import AzureKeyCredential
-from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+from azure.identity import DefaultAzureCredential
+
+import codec
+from audio_codec import AudioCodec, InvalidAudioFrame, negotiate
+
+from flow import FlowPolicy, OutboundQueue
+from metrics import SessionTimeline, metrics
+from recorder import (
+    AUDIO,
+    CLIENT_IN,
+    TEXT,
+    TOOL_CALL,
+    TOOL_RESULT,
+    UPSTREAM_IN,
+    UPSTREAM_OUT,
+    SessionRecorder,
+)
+from silence import SilenceGate
+from tokens import TokenManager
+from upstream import UpstreamClient
+from warmpool import WarmPool
 
 logger = logging.getLogger("voicerag")
 
+# Only these event types are decoded and possibly rewritten, everything else (notably the large
+# base64 audio frames) is forwarded as the original string without a full JSON parse
+_TO_CLIENT_PROCESSED_EVENTS = frozenset(
+    [
+        "session.created",
+        "response.output_item.added",
+        "conversation.item.created",
+        "response.function_call_arguments.delta",
+        "response.function_call_arguments.done",
+        "response.output_item.done",
+        "response.audio_transcript.done",
+        "response.done",
+        "conversation.item.input_audio_transcription.completed",
+        "input_audio_buffer.committed",
+    ]
+)
+_TO_SERVER_PROCESSED_EVENTS = frozenset(["session.update"])
+
+# Both the realtime API and the browser client put "type" first, so a short anchored scan is enough.
+# Frames where it isn't the first key fall back to a full parse.
+_EVENT_TYPE_PATTERN = re.compile(r'\s*\{\s*"type"\s*:\s*"([^"\\]*)"')
+_EVENT_TYPE_SCAN_LIMIT = 128
+
+
+def peek_event_type(data: str) -> Optional[str]:
+    match = _EVENT_TYPE_PATTERN.match(data, 0, _EVENT_TYPE_SCAN_LIMIT)
+    return match.group(1) if match is not None else None
+
+
+# Clients that connect with ?audio=binary exchange raw PCM16 (or their negotiated codec) as binary
+# frames, the conversion to and from the base64 JSON events the realtime API expects happens only in
+# these functions
+_AUDIO_DELTA_MARKER = '"delta":"'
+_AUDIO_APPEND_MARKER = '"audio":"'
+
+
+def audio_append_event(pcm: bytes) -> str:
+    # base64 never needs JSON escaping, so the event can be assembled without encoding a dict
+    return (
+        '{"type":"input_audio_buffer.append","audio":"'
+        + base64.b64encode(pcm).decode("ascii")
+        + '"}'
+    )
+
+
+def _audio_field(data: str, marker: str, field: str) -> bytes:
+    start = data.find(marker)
+    if start < 0:
+        return base64.b64decode(codec.loads(data)[field])
+    start += len(marker)
+    return base64.b64decode(data[start : data.index('"', start)])
+
+
+def audio_delta_bytes(data: str) -> bytes:
+    return _audio_field(data, _AUDIO_DELTA_MARKER, "delta")
+
+
+def audio_append_bytes(data: str) -> bytes:
+    return _audio_field(data, _AUDIO_APPEND_MARKER, "audio")
+
+
+def audio_delta_event(data: str, audio: bytes) -> str:
+    # Swaps the payload of a response.audio.delta, leaving the rest of the frame untouched
+    start = data.find(_AUDIO_DELTA_MARKER)
+    if start < 0:
+        message = codec.loads(data)
+        message["delta"] = base64.b64encode(audio).decode("ascii")
+        return codec.dumps(message)
+    start += len(_AUDIO_DELTA_MARKER)
+    end = data.index('"', start)
+    return data[:start] + base64.b64encode(audio).decode("ascii") + data[end:]
+
 
 class ToolResultDirection(Enum):
     TO_SERVER = 1
@@ -28,16 +123,19 @@ class ToolResult:
     def to_text(self) -> str:
         if self.text is None:
             return ""
-        return self.text if type(self.text) == str else json.dumps(self.text)
+        return self.text if type(self.text) == str else codec.dumps(self.text)
 
 
 class Tool:
     target: Callable[..., ToolResult]
     schema: Any
+    # Seconds before a call is abandoned and reported as failed to the model, None uses the middle tier default
+    timeout: Optional[float]
 
-    def __init__(self, target: Any, schema: Any):
+    def __init__(self, target: Any, schema: Any, timeout: Optional[float] = None):
         self.target = target
         self.schema = schema
+        self.timeout = timeout
 
 
 class RTToolCall:
@@ -49,6 +147,51 @@ class RTToolCall:
         self.previous_id = previous_id
 
 
+class RTSession:
+    """State owned by a single browser connection, never shared across sessions."""
+
+    tools_pending: dict[str, RTToolCall]
+    tool_tasks: dict[str, asyncio.Task]
+    # Free-form per-session storage for tools, e.g. chunks already retrieved by search
+    tool_state: dict[str, Any]
+    # The user input item of the turn in progress, None between turns
+    input_item_id: Optional[str]
+    timeline: SessionTimeline
+    # Send queues towards the browser and the realtime service, set once the upstream is connected
+    to_client: Optional[OutboundQueue]
+    to_server: Optional[OutboundQueue]
+    recorder: Optional[SessionRecorder]
+
+    def __init__(self):
+        self.tools_pending = {}
+        self.tool_tasks = {}
+        self.tool_state = {}
+        self.input_item_id = None
+        self.timeline = SessionTimeline()
+        self.to_client = None
+        self.to_server = None
+        self.recorder = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def spawn(self, coro) -> asyncio.Task:
+        # Keeps a reference so tasks aren't garbage collected and can be cancelled with the session
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def cancel_tasks(self):
+        for task in list(self._tasks):
+            task.cancel()
+        self.tool_tasks.clear()
+
+
+# Set while a tool runs so tool implementations can reach the state of the session that called them
+current_session: ContextVar[Optional[RTSession]] = ContextVar(
+    "current_session", default=None
+)
+
+
 class RTMiddleTier:
     endpoint: str
     deployment: str
@@ -64,8 +207,19 @@ class RTMiddleTier:
     system_message: Optional[str] = None
     voice_choice: Optional[str] = "shimmer"
     api_version: str = "2024-10-01-preview"
-    _tools_pending = {}
-    _token_provider = None
+    tool_timeout: float = 10
+    # Seconds live sessions get to finish when the server shuts down before they are closed
+    drain_timeout: float = 30
+    # Byte budget and drop policy for each direction's send queue
+    flow_policy: FlowPolicy = FlowPolicy()
+    # Server VAD timing, the silence gate's pre-roll follows prefix_padding_ms
+    prefix_padding_ms: int = 300
+    silence_duration_ms: int = 200
+    # Inbound audio chunks quieter than this many dBFS are held back, None forwards everything
+    silence_gate_dbfs: Optional[float] = None
+    # Every session is recorded to a file in this directory for replay.py, None records nothing
+    record_directory: Optional[str] = None
+    _token_manager: Optional[TokenManager] = None
 
     def __init__(
         self,
@@ -73,9 +227,31 @@ class RTMiddleTier:
         deployment: str,
         credentials: AzureKeyCredential | DefaultAzureCredential,
         voice_choice: Optional[str] = None,
+        connector_limit: int = 0,
+        dns_cache_ttl: int = 300,
+        warm_pool_size: int = 0,
+        warm_pool_idle_timeout: float = 60,
+        upstream_connect_timeout: float = 10,
     ):
         self.endpoint = endpoint
         self.deployment = deployment
+        # Called with the text and input item id of every completed input transcription, as a session task
+        self.input_transcript_handlers: list[
+            Callable[[str, Optional[str]], Awaitable[None]]
+        ] = []
+        self._client_sockets: set[web.WebSocketResponse] = set()
+        self.upstream = UpstreamClient(
+            endpoint,
+            connector_limit=connector_limit,
+            dns_cache_ttl=dns_cache_ttl,
+            connect_timeout=upstream_connect_timeout,
+        )
+        if connector_limit and connector_limit <= warm_pool_size:
+            logger.warning(
+                "Upstream connector limit %d leaves no room for sessions beside %d warm pooled sockets",
+                connector_limit,
+                warm_pool_size,
+            )
         self.voice_choice = (
             voice_choice if voice_choice is not None else RTMiddleTier.voice_choice
         )
@@ -84,213 +260,577 @@ class RTMiddleTier:
         if isinstance(credentials, AzureKeyCredential):
             self.key = credentials.key
         else:
-            self._token_provider = get_bearer_token_provider(
+            self._token_manager = TokenManager(
                 credentials, "https://cognitiveservices.azure.com/.default"
             )
-            self._token_provider()  # Warm up during startup so we have a token cached when the first request arrives
+            self._token_manager.warm_up()  # Warm up during startup so we have a token cached when the first request arrives
+        # Upstream connections opened and configured ahead of time, handed to new sessions as they arrive
+        self.warm_pool: Optional[WarmPool] = None
+        if warm_pool_size > 0:
+            self.warm_pool = WarmPool(
+                self._connect_upstream,
+                self._session_update,
+                size=warm_pool_size,
+                idle_timeout=warm_pool_idle_timeout,
+            )
 
     async def _process_message_to_client(
         self,
         msg: str,
         client_ws: web.WebSocketResponse,
         server_ws: web.WebSocketResponse,
+        rt_session: RTSession,
     ) -> Optional[str]:
-        message = json.loads(msg.data)
-        # print("\nfrom server", message["type"])
-
+        event_type = peek_event_type(msg.data)
+        if event_type is None:
+            event_type = codec.loads(msg.data).get("type")
+        if event_type not in _TO_CLIENT_PROCESSED_EVENTS:
+            return msg.data
+
+        # Events are decoded into typed structures only as far as needed, and only the fields that
+        # change are rewritten
         updated_message = msg.data
-        if message is not None:
-            match message["type"]:
-                case "session.created":
-                    session = message["session"]
-                    session["instructions"] = ""
-                    session["tools"] = []
-                    session["voice"] = self.voice_choice
-                    session["tool_choice"] = "none"
-                    session["max_response_output_tokens"] = None
-                    updated_message = json.dumps(message)
-
-                case "response.output_item.added":
-                    if "item" in message and message["item"]["type"] == "function_call":
-                        updated_message = None
-
-                case "conversation.item.created":
-                    if "item" in message and message["item"]["type"] == "function_call":
-                        item = message["item"]
-                        if item["call_id"] not in self._tools_pending:
-                            self._tools_pending[item["call_id"]] = RTToolCall(
-                                item["call_id"], message["previous_item_id"]
-                            )
-                        updated_message = None
-                    elif (
-                        "item" in message
-                        and message["item"]["type"] == "function_call_output"
-                    ):
-                        updated_message = None
+        match event_type:
+            case "session.created":
+                updated_message = codec.rewrite_session_created(
+                    msg.data,
+                    {
+                        "instructions": "",
+                        "tools": [],
+                        "voice": self.voice_choice,
+                        "tool_choice": "none",
+                        "max_response_output_tokens": None,
+                    },
+                )
+
+            case "response.output_item.added":
+                event = codec.decode_item_event(msg.data)
+                if event is not None and event.item.type == "function_call":
+                    updated_message = None
 
-                case "response.function_call_arguments.delta":
+            case "conversation.item.created":
+                event = codec.decode_item_event(msg.data)
+                if event is not None and event.item.type == "function_call":
+                    item = event.item
+                    if item.call_id not in rt_session.tools_pending:
+                        rt_session.tools_pending[item.call_id] = RTToolCall(
+                            item.call_id, event.previous_item_id
+                        )
+                    updated_message = None
+                elif event is not None and event.item.type == "function_call_output":
                     updated_message = None
 
-                case "response.function_call_arguments.done":
+            case "response.function_call_arguments.delta":
+                updated_message = None
+
+            case "response.function_call_arguments.done":
+                updated_message = None
+
+            case "response.output_item.done":
+                event = codec.decode_item_event(msg.data)
+                if event is not None and event.item.type == "function_call":
+                    item = event.item
+                    # Run as a task so upstream events keep flowing to the client while the tool works
+                    rt_session.tool_tasks[item.call_id] = rt_session.spawn(
+                        self._run_tool(item, rt_session)
+                    )
                     updated_message = None
 
-                case "response.audio_transcript.done":
-                    transcript = message["transcript"]
-                    print("\n\noutput transcript:", transcript)
-
-                    if "item" in message and message["item"]["type"] == "function_call":
-                        item = message["item"]
-                        tool_call = self._tools_pending[message["item"]["call_id"]]
-                        tool = self.tools[item["name"]]
-                        args = item["arguments"]
-                        result = await tool.target(json.loads(args))
-                        await server_ws.send_json(
-                            {
-                                "type": "conversation.item.create",
-                                "item": {
-                                    "type": "function_call_output",
-                                    "call_id": item["call_id"],
-                                    "output": (
-                                        result.to_text()
-                                        if result.destination
-                                        == ToolResultDirection.TO_SERVER
-                                        else ""
-                                    ),
-                                },
-                            }
+            case "response.audio_transcript.done":
+                transcript = codec.decode_transcript(msg.data).transcript
+                print("\n\noutput transcript:", transcript)
+
+            case "response.done":
+                if len(rt_session.tools_pending) > 0:
+                    # Only the calls of this response are awaited, later responses start a fresh set
+                    tasks = list(rt_session.tool_tasks.values())
+                    rt_session.tools_pending.clear()
+                    rt_session.tool_tasks.clear()
+                    rt_session.spawn(
+                        self._create_response_after_tools(tasks, rt_session)
+                    )
+                else:
+                    # A response without tool calls ends the turn
+                    rt_session.input_item_id = None
+                updated_message = codec.strip_function_calls(msg.data) or msg.data
+
+            case "conversation.item.input_audio_transcription.completed":
+                event = codec.decode_transcript(msg.data)
+                print("\n\ninput transcript:", event.transcript)
+                for handler in self.input_transcript_handlers:
+                    rt_session.spawn(
+                        self._run_in_session(
+                            rt_session, handler, event.transcript, event.item_id
                         )
-                        if result.destination == ToolResultDirection.TO_CLIENT:
-                            # TODO: this will break clients that don't know about this extra message, rewrite
-                            # this to be a regular text message with a special marker of some sort
-                            await client_ws.send_json(
-                                {
-                                    "type": "extension.middle_tier_tool_response",
-                                    "previous_item_id": tool_call.previous_id,
-                                    "tool_name": item["name"],
-                                    "tool_result": result.to_text(),
-                                }
-                            )
-                        updated_message = None
-
-                case "response.done":
-                    if len(self._tools_pending) > 0:
-                        self._tools_pending.clear()  # Any chance tool calls could be interleaved across different outstanding responses?
-                        await server_ws.send_json({"type": "response.create"})
-                    if "response" in message:
-                        replace = False
-                        for i, output in enumerate(
-                            reversed(message["response"]["output"])
-                        ):
-                            if output["type"] == "function_call":
-                                message["response"]["output"].pop(i)
-                                replace = True
-                        if replace:
-                            updated_message = json.dumps(message)
-
-                case "conversation.item.input_audio_transcription.completed":
-                    transcript = message["transcript"]
-                    print("\n\ninput transcript:", transcript)
+                    )
+
+            case "input_audio_buffer.committed":
+                # Work started on a transcription only counts in the turn of the item it transcribes
+                rt_session.input_item_id = codec.loads(msg.data).get("item_id")
 
         return updated_message
 
+    async def _run_in_session(
+        self, rt_session: RTSession, handler: Callable[..., Awaitable], *args
+    ):
+        current_session.set(rt_session)
+        try:
+            await handler(*args)
+        except Exception:
+            logger.exception("Session handler %s failed", handler)
+
+    async def _run_tool(self, item: codec.Item, rt_session: RTSession):
+        current_session.set(rt_session)
+        start = time.perf_counter()
+        tool_call = rt_session.tools_pending.get(item.call_id)
+        tool = self.tools[item.name]
+        timeout = tool.timeout if tool.timeout is not None else self.tool_timeout
+        if rt_session.recorder is not None:
+            rt_session.recorder.record(
+                TOOL_CALL,
+                TEXT,
+                codec.dumps(
+                    {"call_id": item.call_id, "name": item.name, "arguments": item.arguments}
+                ),
+            )
+        try:
+            result = await asyncio.wait_for(
+                tool.target(codec.loads(item.arguments)), timeout
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Tool %s timed out after %ss", item.name, timeout)
+            result = ToolResult(
+                f"The {item.name} tool timed out, tell the user you couldn't complete the request.",
+                ToolResultDirection.TO_SERVER,
+            )
+        except Exception as e:
+            logger.exception("Tool %s failed", item.name)
+            result = ToolResult(
+                f"The {item.name} tool failed: {e}", ToolResultDirection.TO_SERVER
+            )
+
+        rt_session.to_server.put(
+            codec.dumps(
+                {
+                    "type": "conversation.item.create",
+                    "item": {
+                        "type": "function_call_output",
+                        "call_id": item.call_id,
+                        "output": (
+                            result.to_text()
+                            if result.destination == ToolResultDirection.TO_SERVER
+                            else ""
+                        ),
+                    },
+                }
+            ),
+            "conversation.item.create",
+        )
+        if result.destination == ToolResultDirection.TO_CLIENT:
+            # TODO: this will break clients that don't know about this extra message, rewrite
+            # this to be a regular text message with a special marker of some sort
+            rt_session.to_client.put(
+                codec.dumps(
+                    {
+                        "type": "extension.middle_tier_tool_response",
+                        "previous_item_id": (
+                            tool_call.previous_id if tool_call is not None else None
+                        ),
+                        "tool_name": item.name,
+                        "tool_result": result.to_text(),
+                    }
+                ),
+                "extension.middle_tier_tool_response",
+            )
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        metrics.observe("rtmt_tool_call_ms", elapsed_ms, tool=item.name)
+        if rt_session.recorder is not None:
+            rt_session.recorder.record(
+                TOOL_RESULT,
+                TEXT,
+                codec.dumps(
+                    {
+                        "call_id": item.call_id,
+                        "name": item.name,
+                        "text": result.to_text(),
+                        "to_client": result.destination == ToolResultDirection.TO_CLIENT,
+                        "ms": elapsed_ms,
+                    }
+                ),
+            )
+        rt_session.timeline.mark(f"{item.name} result sent")
+
+    async def _create_response_after_tools(
+        self, tasks: list[asyncio.Task], rt_session: RTSession
+    ):
+        # Every function call output has to be in the conversation before asking for the next response,
+        # the send queue keeps control events in order so the outputs go out first
+        await asyncio.gather(*tasks, return_exceptions=True)
+        rt_session.to_server.put('{"type":"response.create"}', "response.create")
+
     async def _process_message_to_server(
         self, msg: str, ws: web.WebSocketResponse
     ) -> Optional[str]:
-        message = json.loads(msg.data)
-        # print("\n from client", message["type"])
+        event_type = peek_event_type(msg.data)
+        if event_type is None:
+            event_type = codec.loads(msg.data).get("type")
+        if event_type not in _TO_SERVER_PROCESSED_EVENTS:
+            return msg.data
 
         updated_message = msg.data
-        if message is not None:
-            match message["type"]:
-                case "session.update":
-                    session = {}
-                    session["modalities"] = ["audio", "text"]
-                    session["instructions"] = self.system_message
-                    session["voice"] = self.voice_choice
-                    session["input_audio_format"] = "pcm16"
-                    session["output_audio_format"] = "pcm16"
-                    session["input_audio_transcription"] = {"model": "whisper-1"}
-                    session["turn_detection"] = {
-                        "type": "server_vad",
-                        "threshold": 0.5,
-                        "prefix_padding_ms": 300,
-                        "silence_duration_ms": 200,
-                    }
-                    session["temperature"] = 0.8
-                    session["max_response_output_tokens"] = "inf"
-                    session["tools"] = []
-                    message["session"] = session
-                    updated_message = json.dumps(message)
+        match event_type:
+            case "session.update":
+                updated_message = codec.rewrite_session_update(
+                    msg.data, self._session_config()
+                )
 
         return updated_message
 
-    async def _forward_messages(self, ws: web.WebSocketResponse, msg):
-        async with aiohttp.ClientSession(base_url=self.endpoint) as session:
-            params = {"api-version": self.api_version, "deployment": self.deployment}
-            headers = {}
-            if "x-ms-client-request-id" in ws.headers:
-                headers["x-ms-client-request-id"] = ws.headers["x-ms-client-request-id"]
-            if self.key is not None:
-                headers = {"api-key": self.key}
-            else:
-                headers = {
-                    "Authorization": f"Bearer {self._token_provider()}"
-                }  # NOTE: no async version of token provider, maybe refresh token on a timer?
-            async with session.ws_connect(
-                "/openai/realtime", headers=headers, params=params
-            ) as target_ws:
-
-                async def create_and_update_session(msg):
+    def _session_config(self) -> dict:
+        # Replaces whatever the client asked for, so every session runs with the same configuration
+        session = {}
+        session["modalities"] = ["audio", "text"]
+        session["instructions"] = self.system_message
+        session["voice"] = self.voice_choice
+        session["input_audio_format"] = "pcm16"
+        session["output_audio_format"] = "pcm16"
+        session["input_audio_transcription"] = {"model": "whisper-1"}
+        session["turn_detection"] = {
+            "type": "server_vad",
+            "threshold": 0.5,
+            "prefix_padding_ms": self.prefix_padding_ms,
+            "silence_duration_ms": self.silence_duration_ms,
+        }
+        session["temperature"] = 0.8
+        session["max_response_output_tokens"] = "inf"
+        session["tools"] = []
+        return session
+
+    def _session_update(self) -> str:
+        return codec.dumps({"type": "session.update", "session": self._session_config()})
+
+    async def _connect_upstream(
+        self, client_request_id: Optional[str] = None
+    ) -> aiohttp.ClientWebSocketResponse:
+        params = {"api-version": self.api_version, "deployment": self.deployment}
+        headers = {}
+        if client_request_id is not None:
+            headers["x-ms-client-request-id"] = client_request_id
+        if self.key is not None:
+            headers = {"api-key": self.key}
+        else:
+            headers = {
+                "Authorization": f"Bearer {await self._token_manager.bearer_token()}"
+            }
+        return await self.upstream.ws_connect(
+            "/openai/realtime", headers=headers, params=params
+        )
+
+    async def _forward_messages(
+        self,
+        ws: web.WebSocketResponse,
+        msg,
+        binary_audio: bool = False,
+        audio_codec: Optional[AudioCodec] = None,
+    ):
+        rt_session = RTSession()
+        warm = await self.warm_pool.acquire() if self.warm_pool is not None else None
+        if warm is not None:
+            target_ws = warm.ws
+            connected = rt_session.timeline.mark("upstream taken from warm pool")
+        else:
+            try:
+                target_ws = await self._connect_upstream(
+                    ws.headers.get("x-ms-client-request-id")
+                )
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                # Fails the session rather than leaving the client waiting on a full connector or an
+                # unreachable service
+                logger.warning("Could not connect to the realtime service: %r", e)
+                metrics.increment("rtmt_upstream_connect_failures_total")
+                await ws.close(
+                    code=aiohttp.WSCloseCode.TRY_AGAIN_LATER,
+                    message=b"Realtime service unavailable",
+                )
+                return
+            connected = rt_session.timeline.mark("upstream connected")
+        metrics.observe(
+            "rtmt_upstream_connect_ms", (connected - rt_session.timeline.start) * 1000
+        )
+
+        def close_over_budget(peer):
+            # A peer that can't keep up even with audio being dropped is closed instead of buffered
+            # without bound, closing either socket ends both forwarding loops
+            asyncio.create_task(
+                peer.close(
+                    code=aiohttp.WSCloseCode.POLICY_VIOLATION,
+                    message=b"Send queue over budget",
+                )
+            )
+
+        def close_on_send_error():
+            # Either socket failing ends the session, closing both ends both forwarding loops
+            for peer in (ws, target_ws):
+                asyncio.create_task(
+                    peer.close(
+                        code=aiohttp.WSCloseCode.INTERNAL_ERROR,
+                        message=b"Send failed",
+                    )
+                )
+
+        to_client = rt_session.to_client = OutboundQueue(
+            ws,
+            "to_client",
+            self.flow_policy,
+            lambda: close_over_budget(ws),
+            close_on_send_error,
+        )
+        to_server = rt_session.to_server = OutboundQueue(
+            target_ws,
+            "to_server",
+            self.flow_policy,
+            lambda: close_over_budget(ws),
+            close_on_send_error,
+        )
+        to_client.start()
+        to_server.start()
+        gate = None
+        if self.silence_gate_dbfs is not None:
+            gate = SilenceGate(
+                self.silence_gate_dbfs, pre_roll_ms=self.prefix_padding_ms
+            )
+
+        recorder = None
+        if self.record_directory is not None:
+            recorder = rt_session.recorder = SessionRecorder.in_directory(
+                self.record_directory
+            )
+
+            def record_upstream_control(data, event_type):
+                if event_type != "input_audio_buffer.append":
+                    recorder.record(UPSTREAM_OUT, TEXT, data)
+
+            to_server.tap = record_upstream_control
+            recorder.record(CLIENT_IN, TEXT, msg.data)
+
+        def drop_invalid_frame(error: Exception):
+            # A bad frame costs a moment of audio, not the session
+            logger.warning("Dropping client audio frame: %r", error)
+            metrics.increment("rtmt_invalid_audio_frames_total")
+
+        def send_client_audio(data: bytes):
+            if audio_codec is not None:
+                try:
+                    data = audio_codec.decode(data)
+                except InvalidAudioFrame as e:
+                    drop_invalid_frame(e)
+                    return
+            send_audio(data)
+
+        def send_audio(pcm: bytes):
+            if recorder is not None:
+                recorder.record(CLIENT_IN, AUDIO, pcm)
+            for chunk in gate.process(pcm) if gate is not None else (pcm,):
+                to_server.put(audio_append_event(chunk), "input_audio_buffer.append")
+
+        async def create_and_update_session(msg):
+            if warm is not None:
+                # The pooled connection already went through session.created and the server-enforced
+                # session.update, replay what the client would have received instead
+                session_created = await self._process_message_to_client(
+                    aiohttp.WSMessage(aiohttp.WSMsgType.TEXT, warm.session_created, None),
+                    ws,
+                    target_ws,
+                    rt_session,
+                )
+                to_client.put(session_created, "session.created")
+                if recorder is not None:
+                    recorder.record(UPSTREAM_IN, TEXT, warm.session_created)
+                client_updates = peek_event_type(msg.data) == "session.update"
+                if client_updates:
+                    to_client.put(warm.session_updated, "session.updated")
+                    if recorder is not None:
+                        recorder.record(UPSTREAM_IN, TEXT, warm.session_updated)
+                # Events the service sent while the connection sat in the pool
+                for data in warm.backlog:
+                    if recorder is not None:
+                        recorder.record(UPSTREAM_IN, TEXT, data)
+                    new_msg = await self._process_message_to_client(
+                        aiohttp.WSMessage(aiohttp.WSMsgType.TEXT, data, None),
+                        ws,
+                        target_ws,
+                        rt_session,
+                    )
+                    if new_msg is not None:
+                        to_client.put(new_msg, peek_event_type(data))
+                if client_updates:
+                    return
+            new_msg = await self._process_message_to_server(msg, ws)
+            if new_msg is not None:
+                to_server.put(new_msg, "session.update")
+
+        async def from_client_to_server():
+            async for msg in ws:
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    event_type = peek_event_type(msg.data)
+                    if event_type == "input_audio_buffer.append" and (
+                        audio_codec is not None or gate is not None or recorder is not None
+                    ):
+                        try:
+                            data = audio_append_bytes(msg.data)
+                        except (ValueError, KeyError, TypeError) as e:
+                            # Bad JSON or base64 (both ValueErrors), or no audio string in the event
+                            drop_invalid_frame(e)
+                            continue
+                        send_client_audio(data)
+                        continue
+                    if recorder is not None:
+                        recorder.record(CLIENT_IN, TEXT, msg.data)
+                    if event_type == "input_audio_buffer.clear" and gate is not None:
+                        gate.reset()
                     new_msg = await self._process_message_to_server(msg, ws)
                     if new_msg is not None:
-                        await target_ws.send_str(new_msg)
-
-                async def from_client_to_server():
-                    async for msg in ws:
-                        if msg.type == aiohttp.WSMsgType.TEXT:
-                            new_msg = await self._process_message_to_server(msg, ws)
-                            if new_msg is not None:
-                                await target_ws.send_str(new_msg)
-                        else:
-                            print("\nError: unexpected message type:", msg.type)
-
-                    # Means it is gracefully closed by the client then time to close the target_ws
-                    if target_ws:
-                        print("\nClosing OpenAI's realtime socket connection.")
-                        await target_ws.close()
-
-                async def from_server_to_client():
-                    async for msg in target_ws:
-                        if msg.type == aiohttp.WSMsgType.TEXT:
-                            new_msg = await self._process_message_to_client(
-                                msg, ws, target_ws
-                            )
-                            if new_msg is not None:
-                                await ws.send_str(new_msg)
+                        to_server.put(new_msg, event_type or peek_event_type(new_msg))
+                elif binary_audio and msg.type == aiohttp.WSMsgType.BINARY:
+                    send_client_audio(msg.data)
+                else:
+                    print("\nError: unexpected message type:", msg.type)
+
+            # Means it is gracefully closed by the client then time to close the target_ws
+            if target_ws:
+                print("\nClosing OpenAI's realtime socket connection.")
+                await target_ws.close()
+
+        async def from_server_to_client():
+            async for msg in target_ws:
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    event_type = peek_event_type(msg.data)
+                    rt_session.timeline.observe(event_type)
+                    if event_type == "response.audio.delta" and (
+                        binary_audio or audio_codec is not None or recorder is not None
+                    ):
+                        audio = audio_delta_bytes(msg.data)
+                        if recorder is not None:
+                            recorder.record(UPSTREAM_IN, AUDIO, audio)
+                        if audio_codec is not None:
+                            audio = audio_codec.encode(audio)
+                        if binary_audio:
+                            to_client.put(audio, event_type)
+                        elif audio_codec is not None:
+                            to_client.put(audio_delta_event(msg.data, audio), event_type)
                         else:
-                            print("\nError: unexpected message type:", msg.type)
-
-                try:
-                    await create_and_update_session(msg)
-                    await asyncio.gather(
-                        from_client_to_server(), from_server_to_client()
+                            to_client.put(msg.data, event_type)
+                        continue
+                    if recorder is not None:
+                        recorder.record(UPSTREAM_IN, TEXT, msg.data)
+                    new_msg = await self._process_message_to_client(
+                        msg, ws, target_ws, rt_session
                     )
-                except ConnectionResetError:
-                    # Ignore the errors resulting from the client disconnecting the socket
-                    pass
+                    if new_msg is not None:
+                        to_client.put(new_msg, event_type)
+                else:
+                    print("\nError: unexpected message type:", msg.type)
+
+        try:
+            await create_and_update_session(msg)
+            await asyncio.gather(
+                from_client_to_server(), from_server_to_client()
+            )
+        except ConnectionResetError:
+            # Ignore the errors resulting from the client disconnecting the socket
+            pass
+        finally:
+            rt_session.cancel_tasks()
+            await to_client.close()
+            await to_server.close()
+            await target_ws.close()
+            logger.debug("Session timeline: %s", rt_session.timeline.summary())
+            logger.debug(
+                "Send queues: to_client %s, to_server %s",
+                to_client.stats(),
+                to_server.stats(),
+            )
+            if recorder is not None:
+                recorder.close()
+                logger.info("Session recorded to %s", recorder.path)
+            if gate is not None:
+                logger.debug("Silence gate: %s", gate.stats())
+                metrics.increment(
+                    "rtmt_silence_gate_forwarded_bytes_total", gate.forwarded_bytes
+                )
+                metrics.increment(
+                    "rtmt_silence_gate_dropped_bytes_total", gate.dropped_bytes
+                )
 
     async def _websocket_handler(self, request: web.Request):
         ws = web.WebSocketResponse()
         await ws.prepare(request)
-        async for msg in ws:
-            if msg.type == aiohttp.WSMsgType.TEXT:
-                if msg.data == "ping":
-                    await ws.send_str("pong")
-                else:
-                    await self._forward_messages(ws, msg)
-            elif msg.type == aiohttp.WSMsgType.ERROR:
-                logger.error("ws connection closed with exception %s" % ws.exception())
+        binary_audio = request.query.get("audio") == "binary"
+        audio_codec = None
+        if "codec" in request.query:
+            # The client offers codecs in order of preference and learns which one was picked, the
+            # realtime API itself always gets PCM16
+            audio_codec = negotiate(request.query["codec"])
+            await ws.send_str(
+                codec.dumps(
+                    {
+                        "type": "extension.audio_codec",
+                        "codec": audio_codec.name if audio_codec is not None else "pcm16",
+                    }
+                )
+            )
+        self._client_sockets.add(ws)
+        try:
+            async for msg in ws:
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    if msg.data == "ping":
+                        await ws.send_str("pong")
+                    else:
+                        await self._forward_messages(
+                            ws, msg, binary_audio, audio_codec
+                        )
+                elif msg.type == aiohttp.WSMsgType.ERROR:
+                    logger.error("ws connection closed with exception %s" % ws.exception())
+        finally:
+            self._client_sockets.discard(ws)
         return ws
 
+    async def _on_startup(self, app: web.Application):
+        await self.upstream.start()
+        if self._token_manager is not None:
+            await self._token_manager.start()
+        if self.warm_pool is not None:
+            self.warm_pool.start()
+
+    async def _on_shutdown(self, app: web.Application):
+        if self.warm_pool is not None:
+            logger.info("Warm pool stats: %s", self.warm_pool.stats.as_dict())
+            await self.warm_pool.close()
+        # The listener is already closed at this point, live sessions get a chance to finish
+        if self._client_sockets:
+            logger.info("Draining %d realtime sessions", len(self._client_sockets))
+            deadline = time.monotonic() + self.drain_timeout
+            while self._client_sockets and time.monotonic() < deadline:
+                await asyncio.sleep(0.5)
+        for ws in list(self._client_sockets):
+            await ws.close(
+                code=aiohttp.WSCloseCode.GOING_AWAY, message=b"Server shutting down"
+            )
+
+    async def _on_cleanup(self, app: web.Application):
+        logger.info("Upstream connection timings: %s", self.upstream.timings.as_dict())
+        await self.upstream.close()
+        if self._token_manager is not None:
+            logger.info("Token refresh metrics: %s", self._token_manager.metrics.as_dict())
+            await self._token_manager.close()
+
     def attach_to_app(self, app, path):
         app.router.add_get(path, self._websocket_handler)
+        app.on_startup.append(self._on_startup)
+        app.on_shutdown.append(self._on_shutdown)
+        app.on_cleanup.append(self._on_cleanup)
+        metrics.add_collector("rtmt_upstream", self.upstream.timings.as_dict)
+        if self.warm_pool is not None:
+            metrics.add_collector("rtmt_warm_pool", self.warm_pool.stats.as_dict)
+        if self._token_manager is not None:
+            metrics.add_collector("rtmt_token", self._token_manager.metrics.as_dict)
@@ -0,0 +1,144 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from typing import Optional
+
+from aiohttp import web
+
+from metrics import metrics, metrics_handler
+
+logger = logging.getLogger("voicerag")
+
+
+async def _create_worker_app(host: str, metrics_port: Optional[int]) -> web.Application:
+    # Imported in the worker so every process builds its own app, credentials and upstream pool
+    from app import create_app
+
+    app = await create_app()
+    if metrics_port is None:
+        return app
+
+    # Metrics are per process and /metrics on the shared port answers from whichever worker the kernel
+    # picked, so each worker also serves its own on a port of its own
+    metrics_app = web.Application()
+    metrics_app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(metrics_app)
+
+    async def start_metrics(app):
+        await runner.setup()
+        await web.TCPSite(runner, host, metrics_port).start()
+
+    async def stop_metrics(app):
+        await runner.cleanup()
+
+    app.on_startup.append(start_metrics)
+    app.on_cleanup.append(stop_metrics)
+    return app
+
+
+def _run_worker(
+    host: str, port: int, sock: Optional[socket.socket], drain_timeout: float, index: int, metrics_port: Optional[int]
+):
+    # Forked with the parent's handlers, which would stop the whole pool, until run_app installs its own
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    logging.basicConfig(level=logging.INFO)
+    logger.info("Worker %d starting as worker %d", os.getpid(), index)
+    os.environ["RTMT_DRAIN_TIMEOUT"] = str(drain_timeout)
+    metrics.labels["worker"] = str(index)
+    app = _create_worker_app(host, metrics_port)
+    # aiohttp turns SIGTERM into a graceful shutdown, RTMiddleTier drains its sessions on shutdown
+    shutdown_timeout = drain_timeout + 5
+    if sock is not None:
+        web.run_app(app, sock=sock, shutdown_timeout=shutdown_timeout, print=None)
+    else:
+        web.run_app(app, host=host, port=port, reuse_port=True, shutdown_timeout=shutdown_timeout, print=None)
+
+
+class WorkerPool:
+    """Runs N copies of the backend sharing one port and respawns workers that die.
+
+    Workers each bind with SO_REUSEPORT where available so the kernel balances connections between
+    them, otherwise they inherit a socket bound once in the parent. Every worker labels its metrics
+    with its index and, given a `metrics_port`, also serves them on `metrics_port + index`.
+    """
+
+    def __init__(self, host: str, port: int, workers: int, drain_timeout: float, metrics_port: Optional[int] = None):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.drain_timeout = drain_timeout
+        self.metrics_port = metrics_port
+        self._stopping = False
+        self._processes: list[multiprocessing.Process] = []
+        self._sock: Optional[socket.socket] = None
+        if not hasattr(socket, "SO_REUSEPORT"):
+            self._sock = socket.create_server((host, port), backlog=1024)
+            self._sock.set_inheritable(True)
+        # Fork so a pre-bound socket is inherited as is
+        self._context = multiprocessing.get_context("fork")
+
+    def _spawn(self, index: int) -> multiprocessing.Process:
+        # A respawned worker takes over the index, and so the metrics port, of the one it replaces
+        metrics_port = self.metrics_port + index if self.metrics_port is not None else None
+        process = self._context.Process(
+            target=_run_worker,
+            args=(self.host, self.port, self._sock, self.drain_timeout, index, metrics_port),
+            daemon=False,
+        )
+        process.start()
+        return process
+
+    def _stop(self, signum, frame):
+        if self._stopping:
+            return
+        self._stopping = True
+        logger.info("Stopping %d workers, draining sessions for up to %ss", len(self._processes), self.drain_timeout)
+        for process in self._processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        self._processes = [self._spawn(i) for i in range(self.workers)]
+        logger.info("Serving on %s:%d with %d workers", self.host, self.port, self.workers)
+
+        while not self._stopping:
+            for i, process in enumerate(self._processes):
+                if not process.is_alive() and not self._stopping:
+                    logger.warning("Worker %d exited with code %s, respawning", process.pid, process.exitcode)
+                    self._processes[i] = self._spawn(i)
+            time.sleep(1)
+
+        deadline = time.monotonic() + self.drain_timeout + 10
+        for process in self._processes:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning("Worker %d did not drain in time, killing it", process.pid)
+                process.kill()
+                process.join()
+        if self._sock is not None:
+            self._sock.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Serve the backend from several worker processes on one port")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("RTMT_WORKERS") or os.cpu_count() or 1))
+    parser.add_argument("--drain-timeout", type=float, default=30, help="seconds live sessions get to finish on SIGTERM")
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=int(os.environ.get("RTMT_METRICS_PORT") or 0) or None,
+        help="first of the per-worker /metrics ports, worker i serves on this port + i",
+    )
+    args = parser.parse_args()
+    WorkerPool(args.host, args.port, args.workers, args.drain_timeout, args.metrics_port).run()
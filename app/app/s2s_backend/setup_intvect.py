@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 import os
@@ -5,6 +6,8 @@ import subprocess
 
 from azure.core.exceptions import ResourceExistsError
 from azure.identity import AzureDeveloperCliCredential
+from azure.identity.aio import AzureDeveloperCliCredential as AsyncAzureDeveloperCliCredential
+from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes import SearchIndexClient, SearchIndexerClient
 from azure.search.documents.indexes.models import (
     AzureOpenAIEmbeddingSkill,
@@ -38,10 +41,15 @@ from azure.search.documents.indexes.models import (
     VectorSearchAlgorithmMetric,
     VectorSearchProfile,
 )
-from azure.storage.blob import BlobServiceClient
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
 from dotenv import load_dotenv
 from rich.logging import RichHandler
 
+from blob_sync import MANIFEST_FILE, BlobSync, Manifest
+from embeddings import AzureOpenAIEmbedder
+from ingest import ingest_directory
+from tokens import TokenManager
+
 
 def load_azd_env():
     """Get path to current azd env file and load file using python-dotenv"""
@@ -59,21 +67,22 @@ def load_azd_env():
     load_dotenv(env_file_path, override=True)
 
 
-def setup_index(azure_credential, index_name, azure_search_endpoint, azure_storage_connection_string, azure_storage_container, azure_openai_embedding_endpoint, azure_openai_embedding_deployment, azure_openai_embedding_model, azure_openai_embeddings_dimensions):
+def setup_index(azure_credential, index_name, azure_search_endpoint, azure_storage_connection_string, azure_storage_container, azure_openai_embedding_endpoint, azure_openai_embedding_deployment, azure_openai_embedding_model, azure_openai_embeddings_dimensions, integrated_vectorization=True):
     index_client = SearchIndexClient(azure_search_endpoint, azure_credential)
     indexer_client = SearchIndexerClient(azure_search_endpoint, azure_credential)
 
-    data_source_connections = indexer_client.get_data_source_connections()
-    if index_name in [ds.name for ds in data_source_connections]:
-        logger.info(f"Data source connection {index_name} already exists, not re-creating")
-    else:
-        logger.info(f"Creating data source connection: {index_name}")
-        indexer_client.create_data_source_connection(
-            data_source_connection=SearchIndexerDataSourceConnection(
-                name=index_name, 
-                type=SearchIndexerDataSourceType.AZURE_BLOB,
-                connection_string=azure_storage_connection_string,
-                container=SearchIndexerDataContainer(name=azure_storage_container)))
+    if integrated_vectorization:
+        data_source_connections = indexer_client.get_data_source_connections()
+        if index_name in [ds.name for ds in data_source_connections]:
+            logger.info(f"Data source connection {index_name} already exists, not re-creating")
+        else:
+            logger.info(f"Creating data source connection: {index_name}")
+            indexer_client.create_data_source_connection(
+                data_source_connection=SearchIndexerDataSourceConnection(
+                    name=index_name, 
+                    type=SearchIndexerDataSourceType.AZURE_BLOB,
+                    connection_string=azure_storage_connection_string,
+                    container=SearchIndexerDataContainer(name=azure_storage_container)))
 
     index_names = [index.name for index in index_client.list_indexes()]
     if index_name in index_names:
@@ -126,6 +135,10 @@ def setup_index(azure_credential, index_name, azure_search_endpoint, azure_stora
             )
         )
 
+    if not integrated_vectorization:
+        # Documents are chunked, embedded and uploaded by ingest.py instead of a skillset and indexer
+        return
+
     skillsets = indexer_client.get_skillsets()
     if index_name in [skillset.name for skillset in skillsets]:
         logger.info(f"Skillset {index_name} already exists, not re-creating")
@@ -184,28 +197,33 @@ def setup_index(azure_credential, index_name, azure_search_endpoint, azure_stora
             )
         )
 
-def upload_documents(azure_credential, indexer_name, azure_search_endpoint, azure_storage_endpoint, azure_storage_container):
-    indexer_client = SearchIndexerClient(azure_search_endpoint, azure_credential)
-    # Upload the documents in /data folder to the blob storage container
-    blob_client = BlobServiceClient(
-        account_url=azure_storage_endpoint, credential=azure_credential,
-        max_single_put_size=4 * 1024 * 1024
-    )
-    container_client = blob_client.get_container_client(azure_storage_container)
-    if not container_client.exists():
-        container_client.create_container()
-    existing_blobs = [blob.name for blob in container_client.list_blobs()]
+async def sync_documents(azure_credential, azure_storage_endpoint, azure_storage_container, concurrency):
+    # Upload the documents in /data folder to the blob storage container, only those whose content changed
+    async with AsyncBlobServiceClient(account_url=azure_storage_endpoint, credential=azure_credential) as blob_client:
+        container_client = blob_client.get_container_client(azure_storage_container)
+        manifest = Manifest(MANIFEST_FILE, f"{azure_storage_endpoint.rstrip('/')}/{azure_storage_container}")
+        stats = await BlobSync(container_client, manifest, concurrency=concurrency).sync("data")
+    await azure_credential.close()
+    logger.info("Blob sync: %(uploaded)d uploaded, %(skipped)d unchanged, %(failed)d failed, %(uploaded_bytes)d bytes in %(seconds).1fs (%(mb_per_second).2f MB/s)", stats.as_dict())
+    return stats
 
-    # Open each file in /data folder
-    for file in os.scandir("data"):
-        with open(file.path, "rb") as opened_file:
-            filename = os.path.basename(file.path)
-            # Check if blob already exists
-            if filename in existing_blobs:
-                logger.info("Blob already exists, skipping file: %s", filename)
-            else:
-                logger.info("Uploading blob for file: %s", filename)
-                blob_client = container_client.upload_blob(filename, opened_file, overwrite=True)
+async def ingest_documents(azure_credential, async_azure_credential, index_name, azure_search_endpoint, azure_openai_embedding_endpoint, azure_openai_embedding_deployment, azure_openai_embeddings_dimensions):
+    # Chunk and embed the documents in /data folder locally, only new or changed chunks are embedded and uploaded
+    embedder = AzureOpenAIEmbedder(
+        endpoint=azure_openai_embedding_endpoint,
+        deployment=azure_openai_embedding_deployment,
+        credentials=TokenManager(azure_credential, "https://cognitiveservices.azure.com/.default"),
+        dimensions=azure_openai_embeddings_dimensions)
+    try:
+        async with SearchClient(azure_search_endpoint, index_name, async_azure_credential) as search_client:
+            await ingest_directory("data", embedder, search_client, index_name)
+    finally:
+        await embedder.close()
+        await async_azure_credential.close()
+
+def upload_documents(azure_credential, async_azure_credential, indexer_name, azure_search_endpoint, azure_storage_endpoint, azure_storage_container, concurrency=8):
+    indexer_client = SearchIndexerClient(azure_search_endpoint, azure_credential)
+    asyncio.run(sync_documents(async_azure_credential, azure_storage_endpoint, azure_storage_container, concurrency))
 
     # Start the indexer
     try:
@@ -242,6 +260,9 @@ if __name__ == "__main__":
     AZURE_STORAGE_CONTAINER = os.environ["AZURE_STORAGE_CONTAINER"]
 
     azure_credential = AzureDeveloperCliCredential(tenant_id=os.environ["AZURE_TENANT_ID"], process_timeout=60)
+    async_azure_credential = AsyncAzureDeveloperCliCredential(tenant_id=os.environ["AZURE_TENANT_ID"], process_timeout=60)
+
+    local_ingestion = os.environ.get("AZURE_SEARCH_LOCAL_INGESTION") == "true"
 
     setup_index(azure_credential,
         index_name=AZURE_SEARCH_INDEX, 
@@ -251,10 +272,21 @@ if __name__ == "__main__":
         azure_openai_embedding_endpoint=AZURE_OPENAI_EMBEDDING_ENDPOINT,
         azure_openai_embedding_deployment=AZURE_OPENAI_EMBEDDING_DEPLOYMENT,
         azure_openai_embedding_model=AZURE_OPENAI_EMBEDDING_MODEL,
-        azure_openai_embeddings_dimensions=EMBEDDINGS_DIMENSIONS)
+        azure_openai_embeddings_dimensions=EMBEDDINGS_DIMENSIONS,
+        integrated_vectorization=not local_ingestion)
 
-    upload_documents(azure_credential,
+    if local_ingestion:
+        asyncio.run(ingest_documents(azure_credential, async_azure_credential,
+            index_name=AZURE_SEARCH_INDEX,
+            azure_search_endpoint=AZURE_SEARCH_ENDPOINT,
+            azure_openai_embedding_endpoint=AZURE_OPENAI_EMBEDDING_ENDPOINT,
+            azure_openai_embedding_deployment=AZURE_OPENAI_EMBEDDING_DEPLOYMENT,
+            azure_openai_embeddings_dimensions=EMBEDDINGS_DIMENSIONS))
+        exit()
+
+    upload_documents(azure_credential, async_azure_credential,
         indexer_name=AZURE_SEARCH_INDEX,
         azure_search_endpoint=AZURE_SEARCH_ENDPOINT,
         azure_storage_endpoint=AZURE_STORAGE_ENDPOINT,
-        azure_storage_container=AZURE_STORAGE_CONTAINER)
\ No newline at end of file
+        azure_storage_container=AZURE_STORAGE_CONTAINER,
+        concurrency=int(os.environ.get("AZURE_STORAGE_UPLOAD_CONCURRENCY") or 8))
\ No newline at end of file
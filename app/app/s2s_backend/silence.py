@@ -0,0 +1,73 @@
+from collections import deque
+
+import numpy as np
+
+SAMPLE_RATE = 24000
+
+
+class SilenceGate:
+    """Per-session energy gate over inbound PCM16 chunks.
+
+    Chunks quieter than `threshold_dbfs` are held back instead of being sent upstream. The most recent
+    `pre_roll_ms` of them are kept and sent ahead of the first loud chunk so the server VAD still gets
+    its prefix padding, and audio keeps flowing for `hangover_ms` after the last loud chunk so the
+    server VAD sees the silence that ends the turn.
+    """
+
+    def __init__(
+        self,
+        threshold_dbfs: float = -45.0,
+        pre_roll_ms: int = 300,
+        hangover_ms: int = 1000,
+        sample_rate: int = SAMPLE_RATE,
+    ):
+        # Compared against the mean square of the samples, which saves a sqrt and a log per chunk
+        self.threshold_power = (32768 * 10 ** (threshold_dbfs / 20)) ** 2
+        self.pre_roll_bytes = sample_rate * 2 * pre_roll_ms // 1000
+        self.hangover_bytes = sample_rate * 2 * hangover_ms // 1000
+        self.forwarded_bytes = 0
+        self.dropped_bytes = 0
+        self._pre_roll: deque[bytes] = deque()
+        self._pre_roll_size = 0
+        # Bytes of audio still to forward after the last loud chunk
+        self._hangover_left = 0
+
+    def _is_loud(self, pcm: bytes) -> bool:
+        samples = np.frombuffer(pcm, dtype="<i2", count=len(pcm) // 2).astype(np.float32)
+        return samples.size > 0 and float(np.dot(samples, samples)) / samples.size >= self.threshold_power
+
+    def process(self, pcm: bytes) -> list[bytes]:
+        """Returns the chunks to forward upstream, oldest first, possibly none."""
+        if self._is_loud(pcm):
+            self._hangover_left = self.hangover_bytes
+            chunks = list(self._pre_roll)
+            chunks.append(pcm)
+            self.forwarded_bytes += self._pre_roll_size + len(pcm)
+            # The pre-roll was counted as dropped when it was held back
+            self.dropped_bytes -= self._pre_roll_size
+            self.reset()
+            return chunks
+        if self._hangover_left > 0:
+            self._hangover_left -= len(pcm)
+            self.forwarded_bytes += len(pcm)
+            return [pcm]
+
+        self.dropped_bytes += len(pcm)
+        self._pre_roll.append(pcm)
+        self._pre_roll_size += len(pcm)
+        while self._pre_roll and self._pre_roll_size - len(self._pre_roll[0]) >= self.pre_roll_bytes:
+            self._pre_roll_size -= len(self._pre_roll.popleft())
+        return []
+
+    def reset(self) -> None:
+        self._pre_roll.clear()
+        self._pre_roll_size = 0
+
+    def stats(self) -> dict:
+        total = self.forwarded_bytes + self.dropped_bytes
+        return {
+            "forwarded_bytes": self.forwarded_bytes,
+            "dropped_bytes": self.dropped_bytes,
+            "dropped_ratio": self.dropped_bytes / total if total else 0.0,
+        }
+
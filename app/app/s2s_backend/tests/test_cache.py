@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+from cache import AsyncLRUCache
+
+
+def test_get_or_load_coalesces_concurrent_loads():
+    async def main():
+        cache = AsyncLRUCache()
+        calls = 0
+
+        async def load():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "value"
+
+        results = await asyncio.gather(*(cache.get_or_load("key", load) for _ in range(5)))
+        assert results == ["value"] * 5
+        assert calls == 1
+        assert cache.stats.misses == 1 and cache.stats.coalesced == 4
+        assert await cache.get_or_load("key", load) == "value"
+        assert cache.stats.hits == 1
+
+    asyncio.run(main())
+
+
+def test_cancelled_caller_does_not_cancel_the_shared_load():
+    async def main():
+        cache = AsyncLRUCache()
+        started = asyncio.Event()
+
+        async def load():
+            started.set()
+            await asyncio.sleep(0.05)
+            return "value"
+
+        first = asyncio.create_task(cache.get_or_load("key", load))
+        await started.wait()
+        second = asyncio.create_task(cache.get_or_load("key", load))
+        await asyncio.sleep(0)
+        first.cancel()
+
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        assert await second == "value"
+        assert cache.get("key") == "value"
+
+    asyncio.run(main())
+
+
+def test_failed_load_reaches_every_caller_and_is_not_cached():
+    async def main():
+        cache = AsyncLRUCache()
+
+        async def load():
+            await asyncio.sleep(0.01)
+            raise ValueError("backend down")
+
+        results = await asyncio.gather(
+            cache.get_or_load("key", load), cache.get_or_load("key", load), return_exceptions=True
+        )
+        assert all(isinstance(r, ValueError) for r in results)
+        assert cache.get("key") is None
+        assert not cache._in_flight
+
+    asyncio.run(main())
+
+
+def test_load_in_flight_during_clear_is_not_cached():
+    async def main():
+        cache = AsyncLRUCache()
+        results = iter(["before reindex", "after reindex"])
+        release = asyncio.Event()
+
+        async def load():
+            value = next(results)
+            if value == "before reindex":
+                await release.wait()
+            return value
+
+        stale = asyncio.create_task(cache.get_or_load("key", load))
+        await asyncio.sleep(0)
+        cache.clear()
+        release.set()
+        # Its caller still gets the result it waited for
+        assert await stale == "before reindex"
+
+        assert cache.get("key") is None
+        assert await cache.get_or_load("key", load) == "after reindex"
+        assert cache.get("key") == "after reindex"
+
+    asyncio.run(main())
@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+
+from resilience import KnowledgeBaseUnavailable, ResilientRetriever
+from retrievers import Retriever
+
+
+class ScriptedRetriever(Retriever):
+    """Answers each search after the next of `delays` seconds."""
+
+    def __init__(self, delays: list[float]):
+        self.delays = list(delays)
+        self.calls = 0
+
+    async def search(self, query: str, top: int):
+        self.calls += 1
+        await asyncio.sleep(self.delays.pop(0))
+        return [(query, "title", "content", None)]
+
+
+def test_hedge_wins_and_cancelled_call_is_recorded():
+    async def main():
+        # Enough fast calls to set the hedge delay, then a slow one that the hedge overtakes
+        backend = ScriptedRetriever([0.01] * 20 + [0.5, 0.01])
+        retriever = ResilientRetriever(backend, deadline=2, min_samples=20, min_hedge_delay=0.02)
+        for i in range(20):
+            await retriever.search(f"query {i}", 5)
+
+        chunks = await retriever.search("slow query", 5)
+        assert chunks[0][0] == "slow query"
+        assert backend.calls == 22
+        assert retriever.stats.hedges == 1 and retriever.stats.hedge_wins == 1
+        # Both the winner and the cancelled slow request count, the latter for at least the hedge delay
+        assert len(retriever._latencies) == 22
+        assert sorted(retriever._latencies)[-1] >= 0.02
+
+    asyncio.run(main())
+
+
+def test_timed_out_call_is_recorded():
+    async def main():
+        retriever = ResilientRetriever(ScriptedRetriever([0.5]), deadline=0.05, hedge=False)
+        with pytest.raises(KnowledgeBaseUnavailable):
+            await retriever.search("query", 5)
+        assert retriever.stats.timeouts == 1
+        assert len(retriever._latencies) == 1 and retriever._latencies[0] >= 0.05
+
+    asyncio.run(main())
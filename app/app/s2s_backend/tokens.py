@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from azure.core.credentials import AccessToken, TokenCredential
+
+logger = logging.getLogger("voicerag")
+
+
+class TokenMetrics:
+    def __init__(self):
+        self.refreshes = 0
+        self.failures = 0
+        self.refresh_ms = 0.0
+        self.last_refresh_ms: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    def as_dict(self) -> dict:
+        return {
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+            "avg_refresh_ms": self.refresh_ms / max(self.refreshes, 1),
+            "last_refresh_ms": self.last_refresh_ms,
+            "last_error": self.last_error,
+        }
+
+
+class TokenManager:
+    """Caches an Entra ID token for a single scope and refreshes it in the background.
+
+    The underlying credentials only have a blocking get_token, so refreshes run in a worker thread
+    and callers on the event loop are served the cached token. It also implements the async
+    credential protocol so it can be handed to the aio Azure SDK clients directly.
+    """
+
+    def __init__(
+        self,
+        credential: TokenCredential,
+        scope: str,
+        refresh_margin: float = 300,
+        retry_interval: float = 10,
+    ):
+        self.credential = credential
+        self.scope = scope
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self.metrics = TokenMetrics()
+        self._token: Optional[AccessToken] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._refreshing: Optional[asyncio.Future] = None
+
+    def _fetch(self) -> AccessToken:
+        start = time.perf_counter()
+        try:
+            token = self.credential.get_token(self.scope)
+        except Exception as e:
+            self.metrics.failures += 1
+            self.metrics.last_error = str(e)
+            logger.warning("Token refresh for %s failed: %s", self.scope, e)
+            raise
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.metrics.refreshes += 1
+        self.metrics.refresh_ms += elapsed_ms
+        self.metrics.last_refresh_ms = elapsed_ms
+        logger.debug("Refreshed token for %s in %.1f ms", self.scope, elapsed_ms)
+        self._token = token
+        return token
+
+    def warm_up(self) -> None:
+        # Blocking on purpose, only meant to be called during startup
+        self._fetch()
+
+    def _is_fresh(self) -> bool:
+        return self._token is not None and self._token.expires_on - time.time() > 60
+
+    async def _refresh(self) -> AccessToken:
+        # Concurrent callers share a single refresh instead of each hitting Entra ID
+        if self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(asyncio.to_thread(self._fetch))
+            self._refreshing.add_done_callback(lambda _: setattr(self, "_refreshing", None))
+        return await asyncio.shield(self._refreshing)
+
+    async def _refresh_loop(self) -> None:
+        min_delay = self.retry_interval
+        while True:
+            if self._token is not None:
+                # Never sooner than min_delay, or a credential handing back a token that already
+                # expires within the refresh margin would be asked again in a tight loop
+                delay = max(self._token.expires_on - time.time() - self.refresh_margin, min_delay)
+            else:
+                delay = 0
+            await asyncio.sleep(delay)
+            expires_on = self._token.expires_on if self._token is not None else None
+            try:
+                token = await self._refresh()
+            except Exception:
+                await asyncio.sleep(self.retry_interval)
+                continue
+            # Credentials with a token cache of their own (azd, IMDS) return the same token until
+            # it's close to expiring, back off until they hand out a new one
+            if token.expires_on == expires_on:
+                min_delay = min(min_delay * 2, max(self.refresh_margin / 2, self.retry_interval))
+            else:
+                min_delay = self.retry_interval
+
+    async def start(self) -> None:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def close(self) -> None:
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+
+    async def bearer_token(self) -> str:
+        await self.start()
+        if self._is_fresh():
+            return self._token.token
+        return (await self._refresh()).token
+
+    async def get_token(self, *scopes: str, **kwargs) -> AccessToken:
+        if scopes and self.scope not in scopes:
+            return await asyncio.to_thread(self.credential.get_token, *scopes, **kwargs)
+        await self.bearer_token()
+        return self._token
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        # The manager outlives the SDK clients that use it, it is closed explicitly instead
+        pass
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import ssl
+import time
+from types import SimpleNamespace
+from typing import Optional
+
+import aiohttp
+
+logger = logging.getLogger("voicerag")
+
+
+class ConnectionTimings:
+    """Aggregated connection setup timings toward the realtime endpoint, in milliseconds."""
+
+    def __init__(self):
+        self.connects = 0
+        self.new_connections = 0
+        self.reused_connections = 0
+        self.dns_cache_hits = 0
+        self.dns_ms = 0.0
+        self.tcp_tls_ms = 0.0
+        self.ws_connect_ms = 0.0
+        self.last_ws_connect_ms: Optional[float] = None
+
+    def as_dict(self) -> dict:
+        return {
+            "connects": self.connects,
+            "new_connections": self.new_connections,
+            "reused_connections": self.reused_connections,
+            "dns_cache_hits": self.dns_cache_hits,
+            "avg_dns_ms": self.dns_ms / max(self.new_connections, 1),
+            "avg_tcp_tls_ms": self.tcp_tls_ms / max(self.new_connections, 1),
+            "avg_ws_connect_ms": self.ws_connect_ms / max(self.connects, 1),
+            "last_ws_connect_ms": self.last_ws_connect_ms,
+        }
+
+
+class UpstreamClient:
+    """Long-lived pooled client session shared by every browser connection.
+
+    A single connector keeps the DNS cache, keep-alive connections and the TLS context alive across
+    sessions instead of paying for them on every new realtime connection. An open realtime socket
+    holds its connector slot for the whole session, so `connector_limit` (0 for none) caps concurrent
+    sessions plus warm pooled sockets, and a connect waiting for a slot fails after `connect_timeout`.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        connector_limit: int = 0,
+        connector_limit_per_host: int = 0,
+        dns_cache_ttl: int = 300,
+        keepalive_timeout: float = 30,
+        connect_timeout: float = 10,
+    ):
+        self.endpoint = endpoint
+        self.connector_limit = connector_limit
+        self.connector_limit_per_host = connector_limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.connect_timeout = connect_timeout
+        self.timings = ConnectionTimings()
+        self._session: Optional[aiohttp.ClientSession] = None
+        # Shared so certificates are loaded once instead of per connection
+        self._ssl_context = ssl.create_default_context()
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_dns_resolvehost_start(session, ctx: SimpleNamespace, params):
+            ctx.dns_start = time.perf_counter()
+
+        async def on_dns_resolvehost_end(session, ctx: SimpleNamespace, params):
+            self.timings.dns_ms += (time.perf_counter() - ctx.dns_start) * 1000
+
+        async def on_dns_cache_hit(session, ctx: SimpleNamespace, params):
+            self.timings.dns_cache_hits += 1
+
+        async def on_connection_create_start(session, ctx: SimpleNamespace, params):
+            ctx.connect_start = time.perf_counter()
+
+        async def on_connection_create_end(session, ctx: SimpleNamespace, params):
+            self.timings.new_connections += 1
+            self.timings.tcp_tls_ms += (time.perf_counter() - ctx.connect_start) * 1000
+
+        async def on_connection_reuseconn(session, ctx: SimpleNamespace, params):
+            self.timings.reused_connections += 1
+
+        trace_config.on_dns_resolvehost_start.append(on_dns_resolvehost_start)
+        trace_config.on_dns_resolvehost_end.append(on_dns_resolvehost_end)
+        trace_config.on_dns_cache_hit.append(on_dns_cache_hit)
+        trace_config.on_connection_create_start.append(on_connection_create_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    async def start(self) -> None:
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.connector_limit,
+            limit_per_host=self.connector_limit_per_host,
+            ttl_dns_cache=self.dns_cache_ttl,
+            use_dns_cache=True,
+            keepalive_timeout=self.keepalive_timeout,
+            ssl=self._ssl_context,
+        )
+        self._session = aiohttp.ClientSession(
+            base_url=self.endpoint,
+            connector=connector,
+            trace_configs=[self._trace_config()],
+        )
+        logger.info(
+            "Upstream client started (limit=%s, dns_cache_ttl=%ss)",
+            self.connector_limit,
+            self.dns_cache_ttl,
+        )
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def ws_connect(self, path: str, **kwargs) -> aiohttp.ClientWebSocketResponse:
+        # Started lazily as well so the middle tier still works when not attached to an app
+        await self.start()
+        start = time.perf_counter()
+        ws = await asyncio.wait_for(self._session.ws_connect(path, **kwargs), self.connect_timeout)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.timings.connects += 1
+        self.timings.ws_connect_ms += elapsed_ms
+        self.timings.last_ws_connect_ms = elapsed_ms
+        logger.debug("Upstream realtime connection established in %.1f ms", elapsed_ms)
+        return ws
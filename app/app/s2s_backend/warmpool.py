@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+import aiohttp
+
+import codec
+
+logger = logging.getLogger("voicerag")
+
+
+class WarmPoolStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.opened = 0
+        self.expired = 0
+        self.failed = 0
+        self.idle = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / max(self.hits + self.misses, 1),
+            "opened": self.opened,
+            "expired": self.expired,
+            "failed": self.failed,
+            "idle": self.idle,
+        }
+
+
+class WarmConnection:
+    """An upstream realtime socket that finished its handshake and has the session config applied.
+
+    The session.created and session.updated frames it already consumed, and whatever else the service
+    sent while the connection was pooled, are kept so they can be replayed to the client that ends up
+    using the connection.
+    """
+
+    def __init__(self, ws: aiohttp.ClientWebSocketResponse, session_created: str, session_updated: str):
+        self.ws = ws
+        self.session_created = session_created
+        self.session_updated = session_updated
+        self.backlog: list[str] = []
+        self.opened_at = time.monotonic()
+        self._drain_task: Optional[asyncio.Task] = None
+
+    async def _drain(self) -> None:
+        # Reading answers the service's pings and keeps its events from piling up unread
+        while True:
+            msg = await self.ws.receive()
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                self.backlog.append(msg.data)
+            elif msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSING, aiohttp.WSMsgType.CLOSED):
+                return
+            elif msg.type == aiohttp.WSMsgType.ERROR:
+                await self.ws.close()
+                return
+
+    def start_draining(self) -> None:
+        self._drain_task = asyncio.create_task(self._drain())
+
+    async def stop_draining(self) -> None:
+        # The session reads the socket itself from here on, two readers at once aren't allowed
+        if self._drain_task is not None:
+            self._drain_task.cancel()
+            try:
+                await self._drain_task
+            except asyncio.CancelledError:
+                pass
+            self._drain_task = None
+
+    async def close(self) -> None:
+        await self.stop_draining()
+        await self.ws.close()
+
+
+class WarmPool:
+    """Keeps `size` upstream connections open ahead of demand so a new browser session is attached to
+    one immediately instead of waiting for TLS, the WebSocket upgrade and session.created.
+
+    Idle connections are read from, which answers pings, and are still closed after `idle_timeout`
+    seconds rather than risking the service timing them out while pooled.
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], Awaitable[aiohttp.ClientWebSocketResponse]],
+        session_update: Callable[[], str],
+        size: int = 2,
+        idle_timeout: float = 60,
+        setup_timeout: float = 10,
+        retry_interval: float = 5,
+    ):
+        self.connect = connect
+        self.session_update = session_update
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.setup_timeout = setup_timeout
+        self.retry_interval = retry_interval
+        self.stats = WarmPoolStats()
+        self._idle: list[WarmConnection] = []
+        self._wanted = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def _receive_event(self, ws: aiohttp.ClientWebSocketResponse, event_type: str) -> str:
+        msg = await ws.receive()
+        if msg.type != aiohttp.WSMsgType.TEXT:
+            raise ConnectionError(f"Upstream closed while waiting for {event_type}: {msg.type}")
+        received_type = codec.loads(msg.data).get("type")
+        if received_type != event_type:
+            raise ConnectionError(f"Expected {event_type} from upstream, got {received_type}")
+        return msg.data
+
+    async def _configure(self, ws: aiohttp.ClientWebSocketResponse) -> WarmConnection:
+        session_created = await self._receive_event(ws, "session.created")
+        await ws.send_str(self.session_update())
+        session_updated = await self._receive_event(ws, "session.updated")
+        return WarmConnection(ws, session_created, session_updated)
+
+    async def _open(self) -> WarmConnection:
+        ws = await self.connect()
+        try:
+            connection = await asyncio.wait_for(self._configure(ws), self.setup_timeout)
+        except BaseException:
+            await ws.close()
+            raise
+        self.stats.opened += 1
+        connection.start_draining()
+        return connection
+
+    async def _expire(self) -> None:
+        now = time.monotonic()
+        # Taken out of the pool before closing anything, acquire() may pop connections meanwhile
+        expired = [c for c in self._idle if c.ws.closed or now - c.opened_at > self.idle_timeout]
+        self._idle = [c for c in self._idle if c not in expired]
+        for connection in expired:
+            self.stats.expired += 1
+            await connection.close()
+
+    async def _maintain(self) -> None:
+        while True:
+            # Cleared first so a connection taken while others are opening still gets replaced
+            self._wanted.clear()
+            await self._expire()
+            missing = self.size - len(self._idle)
+            if missing > 0:
+                results = await asyncio.gather(*[self._open() for _ in range(missing)], return_exceptions=True)
+                failures = [r for r in results if isinstance(r, BaseException)]
+                self._idle.extend(r for r in results if isinstance(r, WarmConnection))
+                self.stats.idle = len(self._idle)
+                if failures:
+                    self.stats.failed += len(failures)
+                    logger.warning("Could not open %d warm upstream connections: %s", len(failures), failures[0])
+                    await asyncio.sleep(self.retry_interval)
+                    continue
+            self.stats.idle = len(self._idle)
+            try:
+                # Woken early when a connection is taken, otherwise wakes up to expire idle ones
+                await asyncio.wait_for(self._wanted.wait(), self.idle_timeout / 4)
+            except asyncio.TimeoutError:
+                pass
+
+    async def acquire(self) -> Optional[WarmConnection]:
+        now = time.monotonic()
+        while self._idle:
+            connection = self._idle.pop(0)
+            if now - connection.opened_at <= self.idle_timeout:
+                await connection.stop_draining()
+                if not connection.ws.closed:
+                    self.stats.hits += 1
+                    self.stats.idle = len(self._idle)
+                    self._wanted.set()
+                    return connection
+            self.stats.expired += 1
+            await connection.close()
+        self.stats.misses += 1
+        self.stats.idle = 0
+        self._wanted.set()
+        return None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._maintain())
+            logger.info("Warm pool started with %d upstream connections", self.size)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for connection in self._idle:
+            await connection.close()
+        self._idle = []
+        self.stats.idle = 0
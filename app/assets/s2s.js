@@ -4,6 +4,165 @@ import useWebSocket from 'react-use-websocket';
 const SAMPLE_RATE = 24000;
 const BUFFER_SIZE = 4800;
 
+// Client side of the codecs in the middle tier's audio_codec.py, which transcodes to and from the
+// PCM16 the realtime API speaks. Both directions must produce identical bitstreams.
+const MULAW_DECODE = Int16Array.from({ length: 256 }, (_, i) => {
+  const code = ~i & 0xff;
+  const exponent = (code >> 4) & 0x07;
+  const mantissa = code & 0x0f;
+  const magnitude = (((mantissa << 3) + 0x84) << exponent) - 0x84;
+  return code & 0x80 ? -magnitude : magnitude;
+});
+
+function mulawEncode(pcm) {
+  const out = new Uint8Array(pcm.length);
+  for (let i = 0; i < pcm.length; i++) {
+    let sample = pcm[i] >> 2;
+    let sign = 0;
+    if (sample < 0) {
+      sample = -sample;
+      sign = 0x80;
+    }
+    const magnitude = Math.min((Math.min(sample, 8159) + 0x21) << 2, 32767);
+    const exponent = 31 - Math.clz32(magnitude >> 7);
+    const mantissa = (magnitude >> (exponent + 3)) & 0x0f;
+    out[i] = ~(sign | (exponent << 4) | mantissa) & 0xff;
+  }
+  return out;
+}
+
+function mulawDecode(bytes) {
+  const out = new Int16Array(bytes.length);
+  for (let i = 0; i < bytes.length; i++) {
+    out[i] = MULAW_DECODE[bytes[i]];
+  }
+  return out;
+}
+
+const ADPCM_STEPS = [
+  7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
+  50, 55, 60, 66, 73, 80, 88, 97, 107, 118, 130, 143, 157, 173, 190, 209, 230,
+  253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796, 876, 963,
+  1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327,
+  3660, 4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442,
+  11487, 12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794,
+  32767,
+];
+const ADPCM_INDEX_ADJUST = [-1, -1, -1, -1, 2, 4, 6, 8, -1, -1, -1, -1, 2, 4, 6, 8];
+const ADPCM_BLOCK_SAMPLES = 64;
+const ADPCM_BLOCK_BYTES = 4 + ADPCM_BLOCK_SAMPLES / 2;
+
+// Apply one 4 bit code: the new predictor and the new step index, as two functions so the per
+// sample loops don't allocate a result
+function adpcmPredict(predictor, index, code) {
+  const step = ADPCM_STEPS[index];
+  let delta = step >> 3;
+  if (code & 4) delta += step;
+  if (code & 2) delta += step >> 1;
+  if (code & 1) delta += step >> 2;
+  predictor = code & 8 ? predictor - delta : predictor + delta;
+  return Math.max(-32768, Math.min(32767, predictor));
+}
+
+function adpcmNextIndex(index, code) {
+  return Math.max(0, Math.min(88, index + ADPCM_INDEX_ADJUST[code]));
+}
+
+// The last block is padded by repeating the final sample
+function paddedSample(pcm, i) {
+  return pcm[Math.min(i, pcm.length - 1)];
+}
+
+// Frame layout: sample count (uint32), then independent blocks of a 4 byte header (first sample,
+// step index, reserved) and the remaining samples as nibbles, low nibble first
+function adpcmEncode(pcm) {
+  const blocks = Math.ceil(pcm.length / ADPCM_BLOCK_SAMPLES);
+  const out = new Uint8Array(4 + blocks * ADPCM_BLOCK_BYTES);
+  const view = new DataView(out.buffer);
+  view.setUint32(0, pcm.length, true);
+  for (let b = 0; b < blocks; b++) {
+    const start = b * ADPCM_BLOCK_SAMPLES;
+    const offset = 4 + b * ADPCM_BLOCK_BYTES;
+    let change = 0;
+    for (let i = 1; i < ADPCM_BLOCK_SAMPLES; i++) {
+      change += Math.abs(paddedSample(pcm, start + i) - paddedSample(pcm, start + i - 1));
+    }
+    change /= ADPCM_BLOCK_SAMPLES - 1;
+    let index = 0;
+    while (index < 88 && ADPCM_STEPS[index] < change) index++;
+
+    let predictor = paddedSample(pcm, start);
+    view.setInt16(offset, predictor, true);
+    out[offset + 2] = index;
+    for (let i = 1; i < ADPCM_BLOCK_SAMPLES; i++) {
+      const diff = paddedSample(pcm, start + i) - predictor;
+      let code = Math.min(Math.floor((Math.abs(diff) << 2) / ADPCM_STEPS[index]), 7);
+      if (diff < 0) code |= 8;
+      predictor = adpcmPredict(predictor, index, code);
+      index = adpcmNextIndex(index, code);
+      out[offset + 4 + ((i - 1) >> 1)] |= (i - 1) & 1 ? code << 4 : code;
+    }
+  }
+  return out;
+}
+
+function adpcmDecode(bytes) {
+  const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+  const count = view.getUint32(0, true);
+  const out = new Int16Array(count);
+  let n = 0;
+  for (
+    let offset = 4;
+    offset + ADPCM_BLOCK_BYTES <= bytes.length && n < count;
+    offset += ADPCM_BLOCK_BYTES
+  ) {
+    let predictor = view.getInt16(offset, true);
+    let index = Math.min(bytes[offset + 2], 88);
+    out[n++] = predictor;
+    for (let i = 1; i < ADPCM_BLOCK_SAMPLES && n < count; i++) {
+      const byte = bytes[offset + 4 + ((i - 1) >> 1)];
+      const code = (i - 1) & 1 ? byte >> 4 : byte & 0x0f;
+      predictor = adpcmPredict(predictor, index, code);
+      index = adpcmNextIndex(index, code);
+      out[n++] = predictor;
+    }
+  }
+  return out;
+}
+
+const AUDIO_CODECS = {
+  mulaw: { encode: mulawEncode, decode: mulawDecode },
+  adpcm: { encode: adpcmEncode, decode: adpcmDecode },
+};
+
+// String.fromCharCode over bounded slices, spreading a whole buffer into arguments can overflow the
+// stack and allocates an argument list as large as the audio
+const BASE64_CHUNK = 0x2000;
+
+function bytesToBase64(bytes) {
+  let binary = '';
+  for (let i = 0; i < bytes.length; i += BASE64_CHUNK) {
+    binary += String.fromCharCode.apply(null, bytes.subarray(i, i + BASE64_CHUNK));
+  }
+  return btoa(binary);
+}
+
+function base64ToBytes(base64) {
+  const binary = atob(base64);
+  const bytes = new Uint8Array(binary.length);
+  for (let i = 0; i < binary.length; i++) {
+    bytes[i] = binary.charCodeAt(i);
+  }
+  return bytes;
+}
+
+// Samples per captured chunk the recorder worklet posts, 100 ms
+const CHUNK_SAMPLES = BUFFER_SIZE / 2;
+// Captured chunks the recorder can hold while the main thread is busy, and playback buffer length.
+// Responses arrive faster than real time, the playback ring has to hold a whole one
+const CAPTURE_RING_CHUNKS = 8;
+const PLAYBACK_RING_SECONDS = 120;
+
 class Recorder {
   constructor(onDataAvailable) {
     this.onDataAvailable = onDataAvailable;
@@ -21,33 +180,73 @@ class Recorder {
 
       this.audioContext = new AudioContext({ sampleRate: SAMPLE_RATE });
 
+      // Converted samples go into a preallocated ring and leave it as whole chunks, each copied into
+      // a pooled buffer that is transferred to the main thread and transferred back once sent, so
+      // nothing is allocated per 128 frame render quantum. If the main thread stalls long enough
+      // for every buffer to be out, new samples are dropped and counted as overruns.
       const processorCode = `
                 const MIN_INT16 = -0x8000;
                 const MAX_INT16 = 0x7fff;
+                const CHUNK_SAMPLES = ${CHUNK_SAMPLES};
+                const RING_CHUNKS = ${CAPTURE_RING_CHUNKS};
 
                 class PCMAudioProcessor extends AudioWorkletProcessor {
                     constructor() {
                         super();
+                        this.ring = new Int16Array(CHUNK_SAMPLES * RING_CHUNKS);
+                        this.readIndex = 0;
+                        this.writeIndex = 0;
+                        this.available = 0;
+                        this.free = [];
+                        this.allocated = 0;
+                        this.overruns = 0;
+                        this.port.onmessage = this.handleMessage.bind(this);
+                    }
+
+                    handleMessage(event) {
+                        if (event.data === 'stats') {
+                            this.port.postMessage({ overruns: this.overruns, underruns: 0 });
+                            return;
+                        }
+                        this.free.push(event.data);
+                        this.flush();
                     }
 
                     process(inputs, outputs, parameters) {
                         const input = inputs[0];
                         if (input.length > 0) {
-                            const float32Buffer = input[0];
-                            const int16Buffer = this.float32ToInt16(float32Buffer);
-                            this.port.postMessage(int16Buffer);
+                            const samples = input[0];
+                            for (let i = 0; i < samples.length; i++) {
+                                if (this.available === this.ring.length) {
+                                    this.overruns++;
+                                    continue;
+                                }
+                                const val = Math.floor(samples[i] * MAX_INT16);
+                                this.ring[this.writeIndex] = Math.max(MIN_INT16, Math.min(MAX_INT16, val));
+                                this.writeIndex = this.writeIndex + 1 === this.ring.length ? 0 : this.writeIndex + 1;
+                                this.available++;
+                            }
+                            this.flush();
                         }
                         return true;
                     }
 
-                    float32ToInt16(float32Array) {
-                        const int16Array = new Int16Array(float32Array.length);
-                        for (let i = 0; i < float32Array.length; i++) {
-                            let val = Math.floor(float32Array[i] * MAX_INT16);
-                            val = Math.max(MIN_INT16, Math.min(MAX_INT16, val));
-                            int16Array[i] = val;
+                    flush() {
+                        // Chunks start at multiples of CHUNK_SAMPLES, so each one is contiguous in the ring
+                        while (this.available >= CHUNK_SAMPLES) {
+                            let buffer = this.free.pop();
+                            if (buffer === undefined) {
+                                if (this.allocated === RING_CHUNKS) {
+                                    return;
+                                }
+                                buffer = new ArrayBuffer(CHUNK_SAMPLES * 2);
+                                this.allocated++;
+                            }
+                            new Int16Array(buffer).set(this.ring.subarray(this.readIndex, this.readIndex + CHUNK_SAMPLES));
+                            this.readIndex = (this.readIndex + CHUNK_SAMPLES) % this.ring.length;
+                            this.available -= CHUNK_SAMPLES;
+                            this.port.postMessage(buffer, [buffer]);
                         }
-                        return int16Array;
                     }
                 }
 
@@ -69,7 +268,13 @@ class Recorder {
         'audio-processor-worklet'
       );
       this.workletNode.port.onmessage = (event) => {
-        this.onDataAvailable(event.data.buffer);
+        if (event.data instanceof ArrayBuffer) {
+          // Consumers must be done with the chunk when they return, it goes back to the worklet's pool
+          this.onDataAvailable(new Uint8Array(event.data));
+          this.workletNode?.port.postMessage(event.data, [event.data]);
+        } else {
+          this.onStats?.(event.data);
+        }
       };
 
       this.mediaStreamSource.connect(this.workletNode);
@@ -93,6 +298,32 @@ class Recorder {
     this.mediaStreamSource = null;
     this.workletNode = null;
   }
+
+  stats() {
+    return workletStats(this, this.workletNode);
+  }
+}
+
+// How long stop() waits for a worklet's counters, a torn down worklet never answers
+const WORKLET_STATS_TIMEOUT_MS = 200;
+
+// Asks a worklet for its { underruns, overruns } counters, null when it doesn't answer in time
+function workletStats(owner, node) {
+  if (!node) {
+    return Promise.resolve(null);
+  }
+  return new Promise((resolve) => {
+    const timeout = setTimeout(() => {
+      owner.onStats = null;
+      resolve(null);
+    }, WORKLET_STATS_TIMEOUT_MS);
+    owner.onStats = (stats) => {
+      clearTimeout(timeout);
+      owner.onStats = null;
+      resolve(stats);
+    };
+    node.port.postMessage('stats');
+  });
 }
 
 class Player {
@@ -102,33 +333,63 @@ class Player {
 
   async init(sampleRate) {
     const audioContext = new AudioContext({ sampleRate });
+    // PCM16 from the socket is copied into a preallocated ring and converted sample by sample in
+    // process, so playback work is linear in the audio and allocates nothing. Audio that doesn't
+    // fit is dropped and counted as overruns, and audio arriving after the ring ran dry mid
+    // response counts as an underrun, an audible gap.
     const playbackCode = `
             class AudioPlaybackWorklet extends AudioWorkletProcessor {
                 constructor() {
                     super();
                     this.port.onmessage = this.handleMessage.bind(this);
-                    this.buffer = [];
+                    this.ring = new Int16Array(sampleRate * ${PLAYBACK_RING_SECONDS});
+                    this.readIndex = 0;
+                    this.writeIndex = 0;
+                    this.available = 0;
+                    this.ranDry = false;
+                    this.underruns = 0;
+                    this.overruns = 0;
                 }
 
                 handleMessage(event) {
                     if (event.data === null) {
-                        this.buffer = [];
+                        this.readIndex = 0;
+                        this.writeIndex = 0;
+                        this.available = 0;
+                        this.ranDry = false;
+                        return;
+                    }
+                    if (event.data === 'stats') {
+                        this.port.postMessage({ underruns: this.underruns, overruns: this.overruns });
                         return;
                     }
-                    this.buffer.push(...event.data);
+                    const samples = event.data;
+                    if (this.ranDry) {
+                        this.underruns++;
+                        this.ranDry = false;
+                    }
+                    const count = Math.min(samples.length, this.ring.length - this.available);
+                    this.overruns += samples.length - count;
+                    const first = Math.min(count, this.ring.length - this.writeIndex);
+                    this.ring.set(samples.subarray(0, first), this.writeIndex);
+                    this.ring.set(samples.subarray(first, count), 0);
+                    this.writeIndex = (this.writeIndex + count) % this.ring.length;
+                    this.available += count;
                 }
 
                 process(inputs, outputs, parameters) {
                     const output = outputs[0];
                     const channel = output[0];
 
-                    if (this.buffer.length > channel.length) {
-                        const toProcess = this.buffer.slice(0, channel.length);
-                        this.buffer = this.buffer.slice(channel.length);
-                        channel.set(toProcess.map(v => v / 32768));
-                    } else {
-                        channel.set(this.buffer.map(v => v / 32768));
-                        this.buffer = [];
+                    const frames = Math.min(channel.length, this.available);
+                    for (let i = 0; i < frames; i++) {
+                        channel[i] = this.ring[this.readIndex] / 32768;
+                        this.readIndex = this.readIndex + 1 === this.ring.length ? 0 : this.readIndex + 1;
+                    }
+                    channel.fill(0, frames);
+                    this.available -= frames;
+                    if (frames > 0 && this.available === 0) {
+                        this.ranDry = true;
                     }
 
                     return true;
@@ -147,15 +408,21 @@ class Player {
       audioContext,
       'audio-playback-worklet'
     );
+    this.playbackNode.port.onmessage = (event) => this.onStats?.(event.data);
     this.playbackNode.connect(audioContext.destination);
   }
 
-  play(buffer) {
+  // Takes ownership of the samples, their buffer is transferred to the worklet without a copy
+  play(samples) {
     if (this.playbackNode) {
-      this.playbackNode.port.postMessage(buffer);
+      this.playbackNode.port.postMessage(samples, [samples.buffer]);
     }
   }
 
+  stats() {
+    return workletStats(this, this.playbackNode);
+  }
+
   stop() {
     if (this.playbackNode) {
       this.playbackNode.port.postMessage(null);
@@ -166,29 +433,8 @@ class Player {
 function useAudioRecorder({ onAudioRecorded }) {
   const audioRecorder = useRef(null);
 
-  let buffer = new Uint8Array();
-
-  const appendToBuffer = (newData) => {
-    const newBuffer = new Uint8Array(buffer.length + newData.length);
-    newBuffer.set(buffer);
-    newBuffer.set(newData, buffer.length);
-    buffer = newBuffer;
-  };
-
-  const handleAudioData = (data) => {
-    const uint8Array = new Uint8Array(data);
-    appendToBuffer(uint8Array);
-
-    if (buffer.length >= BUFFER_SIZE) {
-      const toSend = new Uint8Array(buffer.slice(0, BUFFER_SIZE));
-      buffer = new Uint8Array(buffer.slice(BUFFER_SIZE));
-
-      const regularArray = String.fromCharCode(...toSend);
-      const base64 = btoa(regularArray);
-
-      onAudioRecorded(base64);
-    }
-  };
+  // The worklet already delivers BUFFER_SIZE byte chunks
+  const handleAudioData = (chunk) => onAudioRecorded(chunk);
 
   const start = async () => {
     if (!audioRecorder.current) {
@@ -200,6 +446,10 @@ function useAudioRecorder({ onAudioRecorded }) {
 
   const stop = async () => {
     if (audioRecorder.current) {
+      const stats = await audioRecorder.current.stats();
+      if (stats?.overruns) {
+        console.warn('Audio capture overruns (samples dropped):', stats.overruns);
+      }
       await audioRecorder.current.stop();
     }
   };
@@ -215,10 +465,12 @@ function useAudioPlayer() {
     audioPlayer.current.init(SAMPLE_RATE);
   };
 
-  const play = (base64Audio) => {
-    const binary = atob(base64Audio);
-    const bytes = Uint8Array.from(binary, (c) => c.charCodeAt(0));
-    const pcmData = new Int16Array(bytes.buffer);
+  // Accepts either a base64 string from a JSON audio delta or a PCM16 ArrayBuffer, from binary mode or
+  // decoded from the negotiated codec
+  const play = (audio) => {
+    const pcmData = new Int16Array(
+      typeof audio === 'string' ? base64ToBytes(audio).buffer : audio
+    );
 
     if (audioPlayer.current) {
       audioPlayer.current.play(pcmData);
@@ -231,11 +483,29 @@ function useAudioPlayer() {
     }
   };
 
-  return { reset, play, stop };
+  // { underruns, overruns } of the playback worklet
+  const stats = () => audioPlayer.current?.stats() ?? Promise.resolve(null);
+
+  return { reset, play, stop, stats };
+}
+
+// report_grounding only sends the ids and titles of cited chunks, their content is fetched from the
+// middle tier's /chunks route when it is shown. Responses carry an ETag and Cache-Control, so the
+// browser cache answers repeated citations.
+export async function fetchGroundingChunks(wsEndpoint, ids) {
+  const url = new URL('/chunks', wsEndpoint.replace(/^ws/, 'http'));
+  url.searchParams.set('ids', ids.join(','));
+  const response = await fetch(url);
+  if (!response.ok) {
+    throw new Error(`Fetching chunks failed: ${response.status}`);
+  }
+  return (await response.json()).chunks;
 }
 
 function useRealTime({
   wsEndpoint,
+  binaryAudio,
+  audioCodec,
   enableInputAudioTranscription,
   onWebSocketOpen,
   onWebSocketClose,
@@ -243,14 +513,26 @@ function useRealTime({
   onWebSocketMessage,
   onReceivedResponseDone,
   onReceivedResponseAudioDelta,
+  onReceivedResponseAudioBinary,
   onReceivedResponseAudioTranscriptDelta,
   onReceivedInputAudioBufferSpeechStarted,
   onReceivedExtensionMiddleTierToolResponse,
   onReceivedInputAudioTranscriptionCompleted,
   onReceivedError,
 }) {
-  const { sendJsonMessage } = useWebSocket(wsEndpoint, {
-    onOpen: () => onWebSocketOpen?.(),
+  // Set from the middle tier's extension.audio_codec answer to the codecs offered in audioCodec
+  const codec = useRef(null);
+
+  const queryParams = {};
+  if (binaryAudio) queryParams.audio = 'binary';
+  if (audioCodec) queryParams.codec = audioCodec;
+
+  const { sendMessage, sendJsonMessage } = useWebSocket(wsEndpoint, {
+    queryParams: Object.keys(queryParams).length ? queryParams : undefined,
+    onOpen: (event) => {
+      event.target.binaryType = 'arraybuffer';
+      onWebSocketOpen?.();
+    },
     onClose: () => onWebSocketClose?.(),
     onError: (event) => onWebSocketError?.(event),
     onMessage: (event) => onMessageReceived(event),
@@ -264,10 +546,24 @@ function useRealTime({
     sendJsonMessage(command);
   };
 
-  const addUserAudio = (base64Audio) => {
+  const addUserAudio = (pcmBytes) => {
+    const audioBytes = codec.current
+      ? codec.current.encode(
+          new Int16Array(pcmBytes.buffer, pcmBytes.byteOffset, pcmBytes.length / 2)
+        )
+      : pcmBytes;
+
+    // In binary mode the middle tier wraps the audio into input_audio_buffer.append itself. Raw PCM
+    // is the recorder's pooled buffer, which is reused once this returns, so it is sent as a copy
+    // in case the socket queues it
+    if (binaryAudio) {
+      sendMessage(codec.current ? audioBytes.buffer : audioBytes.slice().buffer);
+      return;
+    }
+
     const command = {
       type: 'input_audio_buffer.append',
-      audio: base64Audio,
+      audio: bytesToBase64(audioBytes),
     };
 
     sendJsonMessage(command);
@@ -284,6 +580,15 @@ function useRealTime({
   const onMessageReceived = (event) => {
     onWebSocketMessage?.(event);
 
+    if (event.data instanceof ArrayBuffer) {
+      onReceivedResponseAudioBinary?.(
+        codec.current
+          ? codec.current.decode(new Uint8Array(event.data)).buffer
+          : event.data
+      );
+      return;
+    }
+
     let message;
     try {
       message = JSON.parse(event.data);
@@ -297,8 +602,14 @@ function useRealTime({
         onReceivedResponseDone?.(message);
         break;
       case 'response.audio.delta':
+        if (codec.current) {
+          message.delta = codec.current.decode(base64ToBytes(message.delta)).buffer;
+        }
         onReceivedResponseAudioDelta?.(message);
         break;
+      case 'extension.audio_codec':
+        codec.current = AUDIO_CODECS[message.codec] ?? null;
+        break;
       case 'response.audio_transcript.delta':
         onReceivedResponseAudioTranscriptDelta?.(message);
         break;
@@ -325,9 +636,13 @@ export function S2S(props) {
   const wsEndpoint = props.wsEndpoint;
   const startText = props.startText;
   const stopText = props.stopText;
+  const binaryAudio = props.binaryAudio;
+  const audioCodec = props.audioCodec;
 
   const { startSession, addUserAudio, inputAudioBufferClear } = useRealTime({
     wsEndpoint,
+    binaryAudio,
+    audioCodec,
     onWebSocketOpen: () => console.log('WebSocket connection opened'),
     onWebSocketClose: () => console.log('WebSocket connection closed'),
     onWebSocketError: (event) => console.error('WebSocket error:', event),
@@ -335,10 +650,14 @@ export function S2S(props) {
     onReceivedResponseAudioDelta: (message) => {
       isRecording && playAudio(message.delta);
     },
+    onReceivedResponseAudioBinary: (buffer) => {
+      isRecording && playAudio(buffer);
+    },
     onReceivedInputAudioBufferSpeechStarted: () => {
       stopAudioPlayer();
     },
     onReceivedExtensionMiddleTierToolResponse: (message) => {
+      // Citations arrive as { sources: [{ chunk_id, title }] }, see fetchGroundingChunks
       console.log(message);
     },
   });
@@ -347,6 +666,7 @@ export function S2S(props) {
     reset: resetAudioPlayer,
     play: playAudio,
     stop: stopAudioPlayer,
+    stats: audioPlayerStats,
   } = useAudioPlayer();
   const { start: startAudioRecording, stop: stopAudioRecording } =
     useAudioRecorder({ onAudioRecorded: addUserAudio });
@@ -360,6 +680,10 @@ export function S2S(props) {
       setIsRecording(true);
     } else {
       await stopAudioRecording();
+      const playbackStats = await audioPlayerStats();
+      if (playbackStats?.underruns || playbackStats?.overruns) {
+        console.warn('Audio playback underruns and overruns:', playbackStats);
+      }
       stopAudioPlayer();
       inputAudioBufferClear();
 